@@ -0,0 +1,124 @@
+"""
+==========================
+Precheck of signal quality
+==========================
+
+Check the raw data of a subject before the preprocessing (see
+``signal_quality.py``): flat, clipped and noisy channels, line noise and
+the external channels. The data are streamed from the BIDS dataset in chunks
+(only the task blocks), which takes a fraction of the time of PREP and ICA.
+
+The statistics of each channel are written to a .tsv file, the status of the
+subject and its bad channels to a .json file. ``01_run_preprocessing.py``
+starts PREP with these bad channels. The script fails for hopeless subjects
+(too many bad channels), so that ``pipeline.py`` does not run the later
+stages for them (use ``--skip_hopeless False`` to only flag them).
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+import os
+import time
+
+import pandas as pd
+
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_BIDS,
+    FPATH_BIDS_NOT_FOUND_MSG,
+    PRECHECK_PARAMS,
+    SUBJECT_IDS,
+    task_events
+)
+
+from utils import parse_overwrite, find_task_blocks, write_json
+
+from layout import get_fname, get_layout
+
+from qc_index import update_qc
+
+from signal_quality import check_recording, assess
+
+# %%
+# keep track of the runtime
+start_time = time.time()
+
+# %%
+# default settings (use subject 1, don't overwrite output files)
+subj = 1
+overwrite = False
+skip_hopeless = True
+
+# %%
+# When not in an IPython session, get command line inputs
+# https://docs.python.org/3/library/sys.html#sys.ps1
+if not hasattr(sys, "ps1"):
+    defaults = dict(
+        sub=subj,
+        overwrite=overwrite,
+        skip_hopeless=skip_hopeless,
+    )
+
+    defaults = parse_overwrite(defaults)
+
+    subj = defaults["sub"]
+    overwrite = defaults["overwrite"]
+    skip_hopeless = defaults["skip_hopeless"]
+
+# %%
+# paths and overwrite settings
+if subj not in SUBJECT_IDS:
+    raise ValueError(f"'{subj}' is not a valid subject ID.\nUse: {SUBJECT_IDS}")
+
+if not os.path.exists(FPATH_DATA_BIDS):
+    raise RuntimeError(
+        FPATH_BIDS_NOT_FOUND_MSG.format(FPATH_DATA_BIDS)
+    )
+
+# %%
+# task blocks (same selection of cues as in ``01_run_preprocessing.py``),
+# the whole recording if the events are missing
+blocks = None
+if get_layout().exists('bids_events', subj):
+    events = pd.read_csv(get_fname('bids_events', subj), sep='\t')
+    codes = events.trial_type.astype(str).map(task_events)
+    latencies = events.onset[(codes >= 1) & (codes <= 7)].to_numpy()
+    try:
+        _, blocks = find_task_blocks(latencies, subj)
+    except ValueError as err:
+        logger.info(f"    > {err}, checking the whole recording")
+
+# %%
+# statistics of each channel
+channels, n_windows = check_recording(get_fname('bids', subj), blocks=blocks)
+summary = assess(channels, n_windows)
+
+logger.info(f"\nSignal quality of subject {subj}: {summary['status']} "
+            f"({n_windows} s checked)")
+for reason in summary['reasons']:
+    logger.info(f"    > {reason}")
+
+# %%
+# save the statistics and the summary
+FPATH_CHANNELS = get_fname('precheck_channels', subj, make_dirs=True)
+channels.to_csv(FPATH_CHANNELS, sep='\t', index=False, float_format='%.6g')
+write_json(get_fname('precheck', subj),
+           dict(subject=subj, **summary, params=PRECHECK_PARAMS,
+                blocks=blocks))
+
+# %%
+# add quality-control information to the index
+update_qc(subj, 'precheck',
+          runtime=time.time() - start_time,
+          precheck_status=summary['status'],
+          precheck_bad_channels=summary['bad_channels'],
+          precheck_bad_exg=summary['bad_exg'])
+
+# %%
+# stop here for hopeless subjects
+if summary['status'] == 'hopeless' and skip_hopeless:
+    raise RuntimeError(f"Subject {subj} fails the signal-quality precheck: "
+                       f"{'; '.join(summary['reasons'])}")
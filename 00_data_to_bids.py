@@ -20,24 +20,27 @@ from mne import find_events
 from mne.io import read_raw_bdf
 from mne.utils import logger
 
-from mne_bids import BIDSPath, write_raw_bids
+from mne_bids import write_raw_bids
 
 from config import (
     FPATH_DATA_SOURCEDATA,
-    FPATH_DATA_BIDS,
     FPATH_SOURCEDATA_NOT_FOUND_MSG,
-    FNAME_SOURCEDATA_TEMPLATE,
     SUBJECT_IDS,
     montage,
     event_id
 )
 
+from layout import get_dir, get_fname, get_bids_path
+
+from decoded_cache import DecodedCache, load_decoded
+
 from utils import parse_overwrite
 
 # %%
 # default settings (use subject 1, don't overwrite output files)
 subj = 1
 overwrite = False
+decoded_cache = False
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -46,12 +49,14 @@ if not hasattr(sys, "ps1"):
     defaults = dict(
         sub=subj,
         overwrite=overwrite,
+        decoded_cache=decoded_cache,
     )
 
     defaults = parse_overwrite(defaults)
 
     subj = defaults["sub"]
     overwrite = defaults["overwrite"]
+    decoded_cache = defaults["decoded_cache"]
 
 # %%
 # paths and overwrite settings
@@ -67,7 +72,7 @@ if overwrite:
 
 # %%
 # path to file in question (i.e., which subject and session)
-fname = FNAME_SOURCEDATA_TEMPLATE.format(subj=subj, dtype='eeg', ext='.bdf')
+fname = get_fname('sourcedata', subj)
 
 # %%
 # 1) import the data
@@ -103,9 +108,7 @@ date = date_of_record.strftime('%Y-%m-%d')
 
 # here, we compute only and approximate of the subject's birthday
 # this is to keep the date anonymous (at least to some degree)
-demographics = FNAME_SOURCEDATA_TEMPLATE.format(subj=subj,
-                                                dtype='demographics',
-                                                ext='.tsv')
+demographics = get_fname('demographics', subj)
 demo = pd.read_csv(demographics, sep='\t', header=0)
 age = demo[demo.subject_id == 'sub-' + str(subj).rjust(3, '0')].age
 sex = demo[demo.subject_id == 'sub-' + str(subj).rjust(3, '0')].sex
@@ -125,7 +128,12 @@ raw.info['line_freq'] = 50.0
 
 # %%
 # 3) get eeg events
-events = find_events(raw,
+# with the cache, the recording is decoded once here and later stages read
+# the decoded data (see ``decoded_cache.py``)
+raw_events = raw
+if decoded_cache:
+    raw_events = load_decoded(raw, DecodedCache(get_dir('decoded_cache')))
+events = find_events(raw_events,
                      stim_channel='Status',
                      output='onset',
                      min_duration=0.0)
@@ -137,10 +145,7 @@ events = events[keep_evs]
 # 4) export to bids
 
 # create bids path
-output_path = BIDSPath(subject=f'{subj:03}',
-                       task='dpx',
-                       datatype='eeg',
-                       root=FPATH_DATA_BIDS)
+output_path = get_bids_path(subj)
 # write file
 write_raw_bids(raw,
                events_data=events,
@@ -6,41 +6,27 @@ and analysis pipelines.
 The script will create:
 1. The `derivatives/` directory at the location specified in the `paths.json`
 file.
+2. The sub-directories for the results of each stage, as well as for the
+record of pipeline runs (see `manifest.py`) and the quality-control index
+(see `qc_index.py`).
 
-**The script will throw and error if there is a directory with the same name
-at the same location.**
+Directories that are already there are left untouched, so the script can be
+re-run safely, e.g., when resuming an interrupted run of the pipeline.
 """
 # %%
 # imports
-from os import path
-from pathlib import Path
+from mne.utils import logger
 
-from config import (
-    FPATH_DATA_DERIVATIVES
-)
+from layout import DIRECTORIES, get_dir
 
-# check if derivatives dir is already there, if not, create it.
-if FPATH_DATA_DERIVATIVES.exists():
-    raise RuntimeError("The derivatives directory is already there,"
-                       "stopping execution.")
-else:
-    # create derivatives directory along with subdirectories
-    FPATH_DATA_DERIVATIVES.mkdir(exist_ok=True)
-    # preprocessing
-    FPATH_PREPROCESSING = path.join(FPATH_DATA_DERIVATIVES, 'preprocessing')
-    Path(FPATH_PREPROCESSING).mkdir(exist_ok=True)
-    # bad channels
-    FPATH_BADS = path.join(FPATH_PREPROCESSING, 'bad_channels')
-    Path(FPATH_BADS).mkdir(exist_ok=True)
-    # preprocessed data
-    FPATH_PREPROCESSED = path.join(FPATH_PREPROCESSING, 'preprocessed')
-    Path(FPATH_PREPROCESSED).mkdir(exist_ok=True)
-    # ICA
-    FPATH_ICA = path.join(FPATH_PREPROCESSING, 'ICA')
-    Path(FPATH_ICA).mkdir(exist_ok=True)
-    # RT
-    FPATH_RT = path.join(FPATH_DATA_DERIVATIVES, 'rt')
-    Path(FPATH_RT).mkdir(exist_ok=True)
-    # EPOCHS
-    FPATH_EPOCHS = path.join(FPATH_DATA_DERIVATIVES, 'epochs')
-    Path(FPATH_EPOCHS).mkdir(exist_ok=True)
+# check if derivatives dir is already there
+if get_dir('derivatives').exists():
+    logger.info("The derivatives directory is already there, "
+                "only creating missing sub-directories.")
+
+# create derivatives directory along with subdirectories for the results of
+# each stage, the record of pipeline runs, the quality-control index, etc.
+# (see `DIRECTORIES` in `layout.py`)
+for kind, directory in DIRECTORIES.items():
+    if directory.is_relative_to(get_dir('derivatives')):
+        get_dir(kind, make_dirs=True)
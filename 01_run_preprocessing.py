@@ -13,8 +13,8 @@ License: BSD (3-clause)
 # imports
 import sys
 import os
-
-from pathlib import Path
+import time
+import resource
 
 import json
 
@@ -22,14 +22,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from mne import events_from_annotations, concatenate_raws
-from mne.preprocessing import ICA, corrmap
+from mne.io import read_raw_fif
+from mne.preprocessing import corrmap
 from mne.utils import logger
 
-from mne_bids import BIDSPath, read_raw_bids
+from mne_bids import read_raw_bids
 
 from config import (
     FPATH_DATA_BIDS,
-    FPATH_DATA_DERIVATIVES,
     FPATH_BIDS_NOT_FOUND_MSG,
     EOG_COMPONENTS_NOT_FOUND_MSG,
     SUBJECT_IDS,
@@ -37,14 +37,50 @@ from config import (
     ica_templates
 )
 
-from utils import parse_overwrite
+from utils import parse_overwrite, ica_template_scores, find_task_blocks
+
+from layout import get_fname, get_dir, get_bids_path
+
+from qc_index import update_qc
+
+from chunked_filter import filter_raw_chunked
+
+from interpolation import InterpolationCache, cached_interpolation
+
+from ica_methods import make_ica, fit_ica
+
+from line_noise import remove_line_noise
+
+from robust_reference import robust_reference
+
+from decoded_cache import DecodedCache, load_decoded
+
+from overlapped_io import BackgroundWriter, figure_bytes, write_bytes
 
 from pyprep.prep_pipeline import PrepPipeline
 
+# %%
+# keep track of the runtime
+start_time = time.time()
+
 # %%
 # default settings (use subject 1, don't overwrite output files)
 subj = 1
 overwrite = False
+n_jobs = 4
+plot_ica = False
+memory_budget = None
+low_memory = False
+interpolation_cache = True
+ica_method = 'infomax'
+ica_max_iter = None
+ica_tol = None
+line_noise_method = 'prep'
+random_state = None
+background_writes = True
+decoded_cache = False
+precheck_bads = True
+reference_method = 'pyprep'
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -53,12 +89,40 @@ if not hasattr(sys, "ps1"):
     defaults = dict(
         sub=subj,
         overwrite=overwrite,
+        n_jobs=n_jobs,
+        plot_ica=plot_ica,
+        memory_budget=memory_budget,
+        low_memory=low_memory,
+        interpolation_cache=interpolation_cache,
+        ica_method=ica_method,
+        ica_max_iter=ica_max_iter,
+        ica_tol=ica_tol,
+        line_noise_method=line_noise_method,
+        random_state=random_state,
+        background_writes=background_writes,
+        decoded_cache=decoded_cache,
+        precheck_bads=precheck_bads,
+        reference_method=reference_method,
     )
 
     defaults = parse_overwrite(defaults)
 
     subj = defaults["sub"]
     overwrite = defaults["overwrite"]
+    n_jobs = defaults["n_jobs"]
+    plot_ica = defaults["plot_ica"]
+    memory_budget = defaults["memory_budget"]
+    low_memory = defaults["low_memory"]
+    interpolation_cache = defaults["interpolation_cache"]
+    ica_method = defaults["ica_method"]
+    ica_max_iter = defaults["ica_max_iter"]
+    ica_tol = defaults["ica_tol"]
+    line_noise_method = defaults["line_noise_method"]
+    random_state = defaults["random_state"]
+    background_writes = defaults["background_writes"]
+    decoded_cache = defaults["decoded_cache"]
+    precheck_bads = defaults["precheck_bads"]
+    reference_method = defaults["reference_method"]
 
 # %%
 # paths and overwrite settings
@@ -72,17 +136,23 @@ if not os.path.exists(FPATH_DATA_BIDS):
 if overwrite:
     logger.info("`overwrite` is set to ``True`` ")
 
+if reference_method not in ('pyprep', 'vectorized'):
+    raise ValueError(f"Unknown reference method '{reference_method}', use "
+                     f"'pyprep' or 'vectorized'.")
+
 # %%
 # create bids path for import
-str_subj = str(subj).rjust(3, '0')
-raw_fname = BIDSPath(root=FPATH_DATA_BIDS,
-                     subject=str_subj,
-                     task='dpx',
-                     datatype='eeg',
-                     extension='.bdf')
+raw_fname = get_bids_path(subj, extension='.bdf')
 # get the data
 raw = read_raw_bids(raw_fname)
-raw.load_data()
+# read decoded data from the cache instead of decoding the .bdf file (see
+# ``decoded_cache.py``), data are memory-mapped until they are loaded
+if decoded_cache:
+    raw = load_decoded(raw, DecodedCache(get_dir('decoded_cache')))
+# with a memory budget, data are streamed from disk when filtering, in
+# low-memory mode only the task blocks are read from disk (see below)
+if memory_budget is None and not low_memory:
+    raw.load_data()
 
 # get sampling rate
 sfreq = raw.info['sfreq']
@@ -100,45 +170,16 @@ events = events_from_annotations(raw, event_id=task_events)
 cue_evs = events[0]
 cue_evs = cue_evs[(cue_evs[:, 2] >= 1) & (cue_evs[:, 2] <= 7)]
 
-# latencies and difference between two consecutive cues
+# latencies of the cues
 latencies = cue_evs[:, 0] / sfreq
-diffs = [(y - x) for x, y in zip(latencies, latencies[1:])]
 
 # get first event after a long break (i.e., when the time difference between
 # stimuli is greater than 10 seconds). This should only be the case in between
 # task blocks
-breaks = [diff for diff in range(len(diffs)) if diffs[diff] > 10]
+breaks, ((b1s, b1e), (b2s, b2e)) = find_task_blocks(latencies, subj)
 logger.info("\nIdentified breaks at positions:\n %s " % ', '.join(
     [str(br) for br in breaks]))
 
-# save start and end points of task blocks
-# subject '041' has more practice trials (two rounds)
-if subj == 41:
-    # start of first block
-    b1s = latencies[breaks[2] + 1] - 2
-    # end of first block
-    b1e = latencies[breaks[3]] + 6
-
-    # start of second block
-    b2s = latencies[breaks[3] + 1] - 2
-    # end of second block
-    b2e = latencies[breaks[4]] + 6
-
-# all other subjects have the same structure
-else:
-    # start of first block
-    b1s = latencies[breaks[0] + 1] - 2
-    # end of first block
-    b1e = latencies[breaks[1]] + 6
-
-    # start of second block
-    b2s = latencies[breaks[1] + 1] - 2
-    # end of second block
-    if len(breaks) > 2:
-        b2e = latencies[breaks[2]] + 6
-    else:
-        b2e = latencies[-1] + 6
-
 # %%
 # extract data chunks belonging to the task blocks and concatenate them
 # block 1
@@ -147,37 +188,112 @@ raw_bl1 = raw.copy().crop(tmin=b1s, tmax=b1e)
 raw_bl2 = raw.copy().crop(tmin=b2s, tmax=b2e)
 # concatenate
 raw_bl = concatenate_raws([raw_bl1, raw_bl2])
-del raw
+del raw, raw_bl1, raw_bl2
+if low_memory and memory_budget is None:
+    raw_bl.load_data()
 
 # %%
 # apply filter to data
-raw_bl = raw_bl.filter(l_freq=0.1, h_freq=40.,
-                       picks=['eeg', 'eog'],
-                       filter_length='auto',
-                       l_trans_bandwidth='auto',
-                       h_trans_bandwidth='auto',
-                       method='fir',
-                       phase='zero',
-                       fir_window='hamming',
-                       fir_design='firwin',
-                       n_jobs=4)
+if memory_budget is None:
+    raw_bl = raw_bl.filter(l_freq=0.1, h_freq=40.,
+                           picks=['eeg', 'eog'],
+                           filter_length='auto',
+                           l_trans_bandwidth='auto',
+                           h_trans_bandwidth='auto',
+                           method='fir',
+                           phase='zero',
+                           fir_window='hamming',
+                           fir_design='firwin',
+                           n_jobs=n_jobs)
+else:
+    # same filter, but data are read and filtered in chunks and written
+    # to a file, which is memory-mapped
+    FPATH_FILTERED = get_fname('filtered_tmp', subj, make_dirs=True)
+    raw_bl = filter_raw_chunked(raw_bl, l_freq=0.1, h_freq=40.,
+                                fname=FPATH_FILTERED,
+                                picks=('eeg', 'eog'),
+                                memory_budget=memory_budget,
+                                filter_length='auto',
+                                l_trans_bandwidth='auto',
+                                h_trans_bandwidth='auto',
+                                fir_window='hamming',
+                                fir_design='firwin')
 
 # %%
 # raw_bl.plot(scalings=dict(eeg=50e-6), n_channels=64, block=True)
 
 # %%
-# make a copy of the data in question
-raw_copy = raw_bl.copy()
+# start PREP with the bad channels of the signal-quality precheck (see
+# ``00_check_signal_quality.py``), PREP leaves them out of the reference and
+# interpolates them
+FPATH_PRECHECK = get_fname('precheck', subj)
+if precheck_bads and os.path.exists(FPATH_PRECHECK):
+    with open(FPATH_PRECHECK) as precheck:
+        precheck = json.load(precheck)
+    raw_bl.info['bads'] = precheck['bad_channels']
+    logger.info(f"    > Bad channels of the precheck: "
+                f"{precheck['bad_channels']}")
 
+# %%
+# remove line noise of all channels at once (see ``line_noise.py``), this
+# replaces PREP's line-noise removal and the notch filter below
+line_freqs = np.arange(50, raw_bl.info['sfreq'] / 2, 50)
+line_noise_fit = None
+if line_noise_method != 'prep':
+    line_noise_fit = remove_line_noise(raw_bl, method=line_noise_method,
+                                       n_jobs=n_jobs)
+    # PREP skips its line-noise removal without line frequencies
+    line_freqs = []
+
+# %%
 # set up prep pipeline
 prep_params = {
     "ref_chs": "eeg",
     "reref_chs": "eeg",
-    "line_freqs": np.arange(50, raw_copy.info['sfreq'] / 2, 50),
+    "line_freqs": line_freqs,
 }
-# run data through preprocessing pipeline
-prep = PrepPipeline(raw_copy, prep_params, montage, ransac=False)
-prep.fit()
+if low_memory or memory_budget is not None:
+    # PREP works on its own copy of the data, no need to keep ours (with a
+    # memory budget, the memory-mapped data are only read once)
+    prep = PrepPipeline(raw_bl, prep_params, montage, ransac=False)
+    del raw_bl
+else:
+    # make a copy of the data in question
+    raw_copy = raw_bl.copy()
+    # run data through preprocessing pipeline
+    prep = PrepPipeline(raw_copy, prep_params, montage, ransac=False)
+
+# interpolation matrices are shared by subjects with the same bad channels
+# (see ``interpolation.py``), PREP interpolates in each iteration of the
+# robust referencing
+interp_cache = InterpolationCache(
+    get_dir('interpolation_cache', make_dirs=True)
+    if interpolation_cache else None)
+
+prep_start = time.time()
+with cached_interpolation(interp_cache):
+    if reference_method == 'vectorized':
+        # PREP's line-noise removal, then the robust referencing with
+        # vectorized bad-channel detection (see ``robust_reference.py``)
+        if len(line_freqs):
+            prep.remove_line_noise(prep.prep_params['line_freqs'])
+            del prep.EEG_new, prep.EEG_clean
+        del prep.EEG_raw
+        robust_reference(prep)
+    elif low_memory and len(line_freqs):
+        # same as ``prep.fit()``, but the intermediate results of the line
+        # noise removal are dropped before the robust referencing
+        prep.remove_line_noise(prep.prep_params['line_freqs'])
+        del prep.EEG_raw, prep.EEG_new, prep.EEG_clean
+        prep.robust_reference(prep.prep_params['max_iterations'])
+    else:
+        if low_memory:
+            # only needed for PREP's line-noise removal
+            del prep.EEG_raw
+        prep.fit()
+prep_seconds = time.time() - prep_start
+logger.info(f"    > PREP ({reference_method} reference) took "
+            f"{prep_seconds:.1f} s")
 
 # %%
 # crate summary for PyPrep output
@@ -189,48 +305,64 @@ bad_channels = {'interpolated_chans': prep.interpolated_channels,
 # %%
 # export summary to .json
 
-# create path
-FPATH_BADS = os.path.join(FPATH_DATA_DERIVATIVES,
-                          'preprocessing',
-                          'bad_channels',
-                          'sub-%s' % str_subj,
-                          '%s_bad_channels.json' % str_subj)
-# chekc if directory exists
-if not Path(FPATH_BADS).exists():
-    Path(FPATH_BADS).parent.mkdir(parents=True, exist_ok=True)
+# create path (and directory if needed)
+FPATH_BADS = get_fname('bad_channels', subj, make_dirs=True)
 # save file
 with open(FPATH_BADS, 'w') as bads_file:
     json.dump(bad_channels, bads_file, indent=2)
 
 # %%
 # extract the re-referenced eeg data
-clean_raw = prep.raw.copy()
-del prep, raw_bl, raw_copy
+if low_memory:
+    # take over PREP's data instead of copying it (``prep.raw`` would copy)
+    clean_raw = prep.raw_eeg
+    if prep.raw_non_eeg is not None:
+        clean_raw.add_channels([prep.raw_non_eeg], force_update_info=True)
+    del prep
+else:
+    clean_raw = prep.raw.copy()
+    del prep
+    if memory_budget is None:
+        del raw_bl, raw_copy
 
 # %%
 # interpolate any remaining bad channels
-clean_raw.interpolate_bads()
+with cached_interpolation(interp_cache):
+    clean_raw.interpolate_bads()
+logger.info(f"    > Interpolation matrices: {interp_cache.hits} reused, "
+            f"{interp_cache.misses} computed")
 # apply notch filter (50Hz)
-line_noise = [50., 100.]
-clean_raw = clean_raw.notch_filter(freqs=line_noise, n_jobs=4)
+if line_noise_method == 'prep':
+    line_noise = [50., 100.]
+    clean_raw = clean_raw.notch_filter(freqs=line_noise, n_jobs=n_jobs)
 
 # %%
 # prepare ICA
 
 # filter data to remove drifts
-raw_filt = clean_raw.copy().filter(l_freq=1.0, h_freq=None, n_jobs=4)
+if low_memory:
+    # keep the data on disk (in double precision, i.e., unchanged) while
+    # ICA is fitted on the filtered data, instead of holding a copy
+    FPATH_CLEAN = get_fname('clean_tmp', subj, make_dirs=True)
+    clean_raw.save(FPATH_CLEAN, fmt='double', overwrite=True)
+    raw_filt = clean_raw.filter(l_freq=1.0, h_freq=None, n_jobs=n_jobs)
+    del clean_raw
+else:
+    raw_filt = clean_raw.copy().filter(l_freq=1.0, h_freq=None,
+                                       n_jobs=n_jobs)
 
-# set ICA parameters
-method = 'infomax'
+# set ICA parameters (see `ICA_METHODS` in config.py)
 reject = dict(eeg=250e-6)
-ica = ICA(n_components=0.951,
-          method=method,
-          fit_params=dict(extended=True))
+ica = make_ica(method=ica_method,
+               n_components=0.951,
+               max_iter='auto' if ica_max_iter is None else ica_max_iter,
+               tol=ica_tol,
+               random_state=random_state)
 
 # run ICA
-ica.fit(raw_filt,
-        reject=reject,
-        reject_by_annotation=True)
+ica, ica_fit = fit_ica(ica, raw_filt, reject=reject)
+logger.info(f"    > ICA ({ica_method}) converged: {ica_fit['converged']}, "
+            f"{ica_fit['n_iter']} iterations, {ica_fit['seconds']:.1f} s")
 
 # %%
 # look for components that show high correlation with the artefact templates
@@ -243,7 +375,8 @@ try:
         threshold = 'auto'
     corrmap([ica],
             template=np.array(ica_templates['vertical_eye']),
-            threshold=threshold, label='vertical_eog', show=False)
+            threshold=threshold, label='vertical_eog',
+            plot=False, show=False)
     plt.close('all')
 except:
     logger.info(
@@ -264,7 +397,8 @@ try:
         threshold = 'auto'
     corrmap([ica],
             template=np.array(ica_templates['horizontal_eye']),
-            label='horizontal_eog', show=False, threshold=threshold)
+            label='horizontal_eog', threshold=threshold,
+            plot=False, show=False)
     plt.close('all')
 except:
     logger.info(
@@ -291,36 +425,86 @@ logger.info('\n Found bad components:\n %s' % bad_components)
 ica.exclude = np.unique(bad_components)
 
 # %%
-# save ica figure
-
-# create path
-FPATH_ICA = os.path.join(FPATH_DATA_DERIVATIVES,
-                          'preprocessing',
-                          'ICA',
-                          'sub-%s' % str_subj,
-                          '%s_ica_components.png' % str_subj)
-# chekc if directory exists
-if not Path(FPATH_ICA).exists():
-    Path(FPATH_ICA).parent.mkdir(parents=True, exist_ok=True)
-
-# save figure
-fig = ica.plot_components(show=False)
-fig[0].savefig(FPATH_ICA, dpi=100, facecolor='white')
-plt.close('all')
+# save ica solution (figures of the components are rendered in a separate
+# step, see `python pipeline.py render-qc`)
+
+# outputs are written on a background thread while the computation goes on
+# (see ``overlapped_io.py``)
+writer = BackgroundWriter(enabled=background_writes)
+
+# create path (and directory if needed)
+FPATH_ICA = get_fname('ica', subj, make_dirs=True)
+
+# save file
+writer.submit(FPATH_ICA, lambda fname, ica: ica.save(fname, overwrite=True),
+              ica, overwrite=overwrite)
+
+# %%
+# save ica figure (only if requested)
+if plot_ica:
+    # create path
+    FPATH_ICA_FIGURE = get_fname('ica_figure', subj)
+
+    # save figure
+    fig = ica.plot_components(show=False)
+    # a list of figures if there are many components
+    fig = fig[0] if isinstance(fig, list) else fig
+    writer.submit(FPATH_ICA_FIGURE, write_bytes,
+                  figure_bytes(fig, dpi=100, facecolor='white'))
+    plt.close('all')
 
 # %%
 # remove the identified components
+if low_memory:
+    del raw_filt
+    clean_raw = read_raw_fif(FPATH_CLEAN, preload=True)
+    # large recordings are saved in several files
+    for fname in clean_raw.filenames:
+        os.remove(fname)
 ica.apply(clean_raw)
 
-# create path for preprocessed dara
-FPATH_PREPROCESSED = os.path.join(FPATH_DATA_DERIVATIVES,
-                                  'preprocessing',
-                                  'preprocessed',
-                                  'sub-%s' % str_subj,
-                                  'sub-%s_preprocessed-raw.fif' % str_subj)
-# chekc if directory exists
-if not Path(FPATH_PREPROCESSED).exists():
-    Path(FPATH_PREPROCESSED).parent.mkdir(parents=True, exist_ok=True)
+# create path for preprocessed data (and directory if needed)
+FPATH_PREPROCESSED = get_fname('preprocessed', subj, make_dirs=True)
 
 # save file
-clean_raw.save(FPATH_PREPROCESSED, overwrite=overwrite)
+writer.submit(FPATH_PREPROCESSED,
+              lambda fname, raw: raw.save(fname, overwrite=True),
+              clean_raw, overwrite=overwrite)
+
+# wait for the outputs (raises errors of the writes)
+writer.close()
+logger.info(f"    > Waited {writer.seconds_waited:.1f} s for writes")
+
+# remove memory-mapped data of the chunked filter
+if memory_budget is not None:
+    os.remove(FPATH_FILTERED)
+
+# peak memory of this process (ru_maxrss is in kB on Linux)
+peak_memory_gb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+logger.info(f"Peak memory: {peak_memory_gb:.2f} GB"
+            f"{' (low-memory mode)' if low_memory else ''}")
+
+# %%
+# add quality-control information to the index
+corrmap_scores = {
+    label: ica_template_scores(ica, ica_templates[template]).round(3)
+    for label, template in [('vertical_eog', 'vertical_eye'),
+                            ('horizontal_eog', 'horizontal_eye')]
+}
+update_qc(subj, 'preprocessing',
+          runtime=time.time() - start_time,
+          interpolated_chans=bad_channels['interpolated_chans'],
+          still_noisy=bad_channels['still_noisy'],
+          ica_method=ica_method,
+          ica_n_iter=ica_fit['n_iter'],
+          ica_converged=ica_fit['converged'],
+          ica_fit_seconds=ica_fit['seconds'],
+          ica_n_components=ica.n_components_,
+          ica_excluded=ica.exclude,
+          corrmap_scores=corrmap_scores,
+          peak_memory_gb=peak_memory_gb,
+          low_memory=low_memory,
+          line_noise=line_noise_fit,
+          reference_method=reference_method,
+          prep_seconds=prep_seconds,
+          io_wait_seconds=writer.seconds_waited)
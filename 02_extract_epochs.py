@@ -13,28 +13,52 @@ License: BSD (3-clause)
 # imports
 import sys
 import os
+import time
+import resource
 
-from pathlib import Path
+from collections import Counter
 
 import numpy as np
-import pandas as pd
 
-from mne import events_from_annotations, Epochs
+from mne import events_from_annotations, pick_types, Epochs
 from mne.io import read_raw_fif
 from mne.utils import logger
 
 from config import (
     FPATH_DATA_DERIVATIVES,
     FPATH_DERIVATIVES_NOT_FOUND_MSG,
-    SUBJECT_IDS
+    SUBJECT_IDS,
+    cue_event_id,
+    probe_event_id
 )
 
 from utils import parse_overwrite
 
+from epochs_metadata import build_metadata
+
+from qc_index import update_qc
+
+from layout import get_fname
+
+from event_index import subject_events, write_subject_events
+
+from overlapped_io import BackgroundWriter
+
+from epoch_views import EpochViews
+
+from selective_read import read_epoch_spans
+
+# %%
+# keep track of the runtime
+start_time = time.time()
+
 # %%
 # default settings (use subject 1, don't overwrite output files)
 subj = 1
 overwrite = False
+background_writes = True
+epoch_views = False
+selective_read = False
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -43,12 +67,18 @@ if not hasattr(sys, "ps1"):
     defaults = dict(
         sub=subj,
         overwrite=overwrite,
+        background_writes=background_writes,
+        epoch_views=epoch_views,
+        selective_read=selective_read,
     )
 
     defaults = parse_overwrite(defaults)
 
     subj = defaults["sub"]
     overwrite = defaults["overwrite"]
+    background_writes = defaults["background_writes"]
+    epoch_views = defaults["epoch_views"]
+    selective_read = defaults["selective_read"]
 
 # %%
 # paths and overwrite settings
@@ -66,17 +96,26 @@ if overwrite:
 
 # %%
 # create bids path for import
-str_subj = str(subj).rjust(3, '0')
-raw_fname = os.path.join(FPATH_DATA_DERIVATIVES,
-                         'preprocessing',
-                         'preprocessed',
-                         'sub-%s' % str_subj,
-                         'sub-%s_preprocessed-raw.fif' % str_subj)
-# get the data
-raw = read_raw_fif(raw_fname, preload=True)
-
-# only keep EEG channels
-raw.pick_types(eeg=True)
+raw_fname = get_fname('preprocessed', subj)
+if epoch_views:
+    # memory-mapped data, the epochs are views of it (see ``epoch_views.py``)
+    FPATH_RAW_TMP = get_fname('preprocessed_tmp', subj, make_dirs=True)
+if selective_read:
+    # only the header, the EEG of the cue epochs is read once they are
+    # defined (see ``selective_read.py``)
+    raw = read_raw_fif(raw_fname, preload=False)
+    picks = pick_types(raw.info, eeg=True)
+elif epoch_views:
+    raw = read_raw_fif(raw_fname, preload=FPATH_RAW_TMP)
+    # only keep EEG channels (picking them from the raw data would copy it)
+    picks = pick_types(raw.info, eeg=True)
+else:
+    # get the data
+    raw = read_raw_fif(raw_fname, preload=True)
+
+    # only keep EEG channels
+    raw.pick_types(eeg=True)
+    picks = None
 
 # %%
 events, event_ids = events_from_annotations(raw, regexp=None)
@@ -321,150 +360,37 @@ for event in range(len(new_evs[:, 2])):
     else:
         continue
 
-# %%
-# cue events
-cue_event_id = {'Too_soon A': 118,
-                'Too_soon B': 119,
-
-                'Correct A': 122,
-                'Correct B': 125,
-
-                'Incorrect A': 128,
-                'Incorrect B': 131,
-
-                'Missed A': 134,
-                'Missed B': 137}
-
-# probe events
-probe_event_id = {'Too_soon X': 120,
-                  'Too_soon Y': 121,
-
-                  'Correct AX': 123,
-                  'Correct AY': 124,
-
-                  'Correct BX': 126,
-                  'Correct BY': 127,
-
-                  'Incorrect AX': 129,
-                  'Incorrect AY': 130,
-
-                  'Incorrect BX': 132,
-                  'Incorrect BY': 133,
-
-                  'Missed AX': 135,
-                  'Missed AY': 136,
-
-                  'Missed BX': 138,
-                  'Missed BY': 139}
-
 # %%
 # only keep cue events
-cue_events = new_evs[np.where((new_evs[:, 2] == 118) |
-                              (new_evs[:, 2] == 119) |
-                              (new_evs[:, 2] == 122) |
-                              (new_evs[:, 2] == 125) |
-                              (new_evs[:, 2] == 128) |
-                              (new_evs[:, 2] == 131) |
-                              (new_evs[:, 2] == 134) |
-                              (new_evs[:, 2] == 137))]
+cue_events = new_evs[np.isin(new_evs[:, 2], list(cue_event_id.values()))]
 
 # only keep probe events
-probe_events = new_evs[np.where((new_evs[:, 2] == 120) |
-                                (new_evs[:, 2] == 121) |
-                                (new_evs[:, 2] == 123) |
-                                (new_evs[:, 2] == 124) |
-                                (new_evs[:, 2] == 126) |
-                                (new_evs[:, 2] == 127) |
-                                (new_evs[:, 2] == 129) |
-                                (new_evs[:, 2] == 130) |
-                                (new_evs[:, 2] == 132) |
-                                (new_evs[:, 2] == 133) |
-                                (new_evs[:, 2] == 135) |
-                                (new_evs[:, 2] == 136) |
-                                (new_evs[:, 2] == 138) |
-                                (new_evs[:, 2] == 139))]
+probe_events = new_evs[np.isin(new_evs[:, 2], list(probe_event_id.values()))]
 
 # %%
-
-# reversed event_id dict
-cue_event_id_rev = {val: key for key, val in cue_event_id.items()}
-probe_event_id_rev = {val: key for key, val in probe_event_id.items()}
-
 # check if events shape match
 if cue_events.shape[0] != probe_events.shape[0]:
     cue_events = np.delete(cue_events, broken, 0)
 
-# create list with reactions based on cue and probe event ids
-same_stim, reaction_cues, reaction_probes, cues, probes, reaction = \
-    [], [], [], [], [], []
-
-for cue, probe in zip(cue_events[:, 2], probe_events[:, 2]):
-    response, cue = cue_event_id_rev[cue].split(' ')
-    reaction_cues.append(response)
-    # save cue
-    cues.append(cue)
-
-    # save response
-    response, probe = probe_event_id_rev[probe].split(' ')
-    reaction_probes.append(response)
-
-    if response == 'Correct':
-        reaction.append(probe)
-    elif response == 'Incorrect':
-        if probe == 'AX' and response == 'Incorrect':
-            reaction.append('AY')
-        elif probe in ['BX', 'BY', 'AY'] and response == 'Incorrect':
-            reaction.append('AX')
-    else:
-        reaction.append(np.nan)
-
-    # check if same type of combination was shown in the previous trail
-    if len(probes):
-        stim = same_stim[-1]
-        if probe == probes[-1] \
-                and response == 'Correct' \
-                and reaction_probes[-2] == 'Correct':
-            stim += 1
-            same_stim.append(stim)
-        else:
-            same_stim.append(0)
-    else:
-        stim = 0
-        same_stim.append(0)
-
-    # save probe
-    probes.append(probe)
-
 # create data frame with epochs metadata
-metadata = {'block': np.delete(block, broken, 0),
-            'trial': np.delete(np.arange(0, trial), broken, 0),
-            'cue': cues,
-            'probe': probes,
-            'run': same_stim,
-            'reaction_cues': reaction_cues,
-            'reaction_probes': reaction_probes,
-            'cond_reaction': reaction,
-            'rt': np.delete(rt, broken, 0)}
-metadata = pd.DataFrame(metadata)
+metadata = build_metadata(cue_events[:, 2], probe_events[:, 2],
+                          block=block, rt=rt, broken=broken)
 
 # save RT measures for later analyses
 rt_data = metadata.copy()
 rt_data = rt_data.assign(subject=subj)
 
-# create path for preprocessed dara
-FPATH_RT = os.path.join(FPATH_DATA_DERIVATIVES,
-                            'rt',
-                            'sub-%s' % str_subj,
-                            'sub-%s_rt.tsv' % str_subj)
+# create path (and directory if needed)
+FPATH_RT = get_fname('rt', subj, make_dirs=True)
 
-# check if directory exists
-if not Path(FPATH_RT).exists():
-    Path(FPATH_RT).parent.mkdir(parents=True, exist_ok=True)
+# outputs are written on a background thread while the computation goes on
+# (see ``overlapped_io.py``)
+writer = BackgroundWriter(enabled=background_writes)
 
 # save to disk
-rt_data.to_csv(FPATH_RT,
-               sep='\t',
-               index=False)
+writer.submit(FPATH_RT,
+              lambda fname, data: data.to_csv(fname, sep='\t', index=False),
+              rt_data)
 
 # %%
 # extract the epochs
@@ -487,12 +413,23 @@ cue_epochs = Epochs(raw, cue_events, cue_event_id,
                     tmin=-2.0,
                     tmax=5.0,
                     baseline=None,
-                    preload=True,
+                    picks=picks,
+                    preload=not (epoch_views or selective_read),
                     reject_by_annotation=True,
                     reject=reject,
                     decim=decim
                     )
 
+read_stats = None
+if selective_read:
+    read_stats = read_epoch_spans(
+        cue_epochs, preload=FPATH_RAW_TMP if epoch_views else True)
+    if not epoch_views:
+        cue_epochs.load_data()
+
+# bad epochs are dropped one at a time, the others are not copied
+cue_data = EpochViews(cue_epochs) if epoch_views else cue_epochs
+
 # clean cue epochs
 clean_cues = cue_epochs.selection
 bad_cues = [x for x in set(list(range(0, trial)))
@@ -501,15 +438,49 @@ bad_cues = [x for x in set(list(range(0, trial)))
 # %%
 # save epochs to disk
 
-# create path for preprocessed dara
-FPATH_EPOCHS = os.path.join(FPATH_DATA_DERIVATIVES,
-                        'epochs',
-                        'sub-%s' % str_subj,
-                        'sub-%s_cue-epo.fif' % str_subj)
-
-# check if directory exists
-if not Path(FPATH_EPOCHS).exists():
-    Path(FPATH_EPOCHS).parent.mkdir(parents=True, exist_ok=True)
+# create path (and directory if needed)
+FPATH_EPOCHS = get_fname('epochs', subj, make_dirs=True)
 
 # resample and save cue epochs to disk
-cue_epochs.save(FPATH_EPOCHS, overwrite=overwrite)
+writer.submit(FPATH_EPOCHS,
+              lambda fname, epochs: epochs.save(fname, overwrite=True),
+              cue_data, overwrite=overwrite)
+
+# %%
+# add the trials to the index of the cohort (see ``event_index.py``)
+trial_events = subject_events(subj, cue_events, probe_events, metadata,
+                              selection=cue_epochs.selection,
+                              first_samp=raw.first_samp,
+                              sfreq=raw.info['sfreq'])
+
+# the index refers to the epochs, wait until they are written (raises errors
+# of the writes)
+writer.close()
+logger.info(f"    > Waited {writer.seconds_waited:.1f} s for writes")
+write_subject_events(subj, trial_events)
+
+# remove the memory-mapped data
+if epoch_views:
+    os.remove(FPATH_RAW_TMP)
+
+# peak memory of this process (ru_maxrss is in kB on Linux)
+peak_memory_gb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+logger.info(f"Peak memory: {peak_memory_gb:.2f} GB"
+            f"{' (epoch views)' if epoch_views else ''}")
+
+# %%
+# add quality-control information to the index
+drop_reasons = Counter(reason
+                       for log in cue_epochs.drop_log for reason in log)
+update_qc(subj, 'epochs',
+          runtime=time.time() - start_time,
+          n_trials=trial,
+          n_broken_trials=len(broken),
+          n_epochs=len(cue_events),
+          n_epochs_kept=len(cue_epochs),
+          n_epochs_dropped=len(cue_events) - len(cue_epochs),
+          drop_reasons=dict(drop_reasons),
+          io_wait_seconds=writer.seconds_waited,
+          epochs_peak_memory_gb=peak_memory_gb,
+          epoch_views=epoch_views,
+          selective_read=read_stats)
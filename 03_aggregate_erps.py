@@ -0,0 +1,78 @@
+"""
+=====================
+Aggregate ERPs of DPX
+=====================
+
+Average the cue epochs of each condition (see ``ERP_CONDITIONS`` in
+``config.py``). Epochs are read from disk in chunks, so memory use does not
+depend on the number of epochs. The grand average of the cohort is updated
+with ``python pipeline.py grand-average``.
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+import os
+import time
+
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_DERIVATIVES,
+    FPATH_DERIVATIVES_NOT_FOUND_MSG,
+    SUBJECT_IDS
+)
+
+from utils import parse_overwrite
+
+from erp_aggregation import aggregate_subject
+
+from qc_index import update_qc
+
+# %%
+# keep track of the runtime
+start_time = time.time()
+
+# %%
+# default settings (use subject 1)
+subj = 1
+overwrite = False
+
+# %%
+# When not in an IPython session, get command line inputs
+# https://docs.python.org/3/library/sys.html#sys.ps1
+if not hasattr(sys, "ps1"):
+    defaults = dict(
+        sub=subj,
+        overwrite=overwrite,
+    )
+
+    defaults = parse_overwrite(defaults)
+
+    subj = defaults["sub"]
+    overwrite = defaults["overwrite"]
+
+# %%
+# paths and overwrite settings
+if subj not in SUBJECT_IDS:
+    raise ValueError(f"'{subj}' is not a valid subject ID.\nUse: {SUBJECT_IDS}")
+
+# check if derivatives exists
+if not os.path.exists(FPATH_DATA_DERIVATIVES):
+    raise RuntimeError(
+        FPATH_DERIVATIVES_NOT_FOUND_MSG.format(FPATH_DATA_DERIVATIVES)
+    )
+
+# %%
+# average the epochs of each condition
+stats = aggregate_subject(subj)
+
+for label in stats.labels:
+    logger.info(f"    > {label}: {stats.n[label]} epochs")
+
+# %%
+# add quality-control information to the index
+update_qc(subj, 'erps',
+          runtime=time.time() - start_time,
+          n_erp_epochs={label: stats.n[label] for label in stats.labels})
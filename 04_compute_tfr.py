@@ -0,0 +1,99 @@
+"""
+=================================
+Time-frequency analysis of epochs
+=================================
+
+Compute power of each cue epoch and inter-trial coherence of each condition
+with a bank of Morlet wavelets (see ``TFR_PARAMS`` in ``config.py`` and
+``tfr.py``). Results are written to memory-mapped files, read them with
+``tfr.read_tfr``.
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+import os
+import time
+
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_DERIVATIVES,
+    FPATH_DERIVATIVES_NOT_FOUND_MSG,
+    SUBJECT_IDS,
+    TFR_PARAMS
+)
+
+from utils import parse_overwrite
+
+from tfr import compute_tfr
+
+from qc_index import update_qc
+
+# %%
+# keep track of the runtime
+start_time = time.time()
+
+# %%
+# default settings (use subject 1)
+subj = 1
+overwrite = False
+n_jobs = 1
+memory_budget = TFR_PARAMS['memory_budget']
+decim = TFR_PARAMS['decim']
+freq_decim = TFR_PARAMS['freq_decim']
+
+# %%
+# When not in an IPython session, get command line inputs
+# https://docs.python.org/3/library/sys.html#sys.ps1
+if not hasattr(sys, "ps1"):
+    defaults = dict(
+        sub=subj,
+        overwrite=overwrite,
+        n_jobs=n_jobs,
+        memory_budget=memory_budget,
+        decim=decim,
+        freq_decim=freq_decim,
+    )
+
+    defaults = parse_overwrite(defaults)
+
+    subj = defaults["sub"]
+    overwrite = defaults["overwrite"]
+    n_jobs = defaults["n_jobs"]
+    memory_budget = defaults["memory_budget"]
+    decim = defaults["decim"]
+    freq_decim = defaults["freq_decim"]
+
+# %%
+# paths and overwrite settings
+if subj not in SUBJECT_IDS:
+    raise ValueError(f"'{subj}' is not a valid subject ID.\nUse: {SUBJECT_IDS}")
+
+# check if derivatives exists
+if not os.path.exists(FPATH_DATA_DERIVATIVES):
+    raise RuntimeError(
+        FPATH_DERIVATIVES_NOT_FOUND_MSG.format(FPATH_DATA_DERIVATIVES)
+    )
+
+# %%
+# compute power and ITC
+description = compute_tfr(subj,
+                          freqs=TFR_PARAMS['freqs'],
+                          n_cycles=TFR_PARAMS['n_cycles'],
+                          decim=decim,
+                          freq_decim=freq_decim,
+                          zero_mean=TFR_PARAMS['zero_mean'],
+                          memory_budget=memory_budget,
+                          n_jobs=n_jobs)
+
+logger.info(f"    > Power and ITC of {len(description['freqs'])} "
+            f"frequencies and {len(description['times'])} time points")
+
+# %%
+# add quality-control information to the index
+update_qc(subj, 'tfr',
+          runtime=time.time() - start_time,
+          n_tfr_freqs=len(description['freqs']),
+          n_tfr_times=len(description['times']))
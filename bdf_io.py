@@ -0,0 +1,200 @@
+"""Low-level access to Biosemi .bdf files.
+
+Reads the header and the data records of .bdf files without mne, which makes
+it possible to read files that are still being written by the acquisition
+software (the number of records in the header is -1 until the recording is
+stopped).
+"""
+import os
+import time
+
+import numpy as np
+
+# size of fixed part of the header and of the header of each channel
+_FIXED_HEADER = 256
+_CHANNEL_HEADER = 256
+
+# scaling of physical units to SI units
+_UNITS = {'uV': 1e-6, 'µV': 1e-6, 'mV': 1e-3, 'V': 1.}
+
+
+def read_bdf_header(fname):
+    """Read the header of a .bdf file.
+
+    Returns
+    -------
+    header : dict
+        Information about the recording and the layout of the data records.
+    """
+    with open(fname, 'rb') as fid:
+        fixed = fid.read(_FIXED_HEADER)
+        if fixed[1:8] != b'BIOSEMI':
+            raise ValueError(f"{fname} is not a .bdf file")
+
+        n_channels = int(fixed[252:256])
+        channels = fid.read(_CHANNEL_HEADER * n_channels)
+
+    def field(offset, size):
+        # channel fields are stored one after the other for all channels
+        start = offset * n_channels
+        return [channels[start + ch * size:start + (ch + 1) * size]
+                .decode('latin-1').strip() for ch in range(n_channels)]
+
+    ch_names = field(0, 16)
+    units = field(96, 8)
+    phys_min = np.array(field(104, 8), dtype=float)
+    phys_max = np.array(field(112, 8), dtype=float)
+    dig_min = np.array(field(120, 8), dtype=float)
+    dig_max = np.array(field(128, 8), dtype=float)
+    n_samples = np.array(field(216, 8), dtype=int)
+
+    if len(set(n_samples)) != 1:
+        raise ValueError("Channels with different sampling rates are not "
+                         "supported")
+
+    record_duration = float(fixed[244:252])
+    header_bytes = int(fixed[184:192])
+    gain = (phys_max - phys_min) / (dig_max - dig_min)
+    gain *= np.array([_UNITS.get(unit, 1.) for unit in units])
+    offset = phys_min / (phys_max - phys_min) * (dig_max - dig_min) - dig_min
+
+    return dict(
+        ch_names=ch_names,
+        units=units,
+        n_channels=n_channels,
+        n_records=int(fixed[236:244]),
+        record_duration=record_duration,
+        samples_per_record=int(n_samples[0]),
+        sfreq=n_samples[0] / record_duration,
+        header_bytes=header_bytes,
+        record_bytes=3 * int(n_samples.sum()),
+        gain=gain,
+        offset=offset,
+        phys_max=phys_max * np.array([_UNITS.get(unit, 1.)
+                                      for unit in units]),
+        start_date=fixed[168:176].decode('latin-1'),
+        start_time=fixed[176:184].decode('latin-1'),
+    )
+
+
+def decode_int24(buffer):
+    """Decode little-endian 24-bit integers (as int32)."""
+    raw = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, 3)
+    # shift into the upper bytes of int32 values, then back to get the sign
+    padded = np.zeros((raw.shape[0], 4), dtype=np.uint8)
+    padded[:, 1:] = raw
+    return padded.view('<i4').ravel() >> 8
+
+
+def n_available_records(fname, header):
+    """Number of complete data records currently in a file."""
+    size = os.path.getsize(fname)
+    return max((size - header['header_bytes']) // header['record_bytes'], 0)
+
+
+def read_bdf_records(fid, header, start, stop, calibrate=True):
+    """Read data records ``start`` to ``stop`` from an open .bdf file.
+
+    Parameters
+    ----------
+    fid : file
+        The file, opened in binary mode.
+    header : dict
+        The header, see ``read_bdf_header``.
+    start, stop : int
+        First and last (exclusive) record to read.
+    calibrate : bool
+        Whether to convert to physical values (in SI units). The ``Status``
+        channel is always returned as integer values.
+
+    Returns
+    -------
+    data : ndarray, shape (n_channels, n_samples)
+        The data.
+    """
+    n_records = stop - start
+    n_samples = header['samples_per_record']
+    fid.seek(header['header_bytes'] + start * header['record_bytes'])
+    buffer = fid.read(n_records * header['record_bytes'])
+    n_records = len(buffer) // header['record_bytes']
+    buffer = buffer[:n_records * header['record_bytes']]
+
+    # records contain blocks of samples of one channel after the other
+    data = decode_int24(buffer).reshape(n_records, header['n_channels'],
+                                        n_samples)
+    data = data.transpose(1, 0, 2).reshape(header['n_channels'], -1)
+
+    if not calibrate:
+        return data
+
+    out = (data + header['offset'][:, np.newaxis]) \
+        * header['gain'][:, np.newaxis]
+    if 'Status' in header['ch_names']:
+        status = header['ch_names'].index('Status')
+        # trigger values are stored in the lower 16 bits
+        out[status] = data[status] & 0xFFFF
+
+    return out
+
+
+def iter_bdf_chunks(fname, chunk_records=1, follow=False, poll=0.5,
+                    timeout=30., speed=None, start=0, stop=None):
+    """Iterate over the data of a .bdf file in chunks.
+
+    Parameters
+    ----------
+    fname : str
+        The file.
+    chunk_records : int
+        Number of data records per chunk.
+    follow : bool
+        Whether to keep reading while the file grows (i.e., while it is being
+        recorded), like ``tail -f``.
+    poll : float
+        Seconds between checks for new data when ``follow`` is True.
+    timeout : float
+        Stop following the file if it did not grow for this many seconds.
+    speed : float | None
+        If given, replay the file in real time (``speed=1``) or faster, which
+        is a stand-in for a live data stream.
+    start, stop : int | None
+        First and last (exclusive) record to read (default: all records).
+
+    Yields
+    ------
+    first_samp : int
+        Index of the first sample of the chunk.
+    data : ndarray, shape (n_channels, n_samples)
+        Calibrated data of the chunk.
+    """
+    header = read_bdf_header(fname)
+    chunk_duration = chunk_records * header['record_duration']
+
+    record = start
+    waited = 0.
+    with open(fname, 'rb') as fid:
+        while True:
+            available = n_available_records(fname, header)
+            if header['n_records'] > 0:
+                available = min(available, header['n_records'])
+            if stop is not None:
+                available = min(available, stop)
+            if available - record < chunk_records:
+                # an incomplete chunk at the end of a finished file
+                if not follow or waited >= timeout or available == stop:
+                    if available > record:
+                        yield (record * header['samples_per_record'],
+                               read_bdf_records(fid, header, record,
+                                                available))
+                    return
+                time.sleep(poll)
+                waited += poll
+                continue
+
+            waited = 0.
+            end = record + chunk_records
+            yield (record * header['samples_per_record'],
+                   read_bdf_records(fid, header, record, end))
+            record = end
+            if speed is not None:
+                time.sleep(chunk_duration / speed)
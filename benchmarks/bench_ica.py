@@ -0,0 +1,193 @@
+"""
+=========================
+Speed and quality of ICA
+=========================
+
+Fits the ICA solvers of ``ICA_METHODS`` (see ``config.py``) to the same data
+and compares fit time, convergence and how well the components match the eye
+movement templates (``ica_templates.json``)::
+
+    python benchmarks/bench_ica.py --root /tmp/uva_bench --subjects 1-2
+
+With ``--root``, synthetic recordings are written and converted to BIDS
+first (see ``synthetic.py``). Without it, the subjects of the dataset in
+``paths.json`` (or ``UVA_PATHS``) are used.
+
+The data are prepared like the input of ICA in ``01_run_preprocessing.py``,
+but without PREP (which takes most of the runtime): task blocks, 0.1-40 Hz
+band-pass, bad channels of ``bad_channels.json`` (if available)
+interpolated, average reference, line noise removed and 1 Hz high-pass.
+
+For each template, ``max_corr`` is the highest absolute correlation of a
+component with the template, ``corrmap`` whether ``corrmap`` (as used in the
+preprocessing) found a component and ``agreement`` the absolute correlation
+of that component with the one found with the first solver. With
+``--reuse_whitening True``, all solvers are fitted on the PCA whitening of
+the first one.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import json
+
+import click
+import numpy as np
+import pandas as pd
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects  # noqa: E402
+
+
+def prepare_data(subj):
+    """Continuous data of a subject as ICA sees it (without PREP)."""
+    from mne import concatenate_raws, events_from_annotations
+    from mne_bids import read_raw_bids
+
+    from config import task_events
+    from layout import get_bids_path, get_fname, get_layout
+    from utils import find_task_blocks
+
+    raw = read_raw_bids(get_bids_path(subj, extension='.bdf'),
+                        verbose=False)
+    raw.load_data()
+    events, _ = events_from_annotations(raw, event_id=task_events,
+                                        verbose=False)
+    cues = events[(events[:, 2] >= 1) & (events[:, 2] <= 7)]
+    _, blocks = find_task_blocks(cues[:, 0] / raw.info['sfreq'], subj)
+    raw = concatenate_raws([raw.copy().crop(tmin=start, tmax=stop)
+                            for start, stop in blocks])
+    raw.pick(['eeg'])
+    raw.filter(l_freq=0.1, h_freq=40., verbose=False)
+
+    if get_layout().exists('bad_channels', subj):
+        with open(get_fname('bad_channels', subj)) as bads:
+            bads = json.load(bads)
+        raw.info['bads'] = sorted(set(bads['interpolated_chans'])
+                                  | set(bads['still_noisy']))
+        raw.interpolate_bads(verbose=False)
+    raw.set_eeg_reference('average', verbose=False)
+    raw.notch_filter([50., 100.], verbose=False)
+    return raw.filter(l_freq=1.0, h_freq=None, verbose=False)
+
+
+def find_component(ica, template):
+    """Component ``corrmap`` finds for a template (None if not found)."""
+    import matplotlib.pyplot as plt
+
+    from mne.preprocessing import corrmap
+
+    ica.labels_ = dict()
+    try:
+        corrmap([ica], template=np.array(template), threshold='auto',
+                label='eye', plot=False, show=False, verbose=False)
+    except Exception:
+        return None
+    finally:
+        plt.close('all')
+    labels = ica.labels_.get('eye', [])
+    return labels[0] if len(labels) else None
+
+
+def compare(subj, methods, max_iter, tol, reuse_whitening, random_state):
+    """Fit the solvers to the data of a subject and compare them."""
+    from config import ica_templates
+    from ica_methods import fit_ica, make_ica
+    from utils import ica_template_scores
+
+    raw = prepare_data(subj)
+    reject = dict(eeg=250e-6)
+
+    results, reference = [], None
+    for method in methods:
+        result = dict(subject=subj, method=method)
+        ica = make_ica(method, max_iter=max_iter, tol=tol,
+                       random_state=random_state)
+        whitening = reference['ica'] if reuse_whitening and reference \
+            else None
+        try:
+            ica, fit_info = fit_ica(ica, raw, reject=reject,
+                                    whitening=whitening)
+        except ImportError:
+            result['error'] = 'not installed'
+            results.append(result)
+            continue
+        result.update(seconds=round(fit_info['seconds'], 2),
+                      n_iter=fit_info['n_iter'],
+                      converged=fit_info['converged'],
+                      n_components=ica.n_components_)
+
+        maps = ica.get_components()
+        components = {}
+        for name in ('vertical_eye', 'horizontal_eye'):
+            template = ica_templates[name]
+            scores = ica_template_scores(ica, template)
+            component = find_component(ica, template)
+            components[name] = None if component is None \
+                else maps[:, component]
+            result[f'{name}_max_corr'] = round(float(scores.max()), 3)
+            result[f'{name}_corrmap'] = component is not None
+            if reference is not None and component is not None \
+                    and reference['maps'][name] is not None:
+                agreement = np.corrcoef(components[name],
+                                        reference['maps'][name])[0, 1]
+                result[f'{name}_agreement'] = round(abs(agreement), 3)
+        results.append(result)
+
+        if reference is None:
+            reference = dict(ica=ica, maps=components)
+
+    return results
+
+
+@click.command()
+@click.option("--root", default=None, type=str,
+              help="Directory of a synthetic dataset (default: real data)")
+@click.option("--subjects", default='1', type=str,
+              help="Subjects, e.g., '1-3'")
+@click.option("--methods", default='infomax,picard,fastica', type=str,
+              help="Comma separated solvers, the first one is the reference")
+@click.option("--max_iter", default='auto', type=str,
+              help="Maximum number of iterations")
+@click.option("--tol", default=None, type=float,
+              help="Stopping tolerance (default of each solver)")
+@click.option("--reuse_whitening", default=False, type=bool,
+              help="Fit all solvers on the whitening of the first one?")
+@click.option("--n_trials", default=120, type=int,
+              help="Trials per task block of synthetic recordings")
+@click.option("--random_state", default=42, type=int, help="Seed")
+@click.option("--output", default=None, type=str,
+              help="Write the results to this .tsv file")
+def main(root, subjects, methods, max_iter, tol, reuse_whitening, n_trials,
+         random_state, output):
+    """Compare ICA solvers."""
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    if root is not None:
+        from bench_utils import run_script
+        from synthetic import make_dataset
+
+        paths = make_dataset(root, subjects, n_trials=n_trials)
+        os.environ['UVA_PATHS'] = paths
+        for subj in subjects:
+            if run_script('00_data_to_bids.py', '--subj', subj,
+                          '--overwrite', True, paths=paths)['returncode']:
+                sys.exit(1)
+
+    max_iter = max_iter if max_iter == 'auto' else int(max_iter)
+    methods = [method.strip() for method in methods.split(',')]
+    results = []
+    for subj in subjects:
+        results.extend(compare(subj, methods, max_iter, tol,
+                               reuse_whitening, random_state))
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if output is not None:
+        results.to_csv(output, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+========================================
+Speed and residual of line-noise removal
+========================================
+
+Removes line noise with each method of ``LINE_NOISE_METHODS`` (see
+``config.py``) from the same data and compares runtime, residual line noise
+and distortion of the rest of the spectrum::
+
+    python benchmarks/bench_line_noise.py --root /tmp/uva_bench --subjects 1-2
+
+With ``--root``, synthetic recordings are written and converted to BIDS
+first (see ``synthetic.py``). Without it, the subjects of the dataset in
+``paths.json`` (or ``UVA_PATHS``) are used.
+
+The data are the task blocks of the EEG and EOG channels, band-pass filtered
+like in ``01_run_preprocessing.py`` (use ``--h_freq 0`` to see the line noise
+without the low-pass filter). ``'prep'`` is PREP's line-noise removal of the
+EEG (trend removal and multitaper regression at all harmonics) followed by
+the notch filter at 50 and 100 Hz of ``01_run_preprocessing.py``.
+
+For each harmonic, ``line_<freq>_db`` is the power at the harmonic (+-0.5 Hz)
+relative to the neighbouring frequencies (1-3 Hz away), averaged over
+channels (0 dB: no line noise left). ``broadband_change_db`` is the mean
+absolute change of the power at 1-45 Hz (away from the harmonics), i.e., how
+much of the rest of the signal the method changed.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects  # noqa: E402
+
+
+def prepare_data(subj, h_freq):
+    """Task blocks of a subject, band-pass filtered like in the pipeline."""
+    from mne import concatenate_raws, events_from_annotations
+    from mne_bids import read_raw_bids
+
+    from config import task_events
+    from layout import get_bids_path
+    from utils import find_task_blocks
+
+    raw = read_raw_bids(get_bids_path(subj, extension='.bdf'),
+                        verbose=False)
+    raw.load_data()
+    events, _ = events_from_annotations(raw, event_id=task_events,
+                                        verbose=False)
+    cues = events[(events[:, 2] >= 1) & (events[:, 2] <= 7)]
+    _, blocks = find_task_blocks(cues[:, 0] / raw.info['sfreq'], subj)
+    raw = concatenate_raws([raw.copy().crop(tmin=start, tmax=stop)
+                            for start, stop in blocks])
+    raw.pick(['eeg', 'eog'])
+    return raw.filter(l_freq=0.1, h_freq=h_freq or None, verbose=False)
+
+
+def prep_line_noise(raw, n_jobs=1):
+    """PREP's line-noise removal and the notch filter of the pipeline."""
+    from mne.filter import notch_filter
+    from pyprep.removeTrend import removeTrend
+
+    sfreq = raw.info['sfreq']
+
+    def clean(data):
+        trend_free = removeTrend(data, sfreq)
+        return data - trend_free + notch_filter(
+            trend_free, Fs=sfreq, freqs=np.arange(50, sfreq / 2, 50),
+            method='spectrum_fit', mt_bandwidth=2, p_value=0.01,
+            filter_length='10s', verbose=False)
+
+    raw.apply_function(clean, picks='eeg', channel_wise=False)
+    raw.notch_filter(freqs=[50., 100.], n_jobs=n_jobs, verbose=False)
+    return dict(method='prep')
+
+
+def spectra(raw):
+    """Power spectra of all channels."""
+    from scipy.signal import welch
+
+    sfreq = raw.info['sfreq']
+    return welch(raw.get_data(), sfreq, nperseg=int(4 * sfreq))
+
+
+def line_noise_db(freqs, power, line_freq=50.):
+    """Power at each harmonic relative to the neighbouring frequencies."""
+    levels = {}
+    for freq in np.arange(line_freq, freqs[-1], line_freq):
+        distance = np.abs(freqs - freq)
+        peak = power[:, distance <= 0.5].mean(axis=-1)
+        sides = power[:, (distance >= 1.) & (distance <= 3.)].mean(axis=-1)
+        levels[f'line_{freq:.0f}_db'] = round(
+            float(np.mean(10 * np.log10(peak / sides))), 2)
+    return levels
+
+
+def compare(subj, methods, h_freq, n_jobs):
+    """Remove line noise from the data of a subject with each method."""
+    from line_noise import remove_line_noise
+
+    raw = prepare_data(subj, h_freq)
+    freqs, power = spectra(raw)
+    # 1-45 Hz, away from the harmonics
+    broadband = (freqs >= 1.) & (freqs <= 45.) \
+        & (np.abs((freqs + 25.) % 50. - 25.) > 2.)
+
+    results = [dict(subject=subj, method='none', seconds=0.,
+                    **line_noise_db(freqs, power))]
+    for method in methods:
+        cleaned = raw.copy()
+        start = time.time()
+        if method == 'prep':
+            fit = prep_line_noise(cleaned, n_jobs=n_jobs)
+        else:
+            fit = remove_line_noise(cleaned, method=method, n_jobs=n_jobs)
+        seconds = time.time() - start
+        _, cleaned_power = spectra(cleaned)
+        change = np.abs(10 * np.log10(cleaned_power[:, broadband]
+                                      / power[:, broadband]))
+        results.append(dict(subject=subj, method=method,
+                            seconds=round(seconds, 2),
+                            **line_noise_db(freqs, cleaned_power),
+                            broadband_change_db=round(float(change.mean()),
+                                                      3),
+                            n_removed=fit.get('n_removed')))
+    return results
+
+
+@click.command()
+@click.option("--root", default=None, type=str,
+              help="Directory of a synthetic dataset (default: real data)")
+@click.option("--subjects", default='1', type=str,
+              help="Subjects, e.g., '1-3'")
+@click.option("--methods", default='prep,zapline,spectrum_interpolation',
+              type=str, help="Comma separated methods")
+@click.option("--h_freq", default=40., type=float,
+              help="Low-pass frequency of the band-pass filter (0: none)")
+@click.option("--n_jobs", default=1, type=int, help="Number of jobs")
+@click.option("--n_trials", default=120, type=int,
+              help="Trials per task block of synthetic recordings")
+@click.option("--output", default=None, type=str,
+              help="Write the results to this .tsv file")
+def main(root, subjects, methods, h_freq, n_jobs, n_trials, output):
+    """Compare line-noise removal methods."""
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    if root is not None:
+        from bench_utils import run_script
+        from synthetic import make_dataset
+
+        paths = make_dataset(root, subjects, n_trials=n_trials)
+        os.environ['UVA_PATHS'] = paths
+        for subj in subjects:
+            if run_script('00_data_to_bids.py', '--subj', subj,
+                          '--overwrite', True, paths=paths)['returncode']:
+                sys.exit(1)
+
+    methods = [method.strip() for method in methods.split(',')]
+    results = []
+    for subj in subjects:
+        results.extend(compare(subj, methods, h_freq, n_jobs))
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if output is not None:
+        results.to_csv(output, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    main()
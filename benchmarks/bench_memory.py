@@ -0,0 +1,82 @@
+"""
+=================================
+Memory use of the preprocessing
+=================================
+
+Runs ``01_run_preprocessing.py`` on synthetic recordings (see
+``synthetic.py``) with and without ``--low_memory`` and compares runtime,
+peak memory (RSS) and the preprocessed data::
+
+    python benchmarks/bench_memory.py --root /tmp/uva_bench --n_trials 200
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+
+import click
+import numpy as np
+import pandas as pd
+
+from bench_utils import run_script
+from synthetic import make_dataset
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects  # noqa: E402
+
+
+@click.command()
+@click.option("--root", required=True, type=str,
+              help="Directory of the synthetic dataset")
+@click.option("--subjects", default='1', type=str,
+              help="Subjects to process, e.g., '1-3'")
+@click.option("--n_trials", default=40, type=int,
+              help="Number of trials per task block")
+@click.option("--n_jobs", default=1, type=int, help="Value of n_jobs")
+def main(root, subjects, n_trials, n_jobs):
+    """Compare the default and the low-memory mode of preprocessing."""
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    paths = make_dataset(root, subjects, n_trials=n_trials)
+    os.environ['UVA_PATHS'] = paths
+
+    from mne.io import read_raw_fif
+    from layout import get_fname
+
+    results = []
+    for subj in subjects:
+        if run_script('00_data_to_bids.py', '--subj', subj,
+                      '--overwrite', True, paths=paths)['returncode']:
+            sys.exit(1)
+
+        reference = None
+        for low_memory in (False, True):
+            result = run_script('01_run_preprocessing.py', '--subj', subj,
+                                '--overwrite', True, '--n_jobs', n_jobs,
+                                '--low_memory', low_memory, paths=paths,
+                                n_threads=n_jobs)
+            if result['returncode']:
+                sys.exit(1)
+
+            raw = read_raw_fif(get_fname('preprocessed', subj),
+                               verbose=False)
+            if reference is None:
+                # PREP does not keep the order of the non-EEG channels
+                ch_names = raw.ch_names
+                reference = raw.get_data()
+            data = raw.get_data(picks=ch_names)
+            results.append(dict(
+                subject=subj,
+                low_memory=low_memory,
+                seconds=result['seconds'],
+                peak_memory_gb=result['peak_memory_gb'],
+                max_abs_diff=np.abs(data - reference).max(),
+            ))
+
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+==============================================
+Speed and equivalence of the robust reference
+==============================================
+
+Runs the robust referencing of PREP with PyPREP (``prep.robust_reference``)
+and with the vectorized implementation of ``robust_reference.py`` on the
+same data and compares runtime, bad channels and the re-referenced data::
+
+    python benchmarks/bench_reference.py --root /tmp/uva_bench --subjects 1-2
+
+With ``--root``, synthetic recordings are written and converted to BIDS
+first (see ``synthetic.py``). Without it, the subjects of the dataset in
+``paths.json`` (or ``UVA_PATHS``) are used.
+
+The data are the task blocks of the EEG and EOG channels, band-pass filtered
+like in ``01_run_preprocessing.py``. Use ``--bads`` to start with bad
+channels (like those of the precheck) and ``--line_noise True`` to run
+PREP's line-noise removal first.
+
+For each subject, ``same_<attribute>`` tells whether the bad channels of each
+step (of each type: NaN, flat, deviation, ...) are the same, and
+``max_abs_diff`` is the largest difference between the re-referenced data
+(in V). The script exits with an error if any of them differ.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects  # noqa: E402
+
+BAD_CHANNELS = ('noisy_channels_original',
+                'noisy_channels_before_interpolation',
+                'noisy_channels_after_interpolation',
+                'interpolated_channels', 'still_noisy_channels')
+
+
+def run_reference(raw, method, line_noise):
+    """Robust referencing of PREP, returns the pipeline and its runtime."""
+    from pyprep.prep_pipeline import PrepPipeline
+
+    from robust_reference import robust_reference
+
+    line_freqs = np.arange(50, raw.info['sfreq'] / 2, 50) if line_noise \
+        else []
+    prep = PrepPipeline(raw.copy(), dict(ref_chs='eeg', reref_chs='eeg',
+                                         line_freqs=line_freqs),
+                        raw.get_montage(), ransac=False)
+    if len(line_freqs):
+        prep.remove_line_noise(line_freqs)
+    else:
+        prep._line_noise_removed = True
+
+    start = time.time()
+    if method == 'pyprep':
+        prep.robust_reference(prep.prep_params['max_iterations'])
+    else:
+        robust_reference(prep)
+    return prep, time.time() - start
+
+
+def same_channels(first, second):
+    """Whether two lists (or dicts of lists) contain the same channels."""
+    if isinstance(first, dict):
+        return all(same_channels(first[key], second[key]) for key in first)
+    return set(first) == set(second)
+
+
+def compare(subj, bads, line_noise):
+    """Robust referencing of the data of a subject with both methods."""
+    from bench_line_noise import prepare_data
+
+    raw = prepare_data(subj, 40.)
+    raw.info['bads'] = bads
+    pyprep, pyprep_seconds = run_reference(raw, 'pyprep', line_noise)
+    vectorized, seconds = run_reference(raw, 'vectorized', line_noise)
+
+    result = dict(subject=subj, pyprep_seconds=round(pyprep_seconds, 2),
+                  vectorized_seconds=round(seconds, 2),
+                  speedup=round(pyprep_seconds / seconds, 1))
+    for attribute in BAD_CHANNELS:
+        result[f'same_{attribute}'] = same_channels(
+            getattr(pyprep, attribute), getattr(vectorized, attribute))
+    result['max_abs_diff'] = float(np.abs(
+        pyprep.raw_eeg.get_data() - vectorized.raw_eeg.get_data()).max())
+    result['interpolated'] = ','.join(sorted(pyprep.interpolated_channels))
+    return result
+
+
+@click.command()
+@click.option("--root", default=None, type=str,
+              help="Directory of a synthetic dataset (default: real data)")
+@click.option("--subjects", default='1', type=str,
+              help="Subjects, e.g., '1-3'")
+@click.option("--bads", default='', type=str,
+              help="Comma separated channels that are bad from the start")
+@click.option("--line_noise", default=False, type=bool,
+              help="Remove line noise with PREP first?")
+@click.option("--atol", default=1e-12, type=float,
+              help="Largest difference of the data that is accepted (V)")
+@click.option("--n_trials", default=120, type=int,
+              help="Trials per task block of synthetic recordings")
+@click.option("--output", default=None, type=str,
+              help="Write the results to this .tsv file")
+def main(root, subjects, bads, line_noise, atol, n_trials, output):
+    """Compare PyPREP's robust reference with the vectorized one."""
+    import mne
+
+    mne.set_log_level('WARNING')
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    if root is not None:
+        from bench_utils import run_script
+        from synthetic import make_dataset
+
+        paths = make_dataset(root, subjects, n_trials=n_trials)
+        os.environ['UVA_PATHS'] = paths
+        for subj in subjects:
+            if run_script('00_data_to_bids.py', '--subj', subj,
+                          '--overwrite', True, paths=paths)['returncode']:
+                sys.exit(1)
+
+    bads = [name.strip() for name in bads.split(',') if name.strip()]
+    results = pd.DataFrame([compare(subj, bads, line_noise)
+                            for subj in subjects])
+    print(results.to_string(index=False))
+    if output is not None:
+        results.to_csv(output, sep='\t', index=False)
+
+    same = results[[f'same_{attribute}' for attribute in BAD_CHANNELS]]
+    if not same.all(axis=None) or (results['max_abs_diff'] > atol).any():
+        print('Results of the two methods differ.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
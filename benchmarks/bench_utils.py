@@ -0,0 +1,52 @@
+"""Helpers shared by the benchmark scripts."""
+import os
+import sys
+import time
+import subprocess
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_script(script, *args, paths=None, n_threads=1):
+    """Run a pipeline script in a separate process.
+
+    Parameters
+    ----------
+    script : str
+        Name of the script, e.g., ``'01_run_preprocessing.py'``.
+    *args
+        Command line arguments of the script.
+    paths : str | None
+        ``paths.json`` of the dataset (see ``synthetic.py``).
+    n_threads : int
+        Limit of the BLAS/OpenMP thread pools.
+
+    Returns
+    -------
+    result : dict
+        Exit code, wall-clock time (in seconds) and peak memory (in GB) of
+        the process.
+    """
+    env = os.environ.copy()
+    if paths is not None:
+        env['UVA_PATHS'] = paths
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        env[var] = str(n_threads)
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(parent, script),
+                                *[str(arg) for arg in args]],
+                               cwd=parent, env=env,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+    stderr = process.stderr.read()
+    # ru_maxrss is in kB
+    _, status, usage = os.wait4(process.pid, 0)
+    returncode = process.returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        sys.stderr.write(stderr)
+
+    return dict(returncode=returncode,
+                seconds=time.time() - start,
+                peak_memory_gb=usage.ru_maxrss / 1024 ** 2)
@@ -0,0 +1,190 @@
+"""
+==================================
+Equivalence of the epochs metadata
+==================================
+
+Compares ``build_metadata`` (``epochs_metadata.py``) with the loop that
+``02_extract_epochs.py`` used before to build the metadata of the cue
+epochs, on randomized sequences of DPX trials::
+
+    python benchmarks/check_metadata.py --n_sequences 200
+
+The sequences have two blocks, all kinds of responses (correct, incorrect,
+too soon, missed), broken trials (without probe) and streaks of correct
+trials with the same probe that cross the boundary between the blocks. The
+data frames must be equal (values and dtypes,
+``pandas.testing.assert_frame_equal``), otherwise the script exits with an
+error.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from config import cue_event_id, probe_event_id  # noqa: E402
+from epochs_metadata import build_metadata  # noqa: E402
+
+RESPONSES = ('Correct', 'Incorrect', 'Too_soon', 'Missed')
+
+
+def build_metadata_loop(cue_codes, probe_codes, block, rt, broken=()):
+    """Reference: the per-trial loop of ``02_extract_epochs.py``."""
+    # reversed event_id dict
+    cue_event_id_rev = {val: key for key, val in cue_event_id.items()}
+    probe_event_id_rev = {val: key for key, val in probe_event_id.items()}
+
+    # create list with reactions based on cue and probe event ids
+    same_stim, reaction_cues, reaction_probes, cues, probes, reaction = \
+        [], [], [], [], [], []
+
+    for cue, probe in zip(cue_codes, probe_codes):
+        response, cue = cue_event_id_rev[cue].split(' ')
+        reaction_cues.append(response)
+        # save cue
+        cues.append(cue)
+
+        # save response
+        response, probe = probe_event_id_rev[probe].split(' ')
+        reaction_probes.append(response)
+
+        if response == 'Correct':
+            reaction.append(probe)
+        elif response == 'Incorrect':
+            if probe == 'AX' and response == 'Incorrect':
+                reaction.append('AY')
+            elif probe in ['BX', 'BY', 'AY'] and response == 'Incorrect':
+                reaction.append('AX')
+        else:
+            reaction.append(np.nan)
+
+        # check if same type of combination was shown in the previous trail
+        if len(probes):
+            stim = same_stim[-1]
+            if probe == probes[-1] \
+                    and response == 'Correct' \
+                    and reaction_probes[-2] == 'Correct':
+                stim += 1
+                same_stim.append(stim)
+            else:
+                same_stim.append(0)
+        else:
+            stim = 0
+            same_stim.append(0)
+
+        # save probe
+        probes.append(probe)
+
+    # create data frame with epochs metadata
+    metadata = {'block': np.delete(block, broken, 0),
+                'trial': np.delete(np.arange(0, len(rt)), broken, 0),
+                'cue': cues,
+                'probe': probes,
+                'run': same_stim,
+                'reaction_cues': reaction_cues,
+                'reaction_probes': reaction_probes,
+                'cond_reaction': reaction,
+                'rt': np.delete(rt, broken, 0)}
+    return pd.DataFrame(metadata)
+
+
+def random_trials(rng, n_trials):
+    """Random sequence of DPX trials, like the input of the metadata.
+
+    Returns
+    -------
+    cue_codes, probe_codes, block, rt, broken
+        See ``build_metadata``.
+    """
+    # probes repeat often and most responses are correct, so that there are
+    # long streaks
+    probes = ['AX']
+    for _ in range(n_trials - 1):
+        probes.append(probes[-1] if rng.random() < 0.5 else
+                      rng.choice(['AX', 'AY', 'BX', 'BY']))
+    responses = rng.choice(RESPONSES, n_trials, p=[0.7, 0.1, 0.1, 0.1])
+
+    # the second block starts within a streak
+    start = int(rng.integers(n_trials // 4, 3 * n_trials // 4))
+    length = int(rng.integers(2, 8))
+    probes[start - length:start + length] = \
+        [probes[start]] * len(probes[start - length:start + length])
+    responses[start - length:start + length] = 'Correct'
+    block = np.where(np.arange(n_trials) < start, 1, 2)
+
+    rt = np.where(np.isin(responses, ['Correct', 'Incorrect']),
+                  rng.uniform(150., 900., n_trials), np.nan)
+    rt[responses == 'Too_soon'] = rng.uniform(-200., 0.,
+                                              (responses == 'Too_soon').sum())
+    broken = np.sort(rng.choice(n_trials, int(rng.integers(0, 5)),
+                                replace=False)).tolist()
+
+    cue_codes = [cue_event_id[f'{response} {probe[0]}']
+                 for response, probe in zip(responses, probes)]
+    # probes of trials answered too soon are only labeled X or Y
+    probe_codes = [probe_event_id[f'{response} {probe[1]}'
+                                  if response == 'Too_soon' else
+                                  f'{response} {probe}']
+                   for response, probe in zip(responses, probes)]
+    # broken trials have no probe and their cue is removed
+    keep = np.setdiff1d(np.arange(n_trials), broken)
+    return (np.array(cue_codes)[keep], np.array(probe_codes)[keep], block,
+            rt, broken)
+
+
+@click.command()
+@click.option("--n_sequences", default=200, type=int,
+              help="Number of random trial sequences")
+@click.option("--min_trials", default=20, type=int,
+              help="Smallest number of trials of a sequence")
+@click.option("--max_trials", default=400, type=int,
+              help="Largest number of trials of a sequence")
+@click.option("--seed", default=42, type=int,
+              help="Seed of the random sequences")
+def main(n_sequences, min_trials, max_trials, seed):
+    """Compare build_metadata with the per-trial loop."""
+    rng = np.random.default_rng(seed)
+    seconds = dict(loop=0., vectorized=0.)
+    n_failed = n_broken = n_crossing = 0
+    for sequence in range(n_sequences):
+        cue_codes, probe_codes, block, rt, broken = random_trials(
+            rng, int(rng.integers(min_trials, max_trials + 1)))
+
+        start = time.perf_counter()
+        expected = build_metadata_loop(cue_codes, probe_codes, block, rt,
+                                       broken)
+        seconds['loop'] += time.perf_counter() - start
+        start = time.perf_counter()
+        metadata = build_metadata(cue_codes, probe_codes, block, rt, broken)
+        seconds['vectorized'] += time.perf_counter() - start
+
+        try:
+            pd.testing.assert_frame_equal(metadata, expected)
+        except AssertionError as err:
+            print(f'Sequence {sequence} differs:\n{err}')
+            n_failed += 1
+        n_broken += len(broken) > 0
+        second = expected['block'].to_numpy() == 2
+        n_crossing += (expected['run'][second].iloc[0] > 0
+                       if second.any() else False)
+
+    print(f'{n_sequences} sequences, {n_broken} with broken trials, '
+          f'{n_crossing} with a streak across the blocks')
+    print(f"loop: {seconds['loop']:.2f} s, "
+          f"vectorized: {seconds['vectorized']:.2f} s")
+    if n_failed:
+        print(f'{n_failed} sequences differ.')
+        sys.exit(1)
+    print('All metadata are equal.')
+
+
+if __name__ == '__main__':
+    main()
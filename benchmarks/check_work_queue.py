@@ -0,0 +1,395 @@
+"""
+========================================
+Work queue with several worker processes
+========================================
+
+Runs workers of ``work_queue.py`` in separate processes on a local queue
+directory and checks that::
+
+    python benchmarks/check_work_queue.py --n_workers 8 --n_subjects 20
+
+- ``race``: workers that claim tasks at the same time run each task exactly
+  once, and the stages of each subject in order
+- ``reclaimed``: a worker that stalls (no heartbeat) for longer than
+  ``stale_after`` loses its claim. Another worker breaks the stale lock and
+  runs the task again. When the stalled worker finishes, it neither marks
+  the task as done nor removes the lock of the new owner
+- ``finished``: the same, but the other worker already finished the task
+  (and removed its lock) when the stalled worker finishes
+- ``heartbeat``: a worker finds a lock stale, but its owner sends a
+  heartbeat before the lock is broken. The lock is kept
+- ``contended``: several workers try to break the same stale lock at the
+  same time (repeated ``--n_rounds`` times). Exactly one of them breaks it
+  and claims the task
+- ``stopped``: the heartbeats of a worker are too slow and its lock is
+  broken while the task is running. The worker stops the task (``run`` is
+  cancelled) and discards its result
+
+The script exits with an error if any of the checks fails.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import multiprocessing
+
+from functools import partial
+from queue import Empty
+
+import click
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from work_queue import Task, WorkQueue, work  # noqa: E402
+
+STAGES = ('first', 'second')
+
+
+def _log_run(log, stage, subj, cancel=None):
+    """Record a run of a task (lines of appended files do not interleave)."""
+    time.sleep(random.uniform(0., 0.05))
+    with open(log, 'a') as runs:
+        runs.write(f'{stage} {subj} {time.time()!r}\n')
+    return 0
+
+
+def _race_worker(root, subjects, log):
+    queue = WorkQueue(root, STAGES, subjects)
+    work(queue, partial(_log_run, log), poll=0.05, heartbeat=1.)
+
+
+def check_race(root, n_workers, n_subjects):
+    """Workers claim the tasks of several stages at the same time."""
+    subjects = list(range(1, n_subjects + 1))
+    log = os.path.join(root, 'runs.txt')
+    workers = [multiprocessing.Process(target=_race_worker,
+                                       args=(root, subjects, log))
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with open(log) as runs:
+        runs = [line.split() for line in runs]
+    finished = {(stage, int(subj)): float(when) for stage, subj, when in runs}
+    summary = WorkQueue(root, STAGES, subjects).summary()
+    return dict(
+        exit_codes=all(worker.exitcode == 0 for worker in workers),
+        each_task_once=(len(runs) == len(finished)
+                        == len(STAGES) * n_subjects),
+        stages_in_order=all(finished[STAGES[0], subj]
+                            < finished[STAGES[1], subj]
+                            for subj in subjects),
+        all_done=summary == {'done': len(STAGES) * n_subjects})
+
+
+def _lock_owner(queue, task):
+    try:
+        with open(queue._fname(task, 'lock')) as lock:
+            return json.load(lock)['worker']
+    except FileNotFoundError:
+        return None
+
+
+def _stalled_worker(root, stale_after, stall, claimed, results):
+    """Claims the task, then stops sending heartbeats for a while."""
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    task = queue.claim()
+    claimed.set()
+    time.sleep(stall)
+    completed = queue.complete(task, success=True)
+    results.put(dict(role='stalled', worker=queue.worker_id,
+                     completed=completed,
+                     lock_owner=_lock_owner(queue, task),
+                     done=queue._fname(task, 'done').exists()))
+    queue.close()
+
+
+def _second_worker(root, stale_after, duration, claimed, results):
+    """Breaks the stale lock and runs the task again."""
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    claimed.wait()
+    task = None
+    while task is None:
+        time.sleep(0.05)
+        task = queue.claim()
+    with queue.heartbeat(task, interval=0.1):
+        time.sleep(duration)
+    completed = queue.complete(task, success=True)
+    results.put(dict(role='second', worker=queue.worker_id,
+                     completed=completed))
+    queue.close()
+
+
+def check_stale(root, stale_after, stall, duration):
+    """A stalled worker finishes after its lock was broken."""
+    claimed, results = multiprocessing.Event(), multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=target, args=args)
+               for target, args in
+               ((_stalled_worker, (root, stale_after, stall, claimed,
+                                   results)),
+                (_second_worker, (root, stale_after, duration, claimed,
+                                  results)))]
+    for worker in workers:
+        worker.start()
+    # a worker that crashed does not report
+    reports = dict(stalled=dict(completed=None, lock_owner=None, done=None),
+                   second=dict(completed=None, worker=None))
+    for _ in workers:
+        try:
+            report = results.get(timeout=stall + duration + 30.)
+        except Empty:
+            break
+        reports[report['role']] = report
+    for worker in workers:
+        worker.join()
+
+    stalled, second = reports['stalled'], reports['second']
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    task = Task(STAGES[0], 1)
+    try:
+        with open(queue._fname(task, 'done')) as done:
+            done = json.load(done)
+    except FileNotFoundError:
+        done = dict(worker=None)
+    checks = dict(
+        exit_codes=all(worker.exitcode == 0 for worker in workers),
+        stalled_not_completed=stalled['completed'] is False,
+        second_completed=second['completed'] is True,
+        done_by_second=(done['worker'] is not None
+                        and done['worker'] == second['worker']),
+        one_failed_attempt=queue.attempts(task) == 1,
+        no_lock_left=not queue._fname(task, 'lock').exists())
+    if stall < stale_after + duration:
+        # the second worker was still running
+        checks['lock_of_second_kept'] = (
+            stalled['lock_owner'] is not None
+            and stalled['lock_owner'] == second['worker'])
+        checks['not_done_while_running'] = stalled['done'] is False
+    return checks
+
+
+def _backdate(queue, task, seconds):
+    """Make the lock of a task look as if it was not touched for a while."""
+    lock = queue._fname(task, 'lock')
+    then = queue.now() - seconds
+    os.utime(lock, (then, then))
+
+
+def _fresh_owner(root, stale_after, events, results):
+    """Its lock looks stale, but a heartbeat arrives just in time."""
+    found_stale, checked, beaten, tried = events
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    task = queue.claim()
+    _backdate(queue, task, 10 * stale_after)
+    found_stale.set()
+    checked.wait()
+    os.utime(queue._fname(task, 'lock'))
+    beaten.set()
+    tried.wait()
+    results.put(dict(role='owner', owns=queue.owns(task),
+                     completed=queue.complete(task, success=True)))
+    queue.close()
+
+
+def _late_breaker(root, stale_after, events, results):
+    """Finds the lock stale, but breaks it only after the heartbeat."""
+    found_stale, checked, beaten, tried = events
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    task = Task(STAGES[0], 1)
+    found_stale.wait()
+    state = queue.state(task)
+    checked.set()
+    beaten.wait()
+    # what ``claim`` does with a stale lock
+    queue._break_lock(task)
+    claimed = queue._acquire(task)
+    tried.set()
+    results.put(dict(role='breaker', state=state, claimed=claimed))
+    queue.close()
+
+
+def check_heartbeat(root, stale_after):
+    """A heartbeat arrives between the check of a lock and breaking it."""
+    events = [multiprocessing.Event() for _ in range(4)]
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=target,
+                                       args=(root, stale_after, events,
+                                             results))
+               for target in (_fresh_owner, _late_breaker)]
+    for worker in workers:
+        worker.start()
+    reports = dict(owner={}, breaker={})
+    for _ in workers:
+        try:
+            report = results.get(timeout=30.)
+        except Empty:
+            break
+        reports[report['role']] = report
+    for worker in workers:
+        worker.join()
+
+    owner, breaker = reports['owner'], reports['breaker']
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    return dict(
+        exit_codes=all(worker.exitcode == 0 for worker in workers),
+        found_stale=breaker.get('state') == 'stale',
+        lock_kept=owner.get('owns') is True,
+        not_claimed_again=breaker.get('claimed') is False,
+        no_failed_attempt=queue.attempts(Task(STAGES[0], 1)) == 0,
+        owner_completed=owner.get('completed') is True)
+
+
+def _contender(root, stale_after, barrier, results):
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    barrier.wait()
+    task = queue.claim()
+    results.put(queue.worker_id if task is not None else None)
+    queue.close()
+
+
+def check_contended(root, stale_after, n_workers, n_rounds):
+    """Several workers break the same stale lock at the same time."""
+    task = Task(STAGES[0], 1)
+    checks = dict(one_claim=True, one_failed_attempt=True,
+                  lock_of_claimer=True)
+    for round_ in range(n_rounds):
+        queue = WorkQueue(os.path.join(root, str(round_)), STAGES[:1], [1],
+                          stale_after=stale_after)
+        # a worker that died
+        queue._acquire(task)
+        _backdate(queue, task, 10 * stale_after)
+
+        barrier = multiprocessing.Barrier(n_workers)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_contender,
+            args=(queue.root, stale_after, barrier, results))
+            for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        claimers = [results.get(timeout=30.) for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        claimers = [worker for worker in claimers if worker is not None]
+        checks['one_claim'] &= len(claimers) == 1
+        checks['one_failed_attempt'] &= queue.attempts(task) == 1
+        checks['lock_of_claimer'] &= \
+            claimers[:1] == [_lock_owner(queue, task)]
+        queue.close()
+    return checks
+
+
+def _cancellable_run(log, stage, subj, cancel=None):
+    """Runs until it is cancelled."""
+    start = time.time()
+    cancelled = cancel.wait(30.)
+    with open(log, 'a') as runs:
+        runs.write(f'{cancelled} {time.time() - start!r}\n')
+    return 1 if cancelled else 0
+
+
+def _slow_worker(root, stale_after, interval, log, results):
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    n_done = work(queue, partial(_cancellable_run, log), poll=0.05,
+                  heartbeat=interval)
+    results.put(dict(role='slow', worker=queue.worker_id, n_done=n_done))
+
+
+def check_stopped(root, stale_after):
+    """The lock of a running task is broken, the task is stopped."""
+    # the heartbeats of the first worker are too slow
+    interval = 3 * stale_after
+    log = os.path.join(root, 'runs.txt')
+    os.makedirs(root)
+    results, claimed = multiprocessing.Queue(), multiprocessing.Event()
+    slow = multiprocessing.Process(
+        target=_slow_worker,
+        args=(root, stale_after, interval, log, results))
+    slow.start()
+    queue = WorkQueue(root, STAGES[:1], [1], stale_after=stale_after)
+    task = Task(STAGES[0], 1)
+    while not queue._fname(task, 'lock').exists():
+        time.sleep(0.01)
+    claimed.set()
+    second = multiprocessing.Process(
+        target=_second_worker,
+        args=(root, stale_after, interval, claimed, results))
+    second.start()
+    reports = {}
+    for _ in range(2):
+        try:
+            report = results.get(timeout=10 * interval)
+        except Empty:
+            break
+        reports[report['role']] = report
+    slow.join()
+    second.join()
+
+    with open(log) as runs:
+        runs = [line.split() for line in runs]
+    try:
+        with open(queue._fname(task, 'done')) as done:
+            done = json.load(done)
+    except FileNotFoundError:
+        done = dict(worker=None)
+    second = reports.get('second', dict(worker=None))
+    return dict(
+        cancelled=(len(runs) == 1 and runs[0][0] == 'True'
+                   and float(runs[0][1]) < 2 * interval),
+        result_discarded=reports.get('slow', {}).get('n_done') == 0,
+        done_by_second=(done['worker'] is not None
+                        and done['worker'] == second['worker']),
+        one_failed_attempt=queue.attempts(task) == 1)
+
+
+@click.command()
+@click.option("--root", default=None, type=str,
+              help="Directory of the queues (default: a temporary one)")
+@click.option("--n_workers", default=8, type=int,
+              help="Number of worker processes of the race")
+@click.option("--n_subjects", default=20, type=int,
+              help="Number of subjects of the race")
+@click.option("--stale_after", default=1., type=float,
+              help="Seconds after which a lock is stale")
+@click.option("--n_rounds", default=20, type=int,
+              help="Rounds of workers breaking the same lock")
+def main(root, n_workers, n_subjects, stale_after, n_rounds):
+    """Check the work queue with several worker processes."""
+    with tempfile.TemporaryDirectory(dir=root) as root:
+        results = dict(
+            race=check_race(os.path.join(root, 'race'), n_workers,
+                            n_subjects),
+            # stalled for 2 x stale_after, the task takes 3 x stale_after
+            reclaimed=check_stale(os.path.join(root, 'reclaimed'),
+                                  stale_after, 2 * stale_after,
+                                  3 * stale_after),
+            finished=check_stale(os.path.join(root, 'finished'),
+                                 stale_after, 3 * stale_after,
+                                 0.5 * stale_after),
+            heartbeat=check_heartbeat(os.path.join(root, 'heartbeat'),
+                                      stale_after),
+            contended=check_contended(os.path.join(root, 'contended'),
+                                      stale_after, n_workers, n_rounds),
+            stopped=check_stopped(os.path.join(root, 'stopped'),
+                                  stale_after))
+
+    failed = False
+    for scenario, checks in results.items():
+        for check, passed in checks.items():
+            print(f'{scenario:<10} {check:<24} {"ok" if passed else "FAILED"}')
+            failed |= not passed
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
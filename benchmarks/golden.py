@@ -0,0 +1,336 @@
+"""
+=========================================
+Regression checks against golden outputs
+=========================================
+
+Records the outputs of the pipeline for synthetic recordings (see
+``synthetic.py``) as references and compares later runs against them, so
+that performance work on recoding, filtering or epoching can't change
+results unnoticed::
+
+    python benchmarks/golden.py record --root /tmp/uva_bench --subjects 1-2
+    # ... change the pipeline ...
+    python benchmarks/golden.py check --root /tmp/uva_bench --subjects 1-2
+
+Both commands run ``00_data_to_bids.py``, ``00_check_signal_quality.py``,
+``01_run_preprocessing.py`` and ``02_extract_epochs.py`` and report their
+runtimes; ``--run False`` uses the outputs that are already there (e.g., of
+a timing benchmark). Additional arguments are passed on to the scripts,
+e.g., to check the low-memory mode against the references::
+
+    python benchmarks/golden.py check --root /tmp/uva_bench \\
+        -- --low_memory True
+
+The references are the bad channels (of the precheck and of PREP), the ICA
+components that were removed, the recoded events (of the event index and of
+the epochs file), a checksum and a coarse fingerprint (RMS of each channel in
+1 s blocks) of the preprocessed data, the epochs data and metadata, and the
+RT table. Integer outputs have to match exactly, data within ``--rtol`` and
+``--atol``. ICA is seeded (``--random_state``), so that runs are
+reproducible.
+
+License: BSD (3-clause)
+"""
+import io
+import os
+import sys
+import json
+import hashlib
+
+import click
+import numpy as np
+import pandas as pd
+
+from bench_utils import run_script
+from synthetic import make_dataset
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects, write_json  # noqa: E402
+
+SCRIPTS = ('00_data_to_bids.py', '00_check_signal_quality.py',
+           '01_run_preprocessing.py', '02_extract_epochs.py')
+
+
+def _fingerprint(data, sfreq):
+    """RMS of each channel in blocks of 1 s."""
+    size = int(sfreq)
+    n_blocks = data.shape[1] // size
+    blocks = data[:, :n_blocks * size].reshape(len(data), n_blocks, size)
+    return np.sqrt((blocks ** 2).mean(axis=-1))
+
+
+def collect(subj):
+    """Outputs of the pipeline for a subject.
+
+    Returns
+    -------
+    outputs : dict
+        Values that are stored in ``outputs.json``.
+    arrays : dict
+        Arrays that are stored in ``arrays.npz``.
+    tables : dict of pd.DataFrame
+        Epochs metadata and RT table.
+    """
+    from mne import read_epochs
+    from mne.io import read_raw_fif
+    from mne.preprocessing import read_ica
+
+    from layout import get_fname
+
+    with open(get_fname('bad_channels', subj)) as bads:
+        bads = json.load(bads)
+    with open(get_fname('precheck', subj)) as precheck:
+        precheck = json.load(precheck)
+    ica = read_ica(get_fname('ica', subj), verbose=False)
+
+    # PREP does not keep the order of the channels, sort them by name
+    raw = read_raw_fif(get_fname('preprocessed', subj), verbose=False)
+    ch_names = sorted(raw.ch_names)
+    data = raw.get_data(picks=ch_names)
+
+    epochs = read_epochs(get_fname('epochs', subj), verbose=False)
+    epochs_names = sorted(epochs.ch_names)
+
+    outputs = dict(
+        bad_channels={key: sorted(value) for key, value in bads.items()},
+        precheck_bad_channels=sorted(precheck['bad_channels']),
+        ica_exclude=sorted(int(comp) for comp in ica.exclude),
+        ica_n_components=int(ica.n_components_),
+        preprocessed_sha1=hashlib.sha1(data.tobytes()).hexdigest(),
+        preprocessed_ch_names=ch_names,
+        preprocessed_n_times=int(raw.n_times),
+        epochs_ch_names=epochs_names,
+        epochs_selection=epochs.selection.tolist(),
+        epochs_drop_log=[list(log) for log in epochs.drop_log],
+    )
+    arrays = dict(
+        trials=np.load(get_fname('event_index', subj))['rows'],
+        epochs_events=epochs.events,
+        epochs_data=epochs.get_data(picks=epochs_names),
+        preprocessed_rms=_fingerprint(data, raw.info['sfreq']),
+    )
+    tables = dict(
+        metadata=epochs.metadata.reset_index(drop=True),
+        rt=pd.read_csv(get_fname('rt', subj), sep='\t'),
+    )
+    return outputs, arrays, tables
+
+
+def record(subj, golden_dir):
+    """Store the outputs of a subject as references."""
+    outputs, arrays, tables = collect(subj)
+    subj_dir = os.path.join(golden_dir, 'sub-%03d' % subj)
+    os.makedirs(subj_dir, exist_ok=True)
+    write_json(os.path.join(subj_dir, 'outputs.json'), outputs)
+    np.savez_compressed(os.path.join(subj_dir, 'arrays.npz'), **arrays)
+    for name, table in tables.items():
+        table.to_csv(os.path.join(subj_dir, f'{name}.tsv'), sep='\t',
+                     index=False)
+
+
+def _compare_tables(new, old, rtol, atol):
+    """Description of the first difference of two tables (None if equal)."""
+    try:
+        pd.testing.assert_frame_equal(new.reset_index(drop=True),
+                                      old.reset_index(drop=True),
+                                      check_dtype=False, check_exact=False,
+                                      rtol=rtol, atol=atol)
+    except AssertionError as err:
+        return ' '.join(str(err).split())[:200]
+    return None
+
+
+def check(subj, golden_dir, rtol=1e-5, atol=1e-9):
+    """Compare the outputs of a subject with the references.
+
+    Returns
+    -------
+    results : list of dict
+        One row per check: ``output``, ``status`` (``'identical'``,
+        ``'within tolerance'``, ``'differs'``) and ``detail``.
+    """
+    subj_dir = os.path.join(golden_dir, 'sub-%03d' % subj)
+    with open(os.path.join(subj_dir, 'outputs.json')) as old_outputs:
+        old_outputs = json.load(old_outputs)
+    old_arrays = np.load(os.path.join(subj_dir, 'arrays.npz'))
+    outputs, arrays, tables = collect(subj)
+    # round trip through .json, like the references
+    outputs = json.loads(json.dumps(outputs))
+
+    results = []
+
+    def add(output, status, detail=''):
+        results.append(dict(subject=subj, output=output, status=status,
+                            detail=detail))
+
+    # values that have to match exactly
+    for key in ('precheck_bad_channels', 'bad_channels', 'ica_exclude',
+                'ica_n_components', 'preprocessed_ch_names',
+                'preprocessed_n_times', 'epochs_ch_names',
+                'epochs_selection', 'epochs_drop_log'):
+        # references may be older than some of the outputs
+        old = old_outputs.get(key)
+        if outputs[key] == old:
+            add(key, 'identical')
+        else:
+            add(key, 'differs', f'{old} -> {outputs[key]}')
+
+    # recoded events
+    trials, old_trials = arrays['trials'], old_arrays['trials']
+    if trials.shape != old_trials.shape:
+        add('trials', 'differs',
+            f'{len(old_trials)} -> {len(trials)} trials')
+    else:
+        columns = [name for name in trials.dtype.names
+                   if not np.array_equal(trials[name], old_trials[name],
+                                         equal_nan=True)]
+        add('trials', 'differs' if columns else 'identical',
+            f'columns {columns}' if columns else '')
+    if np.array_equal(arrays['epochs_events'], old_arrays['epochs_events']):
+        add('epochs_events', 'identical')
+    else:
+        add('epochs_events', 'differs')
+
+    # data
+    if outputs['preprocessed_sha1'] == old_outputs['preprocessed_sha1']:
+        add('preprocessed', 'identical')
+    else:
+        rms, old_rms = arrays['preprocessed_rms'], \
+            old_arrays['preprocessed_rms']
+        if rms.shape != old_rms.shape:
+            add('preprocessed', 'differs', f'shape {rms.shape}')
+        else:
+            diff = np.abs(rms - old_rms)
+            close = np.allclose(rms, old_rms, rtol=rtol, atol=atol)
+            add('preprocessed', 'within tolerance' if close else 'differs',
+                f'max. RMS difference {diff.max():.3g}')
+
+    data, old_data = arrays['epochs_data'], old_arrays['epochs_data']
+    if data.shape != old_data.shape:
+        add('epochs_data', 'differs',
+            f'shape {old_data.shape} -> {data.shape}')
+    elif np.array_equal(data, old_data):
+        add('epochs_data', 'identical')
+    else:
+        close = np.allclose(data, old_data, rtol=rtol, atol=atol)
+        add('epochs_data', 'within tolerance' if close else 'differs',
+            f'max. difference {np.abs(data - old_data).max():.3g}')
+
+    # tables
+    for name, table in tables.items():
+        old_table = pd.read_csv(os.path.join(subj_dir, f'{name}.tsv'),
+                                sep='\t')
+        # compare like it was stored
+        table = pd.read_csv(io.StringIO(
+            table.to_csv(sep='\t', index=False)), sep='\t')
+        if table.equals(old_table):
+            add(name, 'identical')
+            continue
+        difference = _compare_tables(table, old_table, rtol, atol)
+        add(name, 'differs' if difference else 'within tolerance',
+            difference or '')
+
+    return results
+
+
+def _run_pipeline(subjects, paths, random_state, script_args):
+    """Run the scripts, return their runtimes."""
+    timings = []
+    for subj in subjects:
+        for script in SCRIPTS:
+            args = ['--subj', subj, '--overwrite', True]
+            if script == '01_run_preprocessing.py':
+                args += ['--random_state', random_state]
+            if script != '00_data_to_bids.py':
+                args += list(script_args)
+            result = run_script(script, *args, paths=paths)
+            if result['returncode']:
+                sys.exit(1)
+            timings.append(dict(subject=subj, script=script,
+                                seconds=round(result['seconds'], 1),
+                                peak_memory_gb=round(
+                                    result['peak_memory_gb'], 2)))
+    print(pd.DataFrame(timings).to_string(index=False) + '\n')
+
+
+def _options(command):
+    """Options shared by ``record`` and ``check``."""
+    options = [
+        click.option("--root", required=True, type=str,
+                     help="Directory of the synthetic dataset"),
+        click.option("--subjects", default='1', type=str,
+                     help="Subjects, e.g., '1-3'"),
+        click.option("--n_trials", default=40, type=int,
+                     help="Number of trials per task block"),
+        click.option("--golden", "golden_dir", default=None, type=str,
+                     help="Directory of the references "
+                          "(default: <root>/golden)"),
+        click.option("--run", default=True, type=bool,
+                     help="Run the pipeline (or use existing outputs)?"),
+        click.option("--random_state", default=42, type=int,
+                     help="Seed of ICA"),
+        click.argument("script_args", nargs=-1, type=click.UNPROCESSED),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _setup(root, subjects, n_trials, golden_dir, run, random_state,
+           script_args):
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    paths = make_dataset(root, subjects, n_trials=n_trials)
+    os.environ['UVA_PATHS'] = paths
+    if run:
+        _run_pipeline(subjects, paths, random_state, script_args)
+    if golden_dir is None:
+        golden_dir = os.path.join(root, 'golden')
+    return subjects, golden_dir
+
+
+@click.group()
+def cli():
+    """Record and check golden outputs."""
+
+
+@cli.command(name='record',
+             context_settings=dict(ignore_unknown_options=True))
+@_options
+def record_command(root, subjects, n_trials, golden_dir, run, random_state,
+                   script_args):
+    """Store the outputs as references."""
+    subjects, golden_dir = _setup(root, subjects, n_trials, golden_dir, run,
+                                  random_state, script_args)
+    for subj in subjects:
+        record(subj, golden_dir)
+    print(f'References of {len(subjects)} subjects written to {golden_dir}')
+
+
+@cli.command(name='check',
+             context_settings=dict(ignore_unknown_options=True))
+@_options
+@click.option("--rtol", default=1e-5, type=float,
+              help="Relative tolerance of data")
+@click.option("--atol", default=1e-9, type=float,
+              help="Absolute tolerance of data (V)")
+@click.option("--output", default=None, type=str,
+              help="Write the results to this .tsv file")
+def check_command(root, subjects, n_trials, golden_dir, run, random_state,
+                  script_args, rtol, atol, output):
+    """Compare the outputs with the references."""
+    subjects, golden_dir = _setup(root, subjects, n_trials, golden_dir, run,
+                                  random_state, script_args)
+    results = pd.DataFrame([row for subj in subjects
+                            for row in check(subj, golden_dir, rtol, atol)])
+    print(results.to_string(index=False))
+    if output is not None:
+        results.to_csv(output, sep='\t', index=False)
+    if (results.status == 'differs').any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
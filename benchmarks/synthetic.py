@@ -0,0 +1,254 @@
+"""
+=========================
+Synthetic DPX recordings
+=========================
+
+Writes a synthetic dataset with the structure of the study (Biosemi .bdf
+files with 64 EEG channels, 8 external channels and a ``Status`` channel,
+demographics) that can be processed by the pipeline, e.g., for benchmarks::
+
+    python benchmarks/synthetic.py --root /tmp/uva_bench --subjects 1-3
+
+Each recording has a practice block and two task blocks of DPX trials,
+separated by breaks, with spatially correlated background activity, alpha,
+line noise (50 and 100 Hz), eye blinks and horizontal eye movements (with the
+topographies of ``ica_templates.json``) and one noisy channel. A
+``paths.json`` for the dataset is written to the root directory, use it with
+the environment variable ``UVA_PATHS``.
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import json
+import datetime
+
+import click
+import numpy as np
+import pandas as pd
+
+from mne.channels import make_standard_montage
+
+# get path to the pipeline
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from utils import parse_subjects  # noqa: E402
+
+
+def write_bdf(fname, data, ch_names, sfreq, status, start=None,
+              record_duration=1):
+    """Write data (in V) and a status channel to a .bdf file."""
+    n_channels = len(ch_names) + 1
+    n_per_record = int(sfreq * record_duration)
+    n_records = int(np.ceil(data.shape[1] / n_per_record))
+    n_times = n_records * n_per_record
+
+    # digital values: 24 bit, 1/32 uV resolution (like Biosemi)
+    phys_max, dig_max = 262143., 8388607
+    digital = np.zeros((n_channels, n_times), dtype=np.int64)
+    digital[:-1, :data.shape[1]] = np.clip(
+        np.round(data * 1e6 / phys_max * dig_max), -dig_max - 1, dig_max)
+    digital[-1, :data.shape[1]] = status
+
+    start = start or datetime.datetime(2020, 1, 1, 10, 0, 0)
+
+    def pad(value, size):
+        return str(value).ljust(size)[:size].encode('latin-1')
+
+    header = b'\xffBIOSEMI'
+    header += pad('X X X X', 80) + pad('Startdate', 80)
+    header += pad(start.strftime('%d.%m.%y'), 8)
+    header += pad(start.strftime('%H.%M.%S'), 8)
+    header += pad(256 * (n_channels + 1), 8)
+    header += pad('24BIT', 44)
+    header += pad(n_records, 8) + pad(record_duration, 8)
+    header += pad(n_channels, 4)
+    labels = list(ch_names) + ['Status']
+    header += b''.join(pad(label, 16) for label in labels)
+    header += b''.join(pad('Active Electrode', 80) for _ in labels)
+    header += b''.join(pad('uV', 8) for _ in labels[:-1]) + pad('Boolean', 8)
+    header += b''.join(pad(-phys_max, 8) for _ in labels[:-1]) \
+        + pad(-8388608, 8)
+    header += b''.join(pad(phys_max, 8) for _ in labels[:-1]) \
+        + pad(8388607, 8)
+    header += b''.join(pad(-dig_max - 1, 8) for _ in labels)
+    header += b''.join(pad(dig_max, 8) for _ in labels)
+    header += b''.join(pad('HP:DC; LP:417 Hz', 80) for _ in labels)
+    header += b''.join(pad(n_per_record, 8) for _ in labels)
+    header += b''.join(pad('', 32) for _ in labels)
+
+    # 24-bit little endian, one block of samples per channel and record
+    records = digital.reshape(n_channels, n_records, n_per_record)
+    records = records.transpose(1, 0, 2).astype('<i4')
+    raw_bytes = records.reshape(-1, 1).view(np.uint8)[:, :3]
+
+    with open(fname, 'wb') as fid:
+        fid.write(header)
+        fid.write(raw_bytes.tobytes())
+
+
+def _simulate_events(rng, markers, n_practice, n_trials):
+    """Onsets (in seconds) and codes of the events of a DPX session."""
+    events = []
+    t = 5.
+    for block, n in enumerate([n_practice, n_trials, n_trials]):
+        if block:
+            # break between blocks
+            t += 20.
+        for _ in range(n):
+            cue = 'A' if rng.random() < 0.8 else 'B'
+            p_x = 0.875 if cue == 'A' else 0.5
+            probe = 'X' if rng.random() < p_x else 'Y'
+            target = cue == 'A' and probe == 'X'
+            cue_code = markers['cue_a'] if cue == 'A' \
+                else markers['cue_b%d' % rng.integers(1, 6)]
+            probe_code = markers['probe_x'] if probe == 'X' \
+                else markers['probe_y%d' % rng.integers(1, 6)]
+
+            events.append((t, cue_code))
+            outcome = rng.choice(['correct', 'incorrect', 'missed',
+                                  'too_soon'], p=[0.85, 0.07, 0.04, 0.04])
+            if outcome == 'too_soon':
+                events.append((t + rng.uniform(0.3, 1.5),
+                               markers['incorrect_target_button']))
+            events.append((t + 2., probe_code))
+            if outcome in ('correct', 'incorrect'):
+                button = target if outcome == 'correct' else not target
+                name = outcome + ('_target_button' if button
+                                  else '_non_target_button')
+                events.append((t + 2. + rng.uniform(0.25, 0.7),
+                               markers[name]))
+            t += 2.7 + rng.uniform(0.8, 1.3)
+
+    return events, t + 5.
+
+
+def simulate_session(sfreq=256., n_practice=8, n_trials=40, seed=None):
+    """Simulate the recording of a DPX session.
+
+    Returns
+    -------
+    data : ndarray, shape (n_channels, n_times)
+        EEG and external channels (in V).
+    ch_names : list of str
+        Names of the channels.
+    status : ndarray, shape (n_times,)
+        The trigger channel.
+    """
+    rng = np.random.default_rng(seed)
+    montage = make_standard_montage('biosemi64')
+    eeg_names = montage.ch_names
+    ch_names = eeg_names + ['EXG%d' % i for i in range(1, 9)]
+    with open(os.path.join(parent, 'eeg_markers.json')) as markers:
+        markers = json.load(markers)['dpx']['markers']
+    with open(os.path.join(parent, 'ica_templates.json')) as templates:
+        templates = json.load(templates)
+
+    events, duration = _simulate_events(rng, markers, n_practice, n_trials)
+    n_times = int(duration * sfreq)
+    times = np.arange(n_times) / sfreq
+
+    # background activity with a 1/f spectrum, spatially smoothed so that
+    # neighbouring channels are correlated
+    spectrum = np.fft.rfft(rng.normal(0, 1, (len(eeg_names), n_times)),
+                           axis=1)
+    spectrum /= np.sqrt(np.maximum(np.fft.rfftfreq(n_times, 1 / sfreq), 1.))
+    data = np.fft.irfft(spectrum, n=n_times, axis=1)
+    pos = np.array([montage.get_positions()['ch_pos'][name]
+                    for name in eeg_names])
+    dist = np.linalg.norm(pos[:, np.newaxis] - pos[np.newaxis], axis=-1)
+    data = np.exp(-(dist / 0.05) ** 2) @ data
+    data *= 10e-6 / data.std(axis=1, keepdims=True)
+
+    # alpha and line noise
+    data += 5e-6 * np.sin(2 * np.pi * 10 * times
+                          + rng.uniform(0, 2 * np.pi, (len(eeg_names), 1)))
+    line = 4e-6 * np.sin(2 * np.pi * 50 * times) \
+        + 1e-6 * np.sin(2 * np.pi * 100 * times)
+    data += line * rng.uniform(0.5, 1.5, (len(eeg_names), 1))
+
+    # eye blinks and horizontal eye movements
+    blinks = np.zeros(n_times)
+    for onset in rng.uniform(0, duration, int(duration / 4)):
+        blinks += 150e-6 * np.exp(-0.5 * ((times - onset) / 0.08) ** 2)
+    saccades = np.zeros(n_times)
+    for onset in np.sort(rng.uniform(0, duration, int(duration / 6))):
+        saccades[int(onset * sfreq):] = rng.choice([-1., 0., 1.]) * 40e-6
+    for template, source in (('vertical_eye', blinks),
+                             ('horizontal_eye', saccades)):
+        topography = np.array(templates[template])
+        data += np.outer(topography / np.abs(topography).max(), source)
+
+    # a noisy channel
+    data[eeg_names.index('T7')] += rng.normal(0, 60e-6, n_times)
+
+    # external channels (EOG)
+    exg = rng.normal(0, 5e-6, (8, n_times))
+    exg[:2] += blinks
+    exg[2:4] += saccades * np.array([[1.], [-1.]])
+    data = np.concatenate([data, exg])
+
+    status = np.zeros(n_times, dtype=int)
+    for onset, code in events:
+        sample = int(round(onset * sfreq))
+        status[sample:sample + 4] = code
+
+    return data, ch_names, status
+
+
+def write_subject(root, subj, sfreq=256., n_trials=40, seed=None):
+    """Write the recording and demographics of a subject to ``sourcedata``."""
+    data, ch_names, status = simulate_session(sfreq, n_trials=n_trials,
+                                              seed=seed)
+    sub_dir = os.path.join(root, 'sourcedata', 'sub-%03d' % subj)
+    os.makedirs(os.path.join(sub_dir, 'eeg'), exist_ok=True)
+    os.makedirs(os.path.join(sub_dir, 'demographics'), exist_ok=True)
+
+    write_bdf(os.path.join(sub_dir, 'eeg', 'sub-%03d_dpx_eeg.bdf' % subj),
+              data, ch_names, sfreq, status)
+    demographics = pd.DataFrame(dict(subject_id=['sub-%03d' % subj],
+                                     age=[25], sex=[2]))
+    demographics.to_csv(os.path.join(sub_dir, 'demographics',
+                                     'sub-%03d_dpx_demographics.tsv' % subj),
+                        sep='\t', index=False)
+
+
+def make_dataset(root, subjects, sfreq=256., n_trials=40, overwrite=False):
+    """Write a synthetic dataset, return the path of its ``paths.json``."""
+    root = os.path.abspath(root)
+    for subj in subjects:
+        fname = os.path.join(root, 'sourcedata', 'sub-%03d' % subj, 'eeg',
+                             'sub-%03d_dpx_eeg.bdf' % subj)
+        if overwrite or not os.path.exists(fname):
+            write_subject(root, subj, sfreq, n_trials, seed=subj)
+
+    paths = dict(root=root,
+                 sourcedata=os.path.join(root, 'sourcedata'),
+                 bidsdata=os.path.join(root, 'bidsdata'),
+                 derivatives=os.path.join(root, 'bidsdata', 'derivatives'))
+    paths_fname = os.path.join(root, 'paths.json')
+    with open(paths_fname, 'w') as paths_file:
+        json.dump(paths, paths_file, indent=2)
+
+    return paths_fname
+
+
+@click.command()
+@click.option("--root", required=True, type=str,
+              help="Directory of the dataset")
+@click.option("--subjects", default='1-3', type=str,
+              help="Subjects to simulate, e.g., '1-3'")
+@click.option("--sfreq", default=256., type=float, help="Sampling rate")
+@click.option("--n_trials", default=40, type=int,
+              help="Number of trials per task block")
+@click.option("--overwrite", default=False, type=bool, help="Overwrite?")
+def main(root, subjects, sfreq, n_trials, overwrite):
+    """Write a synthetic dataset."""
+    subjects = parse_subjects(subjects, list(range(1, 1000)))
+    paths_fname = make_dataset(root, subjects, sfreq, n_trials, overwrite)
+    print(f"Use the dataset with:\n    export UVA_PATHS={paths_fname}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Out-of-core FIR filtering of long recordings.
+
+``filter_raw_chunked`` applies the same FIR filter as ``raw.filter()`` (same
+filter design, zero-phase, ``reflect_limited`` padding at the edges of each
+segment, no filtering across ``EDGE`` boundaries), but reads the data from
+disk in overlapping chunks and writes the result to a file. Peak memory of
+the filtering is bounded by the chunk size, which is derived from a memory
+budget, regardless of the length of the recording.
+
+Each chunk is written to the file with ``os.pwrite`` (one call per channel,
+the file has the layout of the data, ``(n_channels, n_times)``). Unlike
+writing into a memory map, this does not make the pages of the file resident
+in the memory of the process. The filtered data are then memory-mapped
+(copy-on-write, C-contiguous like data that are loaded into memory, so that
+MNE and PREP do not copy them to change their layout) and only take up
+memory where they are read or changed.
+"""
+import os
+
+import numpy as np
+
+from scipy.signal import oaconvolve
+
+from mne import pick_types
+from mne.filter import create_filter
+from mne.utils import logger
+
+# annotations that filtering does not cross (same as ``raw.filter()``)
+SKIP_BY_ANNOTATION = ('edge', 'bad_acq_skip')
+
+
+def _segments(raw, skip_by_annotation=SKIP_BY_ANNOTATION):
+    """Start and stop samples of the parts of the data to filter separately.
+    """
+    annotations = raw.annotations
+    skip = [any(desc.upper().startswith(kind.upper())
+                for kind in skip_by_annotation)
+            for desc in annotations.description]
+    onsets = raw.time_as_index(annotations.onset[skip], use_rounding=True,
+                               origin=annotations.orig_time)
+    stops = raw.time_as_index(annotations.onset[skip]
+                              + annotations.duration[skip],
+                              use_rounding=True,
+                              origin=annotations.orig_time)
+
+    segments, start = [], 0
+    for onset, stop in sorted(zip(onsets, stops)):
+        onset, stop = max(onset, 0), min(stop, raw.n_times)
+        if onset > start:
+            segments.append((start, onset))
+        start = max(start, stop)
+    if start < raw.n_times:
+        segments.append((start, raw.n_times))
+
+    return segments
+
+
+def _read_padded(raw, picks, seg_start, seg_stop, start, stop, head, tail):
+    """Read samples ``start`` to ``stop`` (relative to the segment).
+
+    Samples outside of the segment are padded like mne does it
+    (``reflect_limited``: point reflection at the edges, zeros beyond).
+    """
+    n_seg = seg_stop - seg_start
+    inner = raw.get_data(picks, start=seg_start + max(start, 0),
+                         stop=seg_start + min(stop, n_seg))
+
+    parts = []
+    if start < 0:
+        dist = np.arange(-start, 0, -1)
+        left = np.zeros((len(picks), len(dist)))
+        valid = dist < head.shape[1]
+        left[:, valid] = 2 * head[:, :1] - head[:, dist[valid]]
+        parts.append(left)
+    parts.append(inner)
+    if stop > n_seg:
+        dist = np.arange(1, stop - n_seg + 1)
+        right = np.zeros((len(picks), len(dist)))
+        valid = dist < tail.shape[1]
+        right[:, valid] = 2 * tail[:, -1:] - tail[:, -1 - dist[valid]]
+        parts.append(right)
+
+    return np.concatenate(parts, axis=1) if len(parts) > 1 else inner
+
+
+def _gaps(segments, n_times):
+    """Start and stop samples of the parts of the data between segments."""
+    gaps, start = [], 0
+    for seg_start, seg_stop in segments:
+        if seg_start > start:
+            gaps.append((start, seg_start))
+        start = seg_stop
+    if start < n_times:
+        gaps.append((start, n_times))
+    return gaps
+
+
+def _write_samples(fd, n_times, start, data):
+    """Write samples of all channels to a file of shape (n_chs, n_times)."""
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    for ch, samples in enumerate(data):
+        os.pwrite(fd, samples.data, (ch * n_times + start) * 8)
+
+
+def filter_raw_chunked(raw, l_freq, h_freq, fname, picks=('eeg', 'eog'),
+                       memory_budget=512., **filter_kwargs):
+    """Filter data chunk by chunk, writing the result to a memory map.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The data, best not loaded into memory (the result is a copy of it).
+    l_freq, h_freq : float | None
+        Edges of the filter (see ``raw.filter()``).
+    fname : str
+        Path of the memory-mapped output file (will be overwritten).
+    picks : tuple of str
+        Types of the channels to filter, others are copied unchanged.
+    memory_budget : float
+        Approximate amount of memory (in MB) used for filtering.
+    **filter_kwargs
+        Further parameters of the filter design, as in ``raw.filter()``.
+
+    Returns
+    -------
+    raw_filtered : mne.io.Raw
+        A copy of ``raw`` with the filtered data, backed by the memory-mapped
+        file (copy-on-write, the file itself is not changed).
+    """
+    sfreq = raw.info['sfreq']
+    filter_kwargs.setdefault('fir_design', 'firwin')
+    h = create_filter(None, sfreq, l_freq, h_freq, method='fir',
+                      phase='zero', **filter_kwargs)
+    n_h = len(h)
+    # for zero phase, mne designs filters of odd length with the delay
+    # compensated, i.e., output sample n depends on input n - half ... n + half
+    half = (n_h - 1) // 2
+
+    picks = pick_types(raw.info, exclude=[],
+                       **{ch_type: True for ch_type in picks})
+    others = np.setdiff1d(np.arange(len(raw.ch_names)), picks)
+
+    # per output sample, keep ~4 float64 copies of each channel in memory
+    # (input, FFT buffers of overlap-add and output)
+    n_chunk = int(memory_budget * 1024 ** 2 / (4 * 8 * len(raw.ch_names)))
+    n_chunk = max(n_chunk - 2 * half, n_h)
+
+    segments = _segments(raw)
+    logger.info(f"Filtering {len(picks)} channels in {len(segments)} "
+                f"segments, chunks of {n_chunk} samples "
+                f"(filter length {n_h})")
+
+    n_channels = len(raw.ch_names)
+    with open(fname, 'wb') as out:
+        out.truncate(raw.n_times * n_channels * 8)
+        fd = out.fileno()
+
+        # samples outside of the segments are not filtered (like
+        # ``raw.filter()``)
+        for gap_start, gap_stop in _gaps(segments, raw.n_times):
+            for start in range(gap_start, gap_stop, n_chunk):
+                stop = min(start + n_chunk, gap_stop)
+                _write_samples(fd, raw.n_times, start,
+                               raw.get_data(start=start, stop=stop))
+
+        for seg_start, seg_stop in segments:
+            n_seg = seg_stop - seg_start
+            # samples needed to pad the edges of the segment
+            n_edge = min(half + 1, n_seg)
+            head = raw.get_data(picks, start=seg_start,
+                                stop=seg_start + n_edge)
+            tail = raw.get_data(picks, start=seg_stop - n_edge,
+                                stop=seg_stop)
+
+            for start in range(0, n_seg, n_chunk):
+                stop = min(start + n_chunk, n_seg)
+                data = _read_padded(raw, picks, seg_start, seg_stop,
+                                    start - half, stop + half, head, tail)
+                chunk = np.empty((n_channels, stop - start))
+                # overlap-add convolution, 'valid' drops the overlapping
+                # edges
+                chunk[picks] = oaconvolve(data, h[np.newaxis, :],
+                                          mode='valid', axes=1)
+                if len(others):
+                    chunk[others] = raw.get_data(others,
+                                                 start=seg_start + start,
+                                                 stop=seg_start + stop)
+                _write_samples(fd, raw.n_times, seg_start + start, chunk)
+
+    # like ``raw.load_data()`` on a copy (of the unloaded raw, which is
+    # cheap). A ``RawArray`` would keep a reference to the data it was created
+    # with, which ``raw.copy()`` copies along with the (picked) data
+    raw_filtered = raw.copy()
+    raw_filtered._data = np.memmap(fname, dtype=np.float64, mode='c',
+                                   shape=(n_channels, raw.n_times))
+    raw_filtered.preload = True
+    raw_filtered._comp = None
+    raw_filtered.close()
+    # update filter settings as ``raw.filter()`` would do
+    with raw_filtered.info._unlock():
+        if l_freq is not None:
+            raw_filtered.info['highpass'] = float(l_freq)
+        if h_freq is not None:
+            raw_filtered.info['lowpass'] = float(h_freq)
+
+    return raw_filtered
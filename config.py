@@ -22,8 +22,10 @@ from mne.channels import make_standard_montage
 parent = Path(__file__).parent.resolve()
 
 # -----------------------------------------------------------------------------
-# file paths
-with open(os.path.join(parent, 'paths.json')) as paths:
+# file paths (another paths file can be used by setting the environment
+# variable `UVA_PATHS`, e.g., for benchmarks on synthetic data)
+with open(os.environ.get('UVA_PATHS',
+                         os.path.join(parent, 'paths.json'))) as paths:
     paths = json.load(paths)
 
 # the root path of the dataset
@@ -35,15 +37,7 @@ FPATH_DATA_BIDS = Path(paths['bidsdata'])
 # path to derivatives
 FPATH_DATA_DERIVATIVES = Path(paths['derivatives'])
 
-# -----------------------------------------------------------------------------
-# file templates
-# the path to the sourcedata directory
-FNAME_SOURCEDATA_TEMPLATE = os.path.join(
-    str(FPATH_DATA_SOURCEDATA),
-    "sub-{subj:03}",
-    "{dtype}",
-    "sub-{subj:03}_dpx_{dtype}{ext}"
-)
+# file and directory names are defined in `layout.py`
 
 # -----------------------------------------------------------------------------
 # problematic subjects
@@ -109,8 +103,139 @@ task_events = {
     'pause_record': 18,
 }
 
+# recoded cue events (see `02_extract_epochs.py`)
+cue_event_id = {'Too_soon A': 118,
+                'Too_soon B': 119,
+
+                'Correct A': 122,
+                'Correct B': 125,
+
+                'Incorrect A': 128,
+                'Incorrect B': 131,
+
+                'Missed A': 134,
+                'Missed B': 137}
+
+# recoded probe events
+probe_event_id = {'Too_soon X': 120,
+                  'Too_soon Y': 121,
+
+                  'Correct AX': 123,
+                  'Correct AY': 124,
+
+                  'Correct BX': 126,
+                  'Correct BY': 127,
+
+                  'Incorrect AX': 129,
+                  'Incorrect AY': 130,
+
+                  'Incorrect BX': 132,
+                  'Incorrect BY': 133,
+
+                  'Missed AX': 135,
+                  'Missed AY': 136,
+
+                  'Missed BX': 138,
+                  'Missed BY': 139}
+
+# conditions of the ERPs: combinations of columns of the epochs metadata
+# (e.g., 'Correct AX' and 'Correct A', see `erp_aggregation.py`)
+ERP_CONDITIONS = [('reaction_probes', 'probe'),
+                  ('reaction_cues', 'cue')]
+
+# -----------------------------------------------------------------------------
+# ICA solvers (see `ica_methods.py`), picard with `extended=True` and
+# `ortho=False` fits the same model as extended infomax
+ICA_METHODS = {
+    'infomax': dict(method='infomax', fit_params=dict(extended=True)),
+    'picard': dict(method='picard', fit_params=dict(extended=True,
+                                                    ortho=False)),
+    'fastica': dict(method='fastica'),
+}
+
+# -----------------------------------------------------------------------------
+# line-noise removal (see `line_noise.py`), 'prep' is PREP's multitaper
+# regression followed by a notch filter at 50 and 100 Hz, the other methods
+# replace both
+LINE_NOISE_METHODS = {
+    'prep': dict(),
+    'zapline': dict(n_remove='auto', min_ratio=2., chunk_duration=60.),
+    'spectrum_interpolation': dict(width=1., neighbours=2.),
+}
+
+# -----------------------------------------------------------------------------
+# time-frequency decomposition of the cue epochs (see `tfr.py`)
+TFR_PARAMS = dict(
+    freqs=np.logspace(np.log10(2.), np.log10(40.), 30),
+    n_cycles=np.logspace(np.log10(3.), np.log10(10.), 30),
+    # keep every `decim`-th sample and every `freq_decim`-th frequency
+    decim=2,
+    freq_decim=1,
+    # remove the mean of the wavelets (like `tfr_array_morlet`)
+    zero_mean=True,
+    # memory (in MB) used to transform a chunk of epochs
+    memory_budget=256.,
+)
+
+# -----------------------------------------------------------------------------
+# signal-quality precheck of the raw data (see `signal_quality.py`)
+PRECHECK_PARAMS = dict(
+    # length of the windows (in seconds) the statistics are computed in
+    window=1.,
+    # windows with a standard deviation below this value (in V) are flat
+    flat=0.1e-6,
+    # channels that are flat or clipped in a larger fraction of the windows
+    # are bad
+    max_flat=0.1,
+    max_clipped=0.01,
+    # channels whose amplitude or line noise deviates more than this from the
+    # other EEG channels (robust z-score, as in PREP) are bad
+    max_z=5.,
+    line_freq=50.,
+    # subjects with a larger fraction of bad EEG channels are hopeless
+    max_bad_fraction=0.25,
+)
+
 # -----------------------------------------------------------------------------
 # templates
 # import eeg markers
 with open(os.path.join(parent, './ica_templates.json')) as temp:
     ica_templates = json.load(temp)
+
+# -----------------------------------------------------------------------------
+# pipeline stages and their cost profiles (per subject)
+# memory_gb: approx. peak memory needed to process one subject
+# max_jobs: number of cores one subject can make use of (i.e., ``n_jobs`` of
+# mne's filter functions and BLAS/OpenMP threads used by PREP and ICA)
+# minutes: approx. runtime with ``max_jobs`` cores
+# inputs: files read by the stage (see `TEMPLATES` in `layout.py`)
+# outputs: files written by the stage
+STAGES = {
+    'bids': dict(script='00_data_to_bids.py',
+                 memory_gb=1.0, max_jobs=1, minutes=1.0,
+                 inputs=['sourcedata'],
+                 outputs=['bids']),
+    'precheck': dict(script='00_check_signal_quality.py',
+                     memory_gb=0.5, max_jobs=1, minutes=0.5,
+                     inputs=['bids', 'bids_events'],
+                     outputs=['precheck', 'precheck_channels']),
+    'preprocessing': dict(script='01_run_preprocessing.py',
+                          memory_gb=6.0, max_jobs=8, minutes=20.0,
+                          inputs=['bids'],
+                          outputs=['bad_channels', 'ica', 'preprocessed']),
+    'epochs': dict(script='02_extract_epochs.py',
+                   memory_gb=3.0, max_jobs=1, minutes=2.0,
+                   inputs=['preprocessed'],
+                   outputs=['rt', 'epochs']),
+    'erps': dict(script='03_aggregate_erps.py',
+                 memory_gb=0.5, max_jobs=1, minutes=0.5,
+                 inputs=['epochs'],
+                 outputs=['erps', 'erp_stats']),
+    'tfr': dict(script='04_compute_tfr.py',
+                memory_gb=1.0, max_jobs=4, minutes=5.0,
+                inputs=['epochs'],
+                outputs=['tfr', 'tfr_power', 'tfr_itc']),
+}
+
+# fraction of the machine's available memory the scheduler is allowed to use
+MEMORY_HEADROOM = 0.9
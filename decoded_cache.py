@@ -0,0 +1,216 @@
+"""Cache of decoded Biosemi data.
+
+Reading a .bdf file decodes its 24-bit integers to floating point values,
+which takes a large part of the time to load a long recording, and the same
+recording is read by several scripts (and again in every rerun). The cache
+stores the decoded data of a recording once as a float32 ``.npy`` file, with
+the measurement info and annotations as a sidecar, in
+``derivatives/cache/decoded``. Later reads open it memory-mapped, without
+decoding and without copying the whole recording into memory::
+
+    raw = read_raw_bids(bids_path)  # only reads the header
+    raw = load_decoded(raw, DecodedCache(get_dir('decoded_cache')))
+
+Entries are keyed by a hash of the channel headers and data records of the
+file (not of the patient, recording and date fields, which differ between
+the sourcedata and BIDS copies of a recording) and the version of mne. The
+hash of a file is remembered as long as its size and modification time don't
+change. float32 represents the 24-bit samples with a relative error below
+1e-7, far below the resolution of the amplifier.
+"""
+import os
+import json
+import shutil
+import hashlib
+
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+
+import mne
+
+from mne import read_annotations
+from mne.io import BaseRaw, read_info, write_info
+from mne._fiff.utils import _mult_cal_one
+from mne.utils import logger
+
+from utils import write_json
+
+# changes of the format of the entries invalidate the cache
+_VERSION = 1
+
+_INDEX_NAME = 'index.json'
+
+
+def _content_hash(fname, chunk_size=16 * 1024 ** 2):
+    """Hash of the channel headers and data records of a .bdf file."""
+    sha1 = hashlib.sha1(f'{_VERSION}-{mne.__version__}'.encode())
+    with open(fname, 'rb') as fid:
+        fixed = fid.read(256)
+        # number of records, their duration and the number of channels
+        sha1.update(fixed[236:256])
+        while True:
+            chunk = fid.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class DecodedCache:
+    """Decoded data of .bdf files in a directory.
+
+    Parameters
+    ----------
+    root : str | Path
+        Directory of the cache.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _read_index(self):
+        try:
+            with open(self.root / _INDEX_NAME) as index:
+                return json.load(index)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def key(self, fname):
+        """Key of a file (its hash is only computed if the file changed)."""
+        fname = os.path.realpath(fname)
+        stat = os.stat(fname)
+        index = self._read_index()
+        known = index.get(fname)
+        if known is not None and known['size'] == stat.st_size \
+                and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['key']
+        key = _content_hash(fname)
+        index[fname] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                            key=key)
+        self.root.mkdir(parents=True, exist_ok=True)
+        write_json(self.root / _INDEX_NAME, index)
+        return key
+
+    def entry(self, key):
+        """Directory of an entry."""
+        return self.root / key
+
+    def exists(self, key):
+        """Whether an entry is complete."""
+        return (self.entry(key) / 'meta.json').exists()
+
+    def store(self, key, raw, chunk_duration=60.):
+        """Decode the data of a raw .bdf file into the cache.
+
+        The data are decoded in chunks of ``chunk_duration`` seconds, so
+        memory use does not depend on the length of the recording. The
+        entry is written to a temporary directory and renamed when it is
+        complete.
+        """
+        tmp = self.root / f'.tmp-{uuid4().hex}'
+        tmp.mkdir(parents=True)
+        try:
+            data = np.lib.format.open_memmap(
+                tmp / 'data.npy', mode='w+', dtype=np.float32,
+                shape=(len(raw.ch_names), int(raw.n_times)))
+            step = max(int(chunk_duration * raw.info['sfreq']), 1)
+            for start in range(0, raw.n_times, step):
+                stop = min(start + step, raw.n_times)
+                data[:, start:stop] = raw.get_data(start=start, stop=stop)
+            data.flush()
+            del data
+            write_info(tmp / 'info.fif', raw.info)
+            raw.annotations.save(tmp / 'decoded-annot.fif')
+            # written last, the entry is complete with it
+            write_json(tmp / 'meta.json',
+                       dict(first_samp=int(raw.first_samp),
+                            n_times=int(raw.n_times),
+                            source=[str(fname) for fname in raw.filenames]))
+            try:
+                os.replace(tmp, self.entry(key))
+            except OSError:
+                # stored by another process in the meantime
+                if not self.exists(key):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class RawDecoded(BaseRaw):
+    """Raw data read from an entry of ``DecodedCache``.
+
+    Parameters
+    ----------
+    entry : str | Path
+        Directory of the entry.
+    info : mne.Info | None
+        Measurement info (default: that of the entry). Use the info of the
+        reader of the recording, e.g., with the channel types and montage of
+        the BIDS dataset.
+    annotations : mne.Annotations | None
+        Annotations (default: those of the entry).
+    preload : bool
+        Load the data into memory?
+    """
+
+    def __init__(self, entry, info=None, annotations=None, preload=False,
+                 verbose=None):
+        entry = Path(entry)
+        with open(entry / 'meta.json') as meta:
+            meta = json.load(meta)
+        if info is None:
+            info = read_info(entry / 'info.fif', verbose=False)
+        first_samp = meta['first_samp']
+        super().__init__(info, preload=False,
+                         first_samps=[first_samp],
+                         last_samps=[first_samp + meta['n_times'] - 1],
+                         filenames=[str(entry / 'data.npy')],
+                         orig_format='single', verbose=verbose)
+        # the data are stored in SI units
+        self._cals = np.ones_like(self._cals)
+        if annotations is None:
+            annotations = read_annotations(entry / 'decoded-annot.fif')
+        self.set_annotations(annotations)
+        if preload:
+            self.load_data()
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        """Read a chunk of data."""
+        # opened for each read, copies of the raw must not copy the map
+        stored = np.load(self.filenames[fi], mmap_mode='r')
+        _mult_cal_one(data, stored[:, start:stop], idx, cals, mult)
+
+
+def load_decoded(raw, cache):
+    """Raw data of a .bdf file from the cache.
+
+    The data are decoded and stored on the first read. Info and annotations
+    are those of ``raw``.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The recording as returned by ``read_raw_bdf`` or ``read_raw_bids``,
+        without data loaded.
+    cache : DecodedCache
+        The cache.
+
+    Returns
+    -------
+    raw : RawDecoded
+        The recording, data are read from the cache.
+    """
+    if raw.preload or len(raw.filenames) != 1 \
+            or not str(raw.filenames[0]).lower().endswith('.bdf'):
+        raise ValueError("Only recordings read from a single .bdf file "
+                         "without preloading can be cached.")
+    key = cache.key(raw.filenames[0])
+    if cache.exists(key):
+        logger.info(f"    > Decoded data from the cache ({key[:10]})")
+    else:
+        logger.info(f"    > Storing decoded data in the cache ({key[:10]})")
+        cache.store(key, raw)
+    return RawDecoded(cache.entry(key), info=raw.info.copy(),
+                      annotations=raw.annotations.copy())
@@ -0,0 +1,203 @@
+"""Epochs as views of memory-mapped continuous data.
+
+``Epochs(..., preload=True)`` copies the window of every epoch into a new
+array. The cue epochs (-2 to 5 s) are longer than the interval between cues,
+so most samples of the recording are copied several times. ``EpochViews``
+exposes the epochs of an ``Epochs`` object that is not preloaded as strided
+views of the data of its raw object, which can be memory-mapped (e.g.,
+``read_raw_fif(fname, preload=<file>)``):
+
+- bad epochs are dropped by ``Epochs.drop_bad`` (one epoch in memory at a
+  time), so the selection and drop log are those of ``preload=True``,
+- decimation is a step of the view,
+- only baseline correction (and channels that are not equally spaced in the
+  raw data) copy an epoch, one at a time,
+- ``EpochViews.save`` writes a regular ``-epo.fif`` file one epoch at a time.
+
+The memory used thus scales with the length of the recording, which stays on
+disk, instead of the number of epochs times their length.
+"""
+import json
+
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from mne.annotations import _write_annotations
+from mne.baseline import rescale
+from mne.epochs import _event_id_string, _pack_reject_params
+from mne.utils import logger, _check_fname, _prepare_write_metadata
+from mne._fiff.constants import FIFF
+from mne._fiff.meas_info import write_meas_info
+from mne._fiff.write import (
+    INT32_MAX,
+    check_fiff_length,
+    end_block,
+    start_and_end_file,
+    start_block,
+    write_float,
+    write_id,
+    write_int,
+    write_string
+)
+
+
+def _as_slice(picks):
+    """Equally spaced channel indices as a slice (which indexes a view)."""
+    picks = np.asarray(picks)
+    if len(picks) == 1:
+        return slice(picks[0], picks[0] + 1)
+    step = picks[1] - picks[0]
+    if step > 0 and np.all(np.diff(picks) == step):
+        return slice(picks[0], picks[-1] + 1, step)
+    return picks
+
+
+class EpochViews:
+    """Epochs as views of the data of their raw object.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs created with ``preload=False`` from a raw object whose data
+        are loaded (possibly memory-mapped). Bad epochs are dropped.
+    """
+
+    def __init__(self, epochs):
+        raw = epochs._raw
+        if epochs.preload or raw is None or not raw.preload:
+            raise ValueError('Epoch views need epochs that are not preloaded '
+                             'from a raw object whose data are loaded.')
+        if epochs.detrend is not None or (
+                epochs._projector is not None and not epochs._do_delayed_proj):
+            raise ValueError('Epoch views do not support detrending and '
+                             'projections.')
+        epochs.drop_bad()
+
+        self.epochs = epochs
+        sfreq = raw.info['sfreq']
+        self.starts = np.array(
+            [int(round(sample + epochs._raw_times[0] * sfreq))
+             for sample in epochs.events[:, 0]], dtype=int) - raw.first_samp
+        self._channels = _as_slice(epochs.picks)
+        # (n_channels, n_positions, n_times) view of all windows of the
+        # recording, read-only
+        self._windows = sliding_window_view(
+            raw._data, len(epochs._raw_times), axis=-1)
+        logger.info(f'Using views of the raw data for {len(self)} epochs')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        """Data of one epoch, shape (n_channels, n_times).
+
+        A read-only view of the raw data, unless the epochs are baseline
+        corrected.
+        """
+        epoch = self._windows[self._channels, self.starts[idx]]
+        if self.epochs._do_baseline and self.epochs.baseline is not None:
+            # like mne, the baseline is computed before decimation
+            epoch = rescale(epoch, self.epochs._raw_times,
+                            self.epochs.baseline,
+                            picks=self.epochs._detrend_picks, copy=True,
+                            verbose=False)
+        return epoch[:, self.epochs._decim_slice]
+
+    @property
+    def info(self):
+        return self.epochs.info
+
+    @property
+    def times(self):
+        return self.epochs.times
+
+    def get_data(self, item=None):
+        """Copy of the data of the epochs (all or ``item``)."""
+        indices = np.arange(len(self))[slice(None) if item is None else item]
+        data = np.empty((len(indices), len(self.info['ch_names']),
+                         len(self.times)))
+        for position, idx in enumerate(indices):
+            data[position] = self[idx]
+        return data
+
+    def save(self, fname, overwrite=False):
+        """Write the epochs to a .fif file, one epoch at a time.
+
+        The file is the same as that of ``Epochs.save`` (single precision,
+        not split into several files).
+        """
+        fname = _check_fname(fname, overwrite=overwrite)
+        epochs = self.epochs
+        info = epochs.info
+        n_channels, n_times = len(info['ch_names']), len(self.times)
+        # the data tag has to fit into 2 GB
+        data_size = 4 * len(self) * n_channels * n_times + 4 * 4
+        if data_size > INT32_MAX:
+            raise ValueError(f'{len(self)} epochs are too large for a single '
+                             f'file, use Epochs.save instead.')
+        decal = np.array([1. / (ch['cal'] * ch.get('scale', 1.))
+                          for ch in info['chs']])[:, np.newaxis]
+
+        with start_and_end_file(fname) as fid:
+            start_block(fid, FIFF.FIFFB_MEAS)
+            write_id(fid, FIFF.FIFF_BLOCK_ID)
+            if info['meas_id'] is not None:
+                write_id(fid, FIFF.FIFF_PARENT_BLOCK_ID, info['meas_id'])
+            write_meas_info(fid, info)
+
+            start_block(fid, FIFF.FIFFB_PROCESSED_DATA)
+            start_block(fid, FIFF.FIFFB_MNE_EPOCHS)
+            if epochs.annotations is not None and len(epochs.annotations):
+                _write_annotations(fid, epochs.annotations)
+
+            start_block(fid, FIFF.FIFFB_MNE_EVENTS)
+            write_int(fid, FIFF.FIFF_MNE_EVENT_LIST, epochs.events.T)
+            write_string(fid, FIFF.FIFF_DESCRIPTION,
+                         _event_id_string(epochs.event_id))
+            end_block(fid, FIFF.FIFFB_MNE_EVENTS)
+
+            if epochs.metadata is not None:
+                start_block(fid, FIFF.FIFFB_MNE_METADATA)
+                write_string(fid, FIFF.FIFF_DESCRIPTION,
+                             _prepare_write_metadata(epochs.metadata))
+                end_block(fid, FIFF.FIFFB_MNE_METADATA)
+
+            first = int(round(epochs.tmin * info['sfreq']))
+            write_int(fid, FIFF.FIFF_FIRST_SAMPLE, first)
+            write_int(fid, FIFF.FIFF_LAST_SAMPLE, first + n_times - 1)
+            write_float(fid, FIFF.FIFF_MNE_EPOCHS_RAW_SFREQ,
+                        epochs._raw_sfreq)
+            if epochs.baseline is not None:
+                write_float(fid, FIFF.FIFF_MNE_BASELINE_MIN,
+                            epochs.baseline[0])
+                write_float(fid, FIFF.FIFF_MNE_BASELINE_MAX,
+                            epochs.baseline[1])
+
+            # matrix tag of shape (n_epochs, n_channels, n_times), written
+            # epoch by epoch
+            fid.write(np.array([FIFF.FIFF_EPOCH,
+                                FIFF.FIFFT_FLOAT | FIFF.FIFFT_MATRIX,
+                                data_size, FIFF.FIFFV_NEXT_SEQ],
+                               dtype='>i4').tobytes())
+            for epoch in self:
+                fid.write((epoch * decal).astype('>f4').tobytes())
+            fid.write(np.array([n_times, n_channels, len(self), 3],
+                               dtype='>i4').tobytes())
+            check_fiff_length(fid)
+
+            write_string(fid, FIFF.FIFF_MNE_EPOCHS_DROP_LOG,
+                         json.dumps(epochs.drop_log))
+            reject_params = _pack_reject_params(epochs)
+            if reject_params:
+                write_string(fid, FIFF.FIFF_MNE_EPOCHS_REJECT_FLAT,
+                             json.dumps(reject_params))
+            write_int(fid, FIFF.FIFF_MNE_EPOCHS_SELECTION, epochs.selection)
+
+            end_block(fid, FIFF.FIFFB_MNE_EPOCHS)
+            end_block(fid, FIFF.FIFFB_PROCESSED_DATA)
+            end_block(fid, FIFF.FIFFB_MEAS)
@@ -0,0 +1,81 @@
+"""Metadata of DPX trials.
+
+Builds the metadata of the cue epochs (and the RT table) from the recoded
+cue and probe events with vectorized NumPy operations (look-up tables of
+the event labels), pandas is only used for the resulting data frame.
+"""
+import numpy as np
+import pandas as pd
+
+from config import cue_event_id, probe_event_id
+
+
+def _split_labels(codes, event_id):
+    """Split event labels such as 'Correct AX' into response and stimulus."""
+    codes = np.asarray(codes, dtype=int)
+    # look-up tables from event code to response and stimulus
+    responses = np.full(max(event_id.values()) + 1, None, dtype=object)
+    stimuli = responses.copy()
+    for label, code in event_id.items():
+        responses[code], stimuli[code] = label.split(' ')
+    known = np.isin(codes, list(event_id.values()))
+    if not known.all():
+        raise ValueError(f"Unknown event codes: {np.unique(codes[~known])}")
+    return responses[codes], stimuli[codes]
+
+
+def build_metadata(cue_codes, probe_codes, block, rt, broken=()):
+    """Build the metadata of DPX trials.
+
+    Parameters
+    ----------
+    cue_codes, probe_codes : array of int
+        Recoded cue and probe events (see ``cue_event_id`` and
+        ``probe_event_id`` in ``config.py``), one per trial.
+    block : array of int
+        Block of each trial, including broken trials.
+    rt : array of float
+        Reaction time of each trial, including broken trials.
+    broken : list of int
+        Trials without probe, which are removed from ``block`` and ``rt``.
+
+    Returns
+    -------
+    metadata : pd.DataFrame
+        One row per trial with the columns ``block``, ``trial``, ``cue``,
+        ``probe``, ``run`` (number of preceding correct trials with the same
+        probe), ``reaction_cues``, ``reaction_probes``, ``cond_reaction`` (the
+        condition the reaction corresponds to) and ``rt``.
+    """
+    reaction_cues, cues = _split_labels(cue_codes, cue_event_id)
+    reaction_probes, probes = _split_labels(probe_codes, probe_event_id)
+
+    # condition the reaction corresponds to: the probe itself for correct
+    # reactions, the one with the other button for incorrect reactions
+    correct = reaction_probes == 'Correct'
+    incorrect = reaction_probes == 'Incorrect'
+    cond_reaction = np.full(len(probes), np.nan, dtype=object)
+    cond_reaction[correct] = probes[correct]
+    cond_reaction[incorrect & (probes == 'AX')] = 'AY'
+    cond_reaction[incorrect & np.isin(probes, ['BX', 'BY', 'AY'])] = 'AX'
+
+    # streaks of correct trials with the same probe: the counter goes up
+    # when the probe is the same as in the previous trial and both were
+    # answered correctly, otherwise it starts over at 0 (the count at the
+    # last reset is subtracted from the running count)
+    same = np.zeros(len(probes), dtype=bool)
+    same[1:] = (probes[1:] == probes[:-1]) & correct[1:] & correct[:-1]
+    count = np.cumsum(same)
+    run = count - np.maximum.accumulate(np.where(same, 0, count))
+
+    return pd.DataFrame({
+        'block': np.delete(block, broken, 0),
+        'trial': np.delete(np.arange(0, len(rt)), broken, 0),
+        'cue': cues,
+        'probe': probes,
+        'run': run,
+        'reaction_cues': reaction_cues,
+        'reaction_probes': reaction_probes,
+        'cond_reaction': cond_reaction,
+        'rt': np.delete(rt, broken, 0),
+    })
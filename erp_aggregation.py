@@ -0,0 +1,282 @@
+"""Streaming aggregation of ERPs.
+
+The epochs of a subject are read from disk in chunks (``preload=False``), and
+a running count, mean and sum of squared deviations (Welford's algorithm, in
+the form for merging chunks) is kept for each condition, so only one chunk of
+epochs is in memory at a time. The conditions are combinations of metadata
+columns (see ``ERP_CONDITIONS`` in ``config.py``), e.g., ``Correct AX``.
+
+The grand average is the mean of the subject averages. It is kept as running
+statistics over subjects in ``derivatives/erps/grand_average``, together
+with the subject averages it contains. When a subject is added or
+reprocessed, only that subject is added (or its old average removed first),
+so memory and time do not depend on the size of the cohort.
+"""
+import os
+import shutil
+
+from uuid import uuid4
+
+import numpy as np
+
+from mne import EvokedArray, pick_info, read_epochs, write_evokeds
+from mne.io import read_info
+from mne.utils import logger
+
+from config import ERP_CONDITIONS
+
+from layout import get_dir, get_fname
+
+from utils import write_json
+
+
+class RunningStats:
+    """Running count, mean and sum of squared deviations per condition."""
+
+    def __init__(self):
+        self.n = {}
+        self.mean = {}
+        self.m2 = {}
+
+    @property
+    def labels(self):
+        return sorted(self.n)
+
+    def add(self, label, n, mean, m2=0.):
+        """Add ``n`` observations with mean ``mean`` and deviations ``m2``."""
+        if n == 0:
+            return
+        if self.n.get(label, 0) == 0:
+            self.n[label] = n
+            self.mean[label] = np.array(mean, dtype=np.float64)
+            self.m2[label] = np.zeros_like(self.mean[label]) + m2
+            return
+        n_a = self.n[label]
+        n_ab = n_a + n
+        delta = mean - self.mean[label]
+        self.mean[label] += delta * (n / n_ab)
+        self.m2[label] += m2 + delta ** 2 * (n_a * n / n_ab)
+        self.n[label] = n_ab
+
+    def remove(self, label, n, mean, m2=0.):
+        """Remove observations that were added with ``add``."""
+        n_ab = self.n[label]
+        n_a = n_ab - n
+        if n_a <= 0:
+            for stats in (self.n, self.mean, self.m2):
+                del stats[label]
+            return
+        mean_a = (self.mean[label] * n_ab - mean * n) / n_a
+        delta = mean - mean_a
+        self.m2[label] -= m2 + delta ** 2 * (n_a * n / n_ab)
+        # rounding errors must not lead to negative variances
+        np.maximum(self.m2[label], 0., out=self.m2[label])
+        self.mean[label] = mean_a
+        self.n[label] = n_a
+
+    def update(self, label, data):
+        """Add observations, ``data`` has shape ``(n, ...)``."""
+        mean = data.mean(axis=0)
+        self.add(label, len(data), mean, ((data - mean) ** 2).sum(axis=0))
+
+    def sem(self, label):
+        """Standard error of the mean (NaN with fewer than 2 observations)."""
+        n = self.n[label]
+        if n < 2:
+            return np.full_like(self.mean[label], np.nan)
+        return np.sqrt(self.m2[label] / (n - 1) / n)
+
+    def save(self, fname, **extra):
+        """Write the statistics to a .npz file (atomically)."""
+        labels = self.labels
+        tmp = os.path.join(os.path.dirname(fname), f'.tmp-{uuid4().hex}.npz')
+        np.savez(tmp,
+                 labels=np.array(labels, dtype=str),
+                 n=np.array([self.n[label] for label in labels]),
+                 mean=np.array([self.mean[label] for label in labels]),
+                 m2=np.array([self.m2[label] for label in labels]),
+                 **extra)
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Read statistics written with ``save``."""
+        stats = cls()
+        with np.load(fname) as saved:
+            for label, n, mean, m2 in zip(saved['labels'].tolist(),
+                                          saved['n'], saved['mean'],
+                                          saved['m2']):
+                stats.n[label] = int(n)
+                stats.mean[label] = mean
+                stats.m2[label] = m2
+        return stats
+
+
+def condition_labels(metadata, conditions=None):
+    """Condition(s) of each epoch, e.g., ``Correct AX`` and ``Correct A``.
+
+    Returns
+    -------
+    labels : list of pd.Series
+        One series per entry of ``conditions`` (default: ``ERP_CONDITIONS``),
+        NaN where a column of the condition is missing.
+    """
+    conditions = ERP_CONDITIONS if conditions is None else conditions
+    labels = []
+    for columns in conditions:
+        values = metadata[list(columns)]
+        label = values.astype(str).agg(' '.join, axis=1)
+        labels.append(label.where(values.notna().all(axis=1)))
+    return labels
+
+
+def subject_stats(fname, conditions=None, chunk_size=32):
+    """Statistics of the epochs of a subject, read chunk by chunk.
+
+    Returns
+    -------
+    stats : RunningStats
+        Statistics of the epochs of each condition.
+    info : mne.Info
+        Measurement info of the epochs.
+    tmin : float
+        Start of the epochs.
+    """
+    epochs = read_epochs(fname, preload=False, verbose=False)
+    labels = condition_labels(epochs.metadata, conditions)
+
+    stats = RunningStats()
+    for start in range(0, len(epochs), chunk_size):
+        stop = min(start + chunk_size, len(epochs))
+        data = epochs[start:stop].get_data()
+        for label in labels:
+            chunk = label.iloc[start:stop].to_numpy()
+            for name in np.unique(chunk[chunk == chunk]):
+                stats.update(name, data[chunk == name])
+
+    return stats, epochs.info, epochs.tmin
+
+
+def _evokeds(stats, info, tmin, values=None):
+    """One evoked per condition (``values`` default to the means)."""
+    values = stats.mean if values is None else values
+    return [EvokedArray(values[label], info, tmin=tmin, comment=label,
+                        nave=stats.n[label], verbose=False)
+            for label in stats.labels]
+
+
+def aggregate_subject(subj, conditions=None, chunk_size=32):
+    """Write the condition ERPs of a subject and their statistics.
+
+    Returns
+    -------
+    stats : RunningStats
+        Statistics of the epochs of each condition.
+    """
+    stats, info, tmin = subject_stats(get_fname('epochs', subj), conditions,
+                                      chunk_size)
+    write_evokeds(get_fname('erps', subj, make_dirs=True),
+                  _evokeds(stats, info, tmin), overwrite=True, verbose=False)
+    stats.save(get_fname('erp_stats', subj), ch_names=info.ch_names,
+               tmin=tmin)
+    return stats
+
+
+def update_grand_average(subjects):
+    """Add new or reprocessed subjects to the grand average.
+
+    Subjects whose ERPs are missing are removed from it.
+
+    Parameters
+    ----------
+    subjects : list of int
+        The subjects of the cohort.
+
+    Returns
+    -------
+    changed : list of int
+        Subjects that were added, updated or removed.
+    """
+    # not make_dirs, the directory is removed by reset_grand_average
+    os.makedirs(get_dir('grand_average'), exist_ok=True)
+    state_fname = get_fname('grand_average_state')
+
+    if os.path.exists(state_fname):
+        stats = RunningStats.load(state_fname)
+        with np.load(state_fname) as state:
+            included = dict(zip(state['subjects'].tolist(),
+                                state['mtimes'].tolist()))
+            ch_names = state['ch_names'].tolist()
+            tmin = float(state['tmin'])
+    else:
+        stats, included, ch_names, tmin = RunningStats(), {}, None, None
+
+    changed = []
+    for subj in subjects:
+        fname = get_fname('erp_stats', subj)
+        mtime = os.stat(fname).st_mtime if os.path.exists(fname) else None
+        if included.get(subj) == mtime:
+            continue
+
+        # the subject average as it was added to the grand average
+        contribution = get_fname('grand_average_subject', subj)
+        if subj in included:
+            old = RunningStats.load(contribution)
+            for label in old.labels:
+                stats.remove(label, 1, old.mean[label])
+            os.remove(contribution)
+            del included[subj]
+
+        if mtime is not None:
+            with np.load(fname) as subject:
+                # the order of the channels of the first subject is used
+                if not ch_names:
+                    ch_names = subject['ch_names'].tolist()
+                    tmin = float(subject['tmin'])
+                order = [subject['ch_names'].tolist().index(name)
+                         for name in ch_names]
+            new = RunningStats.load(fname)
+            for label in new.labels:
+                new.mean[label] = new.mean[label][order]
+                stats.add(label, 1, new.mean[label])
+            new.n = {label: 1 for label in new.labels}
+            new.save(contribution)
+            included[subj] = mtime
+        changed.append(subj)
+
+    if not changed:
+        return changed
+
+    names = sorted(included)
+    stats.save(state_fname,
+               subjects=np.array(names, dtype=int),
+               mtimes=np.array([included[subj] for subj in names]),
+               ch_names=np.array(ch_names or [], dtype=str),
+               tmin=tmin if tmin is not None else np.nan)
+
+    # the grand average and its standard error
+    if stats.labels:
+        info = read_info(get_fname('erps', names[0]), verbose=False)
+        info = pick_info(info, [info.ch_names.index(name)
+                                for name in ch_names])
+        write_evokeds(get_fname('grand_average'),
+                      _evokeds(stats, info, tmin), overwrite=True,
+                      verbose=False)
+        write_evokeds(get_fname('grand_average_sem'),
+                      _evokeds(stats, info, tmin,
+                               {label: stats.sem(label)
+                                for label in stats.labels}),
+                      overwrite=True, verbose=False)
+    write_json(get_fname('grand_average_subjects'),
+               dict(subjects=names,
+                    n_subjects={label: stats.n[label]
+                                for label in stats.labels}))
+    logger.info(f"    > Grand average of {len(names)} subjects "
+                f"({len(changed)} changed)")
+
+    return changed
+
+
+def reset_grand_average():
+    """Remove the grand average, it is rebuilt on the next update."""
+    shutil.rmtree(get_dir('grand_average'), ignore_errors=True)
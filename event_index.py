@@ -0,0 +1,273 @@
+"""Index of the trials of all subjects.
+
+``02_extract_epochs.py`` writes the trials of each subject (one row per
+trial: recoded cue and probe, outcome, condition, block, onset, RT and the
+position of the trial in the epochs file) to a small per-subject file in
+``derivatives/event_index``. All columns are integer-coded (RTs in ms as
+floats), see ``OUTCOMES``, ``CONDITIONS`` and ``CUES``.
+
+``load_event_index`` merges these files into a single index
+(``derivatives/event_index/event_index.npz``), sorted by subject and onset.
+Only subject files that changed since the index was last written are read
+again. The index keeps the rows of each combination of outcome and condition
+together (a secondary index), so that selecting, e.g., all correct AY trials
+of the cohort is a slice, and a query takes microseconds::
+
+    index = load_event_index()
+    rows = index.select(outcome='Correct', condition='AY', rt_max=300)
+    for subj, epochs in index.epochs(rows).items():
+        ...  # read_epochs(get_fname('epochs', subj))[epochs]
+"""
+import os
+
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+
+from config import cue_event_id, probe_event_id
+
+from layout import get_dir, get_fname
+
+OUTCOMES = ('Correct', 'Incorrect', 'Missed', 'Too_soon')
+CONDITIONS = ('AX', 'AY', 'BX', 'BY', 'X', 'Y')
+CUES = ('A', 'B')
+
+# columns of the index
+DTYPE = np.dtype([
+    ('subject', np.int16),
+    ('trial', np.int16),
+    # position in the epochs file, -1 if the epoch was dropped
+    ('epoch', np.int16),
+    ('block', np.int8),
+    ('cue', np.int8),
+    ('outcome', np.int8),
+    ('condition', np.int8),
+    # recoded events (see ``cue_event_id`` and ``probe_event_id``)
+    ('cue_code', np.int16),
+    ('probe_code', np.int16),
+    # onset of the cue in ms from the start of the recording
+    ('onset', np.int32),
+    # reaction time in ms, NaN without (valid) reaction
+    ('rt', np.float32),
+])
+
+
+def _codes(labels, values):
+    """Integer codes of ``labels`` (positions in ``values``)."""
+    return np.array([values.index(label) for label in labels], dtype=np.int8)
+
+
+def subject_events(subj, cue_events, probe_events, metadata, selection,
+                   first_samp, sfreq):
+    """Rows of the index for the trials of a subject.
+
+    Parameters
+    ----------
+    subj : int
+        The subject.
+    cue_events, probe_events : array of int, shape (n_trials, 3)
+        The recoded cue and probe events, one per trial.
+    metadata : pd.DataFrame
+        Metadata of the trials (see ``build_metadata``).
+    selection : array of int
+        Trials that were kept in the epochs file (``epochs.selection``).
+    first_samp : int
+        First sample of the recording.
+    sfreq : float
+        Sampling rate of the recording.
+    """
+    cue_labels = {val: key for key, val in cue_event_id.items()}
+    probe_labels = {val: key for key, val in probe_event_id.items()}
+    cues = [cue_labels[code].split(' ')[1] for code in cue_events[:, 2]]
+    probes = [probe_labels[code].split(' ') for code in probe_events[:, 2]]
+
+    rows = np.zeros(len(cue_events), dtype=DTYPE)
+    rows['subject'] = subj
+    rows['trial'] = metadata.trial
+    rows['epoch'] = -1
+    rows['epoch'][np.asarray(selection, dtype=int)] = np.arange(len(selection))
+    rows['block'] = metadata.block
+    rows['cue'] = _codes(cues, CUES)
+    rows['outcome'] = _codes([outcome for outcome, _ in probes], OUTCOMES)
+    rows['condition'] = _codes([condition for _, condition in probes],
+                               CONDITIONS)
+    rows['cue_code'] = cue_events[:, 2]
+    rows['probe_code'] = probe_events[:, 2]
+    rows['onset'] = np.round((cue_events[:, 0] - first_samp) / sfreq * 1e3)
+    # missed reactions are coded as 99999 s in the metadata
+    rt = metadata.rt.to_numpy(dtype=float) * 1e3
+    rt[rt >= 99999e3] = np.nan
+    rows['rt'] = rt
+
+    return np.sort(rows, order='onset', kind='stable')
+
+
+def _save(fname, **arrays):
+    """Write a .npz file atomically."""
+    fname = str(fname)
+    # hidden, so that it is not taken for a subject file
+    tmp = os.path.join(os.path.dirname(fname), f'.tmp-{uuid4().hex}.npz')
+    np.savez(tmp, **arrays)
+    os.replace(tmp, fname)
+
+
+def write_subject_events(subj, rows):
+    """Write the rows of a subject (see ``subject_events``)."""
+    _save(get_fname('event_index', subj, make_dirs=True), rows=rows)
+
+
+class EventIndex:
+    """Trials of the cohort, sorted by subject and onset.
+
+    Parameters
+    ----------
+    rows : structured array
+        The trials, see ``DTYPE``.
+    order, starts : array of int | None
+        The secondary index: ``order[starts[key]:starts[key + 1]]`` are the
+        rows with ``outcome * len(CONDITIONS) + condition == key``, in the
+        order of the index. Computed if None.
+    """
+
+    def __init__(self, rows, order=None, starts=None):
+        self.rows = rows
+        if order is None:
+            keys = self._keys(rows['outcome'], rows['condition'])
+            order = np.argsort(keys, kind='stable')
+            counts = np.bincount(keys,
+                                 minlength=len(OUTCOMES) * len(CONDITIONS))
+            starts = np.concatenate([[0], np.cumsum(counts)])
+        self.order = order
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def _keys(outcome, condition):
+        return np.asarray(outcome, dtype=np.intp) * len(CONDITIONS) \
+            + np.asarray(condition, dtype=np.intp)
+
+    def select(self, outcome=None, condition=None, subjects=None,
+               block=None, rt_min=None, rt_max=None, kept=False):
+        """Positions of the rows that match all criteria.
+
+        Parameters
+        ----------
+        outcome, condition : str | list of str | None
+            Outcomes (see ``OUTCOMES``) and conditions (see ``CONDITIONS``)
+            to select (default: all).
+        subjects : list of int | None
+            Subjects to select (default: all).
+        block : int | None
+            Block to select (default: both).
+        rt_min, rt_max : float | None
+            Range of reaction times (in ms, inclusive). Trials without RT
+            are excluded if given.
+        kept : bool
+            Only trials that were kept in the epochs files.
+
+        Returns
+        -------
+        rows : array of int
+            Positions in ``rows``, in the order of the index.
+        """
+        if outcome is None and condition is None:
+            rows = np.arange(len(self.rows))
+        else:
+            outcomes = OUTCOMES if outcome is None \
+                else np.atleast_1d(outcome).tolist()
+            conditions = CONDITIONS if condition is None \
+                else np.atleast_1d(condition).tolist()
+            keys = self._keys(_codes(outcomes, OUTCOMES)[:, np.newaxis],
+                              _codes(conditions, CONDITIONS)[np.newaxis])
+            rows = [self.order[self.starts[key]:self.starts[key + 1]]
+                    for key in np.sort(keys, axis=None)]
+            rows = rows[0] if len(rows) == 1 else np.sort(np.concatenate(rows))
+
+        mask = np.ones(len(rows), dtype=bool)
+        selected = self.rows[rows]
+        if subjects is not None:
+            mask &= np.isin(selected['subject'], subjects)
+        if block is not None:
+            mask &= selected['block'] == block
+        if rt_min is not None:
+            mask &= selected['rt'] >= rt_min
+        if rt_max is not None:
+            mask &= selected['rt'] <= rt_max
+        if kept:
+            mask &= selected['epoch'] >= 0
+        return rows if mask.all() else rows[mask]
+
+    def epochs(self, rows):
+        """Epochs to read for the selected rows.
+
+        Returns
+        -------
+        epochs : dict
+            Subject -> positions of the epochs in its epochs file (see
+            ``get_fname('epochs', subj)``). Dropped trials are left out.
+        """
+        selected = self.rows[rows]
+        selected = selected[selected['epoch'] >= 0]
+        subjects, starts = np.unique(selected['subject'], return_index=True)
+        return {int(subj): epochs for subj, epochs
+                in zip(subjects, np.split(selected['epoch'], starts[1:]))}
+
+    def to_frame(self, rows=None):
+        """The (selected) rows as a data frame with labels."""
+        rows = self.rows if rows is None else self.rows[rows]
+        frame = pd.DataFrame(rows)
+        for column, labels in (('cue', CUES), ('outcome', OUTCOMES),
+                               ('condition', CONDITIONS)):
+            frame[column] = pd.Categorical.from_codes(frame[column], labels)
+        return frame
+
+
+def load_event_index(root=None):
+    """Trials of all subjects (see ``EventIndex``)."""
+    root = get_dir('event_index') if root is None else root
+    index_fname = os.path.join(
+        root, os.path.basename(get_fname('event_index_cohort')))
+
+    try:
+        with np.load(index_fname) as index:
+            index = {key: index[key] for key in index.files}
+        mtimes = dict(zip(index['names'].tolist(), index['mtimes'].tolist()))
+    except (FileNotFoundError, ValueError, KeyError):
+        index, mtimes = None, {}
+
+    # only read subject files that changed since the index was written
+    found = {}
+    if os.path.exists(root):
+        for entry in os.scandir(root):
+            if entry.name.startswith('sub-') and entry.name.endswith('.npz'):
+                found[entry.name] = entry.stat().st_mtime
+
+    if index is not None and found == mtimes:
+        return EventIndex(index['rows'], index['order'], index['starts'])
+
+    parts = {}
+    if index is not None:
+        rows = index['rows']
+        subjects, starts = np.unique(rows['subject'], return_index=True)
+        for subj, part in zip(subjects, np.split(rows, starts[1:])):
+            name = os.path.basename(get_fname('event_index', subj))
+            if found.get(name) == mtimes.get(name):
+                parts[name] = part
+    for name in found:
+        if name not in parts:
+            with np.load(os.path.join(root, name)) as part:
+                parts[name] = part['rows']
+
+    # file names sort by subject
+    rows = np.concatenate([parts[name] for name in sorted(parts)]) \
+        if parts else np.zeros(0, dtype=DTYPE)
+    index = EventIndex(rows)
+    if os.path.exists(root):
+        names = sorted(found)
+        _save(index_fname, rows=index.rows, order=index.order,
+              starts=index.starts, names=np.array(names, dtype=str),
+              mtimes=np.array([found[name] for name in names]))
+    return index
@@ -0,0 +1,144 @@
+"""ICA solvers of the preprocessing.
+
+The solvers are set up in ``ICA_METHODS`` (see ``config.py``): extended
+infomax (the original setting), Picard with ``extended=True`` and
+``ortho=False``, which fits the same model as extended infomax and usually
+converges in far fewer iterations, and FastICA. ``make_ica`` translates a
+common tolerance to the parameter of each solver.
+
+An ICA can be fitted on the PCA whitening of another ICA of the same data
+(``fit_ica(..., whitening=ica)``). The data are then projected onto the
+stored PCA instead of computing a new one, and all solvers work on the same
+whitened data, which is what a comparison of solvers needs.
+"""
+import time
+
+import numpy as np
+
+from mne.preprocessing import ICA, infomax
+from mne.utils import logger, _reject_data_segments
+
+from config import ICA_METHODS
+
+# name of the stopping tolerance of each solver
+_TOLERANCES = {'infomax': 'w_change', 'picard': 'tol', 'fastica': 'tol'}
+
+
+def make_ica(method='infomax', n_components=0.951, max_iter='auto', tol=None,
+             random_state=None):
+    """Set up an ICA with one of ``ICA_METHODS``.
+
+    Parameters
+    ----------
+    method : str
+        Key of ``ICA_METHODS``.
+    n_components : int | float
+        Number of components, or fraction of variance they explain.
+    max_iter : int | 'auto'
+        Maximum number of iterations of the solver.
+    tol : float | None
+        Stopping tolerance of the solver (default of the solver if None).
+    random_state : int | None
+        Seed of the solver.
+    """
+    if method not in ICA_METHODS:
+        raise ValueError(f"Unknown ICA method '{method}', use one of "
+                         f"{list(ICA_METHODS)}.")
+    params = ICA_METHODS[method]
+    fit_params = dict(params.get('fit_params', {}))
+    if tol is not None:
+        fit_params[_TOLERANCES[params['method']]] = tol
+    return ICA(n_components=n_components,
+               method=params['method'],
+               fit_params=fit_params,
+               max_iter=max_iter,
+               random_state=random_state)
+
+
+def _whitened_data(whitening, raw, reject, tstep=2.):
+    """Data of ``raw`` projected onto the PCA of a fitted ICA."""
+    data = raw.get_data(picks=whitening.ch_names,
+                        reject_by_annotation='omit')
+    if reject is not None:
+        data, _ = _reject_data_segments(data, reject, None, None,
+                                        whitening.info, tstep)
+    data = whitening._pre_whiten(data)
+    data -= whitening.pca_mean_[:, np.newaxis]
+    n_components = whitening.n_components_
+    norms = np.sqrt(whitening.pca_explained_variance_[:n_components])
+    return (whitening.pca_components_[:n_components] @ data).T / norms, norms
+
+
+def _solve(ica, data):
+    """Unmixing matrix and number of iterations of the solver of ``ica``."""
+    random_state = ica.random_state
+    if ica.method == 'infomax':
+        return infomax(data, random_state=random_state, return_n_iter=True,
+                       **ica.fit_params)
+    if ica.method == 'picard':
+        from picard import picard
+        _, unmixing, _, n_iter = picard(data.T, whiten=False,
+                                        return_n_iter=True,
+                                        random_state=random_state,
+                                        **ica.fit_params)
+        return unmixing, n_iter + 1
+    if ica.method == 'fastica':
+        from sklearn.decomposition import FastICA
+        solver = FastICA(whiten=False, random_state=random_state,
+                         **ica.fit_params)
+        solver.fit(data)
+        return solver.components_, solver.n_iter_
+    raise ValueError(f"Cannot reuse the whitening with '{ica.method}'.")
+
+
+def fit_ica(ica, raw, reject=None, whitening=None):
+    """Fit an ICA (see ``make_ica``) on continuous data.
+
+    Parameters
+    ----------
+    ica : mne.preprocessing.ICA
+        The ICA.
+    raw : mne.io.Raw
+        The data.
+    reject : dict | None
+        Rejection thresholds of data segments.
+    whitening : mne.preprocessing.ICA | None
+        An ICA fitted on the same data whose PCA whitening (and number of
+        components) is used instead of computing a new one.
+
+    Returns
+    -------
+    ica : mne.preprocessing.ICA
+        The fitted ICA (a new object if ``whitening`` is given).
+    fit_info : dict
+        ``seconds`` the fit took, number of iterations (``n_iter``), the
+        maximum (``max_iter``) and whether the solver ``converged`` before
+        reaching it.
+    """
+    start = time.time()
+    if whitening is None:
+        ica.fit(raw, reject=reject, reject_by_annotation=True)
+    else:
+        data, norms = _whitened_data(whitening, raw, reject)
+        fitted = whitening.copy()
+        fitted.method = ica.method
+        fitted.fit_params = ica.fit_params
+        fitted.max_iter = ica.max_iter
+        fitted.random_state = ica.random_state
+        unmixing, n_iter = _solve(fitted, data)
+        # same scaling as ``ICA.fit``
+        fitted.unmixing_matrix_ = unmixing / norms
+        fitted._update_mixing_matrix()
+        fitted.n_iter_ = n_iter
+        fitted.exclude = []
+        fitted.labels_ = dict()
+        ica = fitted
+
+    fit_info = dict(seconds=time.time() - start,
+                    n_iter=int(ica.n_iter_),
+                    max_iter=int(ica.max_iter),
+                    converged=bool(ica.n_iter_ < ica.max_iter))
+    if not fit_info['converged']:
+        logger.info(f"    > ICA ({ica.method}) did not converge in "
+                    f"{ica.max_iter} iterations")
+    return ica, fit_info
@@ -0,0 +1,104 @@
+"""Cache of spherical-spline interpolation matrices.
+
+All subjects are recorded with the same montage, and many of them end up
+with the same bad channels, but mne computes the interpolation matrix
+(evaluation of the Legendre series and inversion of the spline matrix) anew
+for every call of ``interpolate_bads()``, also in the robust referencing of
+PREP, which interpolates several times per subject.
+
+``InterpolationCache`` keeps the matrices in memory and, optionally, on disk,
+keyed by the positions of the good and bad channels (relative to the origin
+of the head), the regularization and the version of mne. Within
+``cached_interpolation(cache)``, every spherical-spline interpolation of mne,
+including those of PREP, uses the cache. The matrices are the ones mne would
+compute, so results do not change.
+"""
+import os
+import hashlib
+
+from contextlib import contextmanager
+from uuid import uuid4
+
+import numpy as np
+
+import mne
+from mne.channels import interpolation as mne_interpolation
+
+from pyprep import ransac
+
+# the function of mne that computes the matrices
+_make_interpolation_matrix = mne_interpolation._make_interpolation_matrix
+
+# modules that call it (RANSAC imports it by name)
+_CALLERS = (mne_interpolation, ransac)
+
+
+class InterpolationCache:
+    """Spherical-spline interpolation matrices, computed once.
+
+    Parameters
+    ----------
+    root : str | Path | None
+        Directory of the cache on disk, shared by subjects and runs. If None,
+        matrices are only kept in memory.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self.matrices = {}
+        self.hits = 0
+        self.misses = 0
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(pos_from, pos_to, alpha):
+        """Key of the matrix that maps ``pos_from`` to ``pos_to``."""
+        key = hashlib.sha1()
+        for pos in (pos_from, pos_to):
+            pos = np.ascontiguousarray(pos, dtype=np.float64)
+            key.update(str(pos.shape).encode())
+            key.update(pos.tobytes())
+        key.update(f'{alpha!r}-{mne.__version__}'.encode())
+        return key.hexdigest()
+
+    def get(self, pos_from, pos_to, alpha=1e-5):
+        """Interpolation matrix, shape ``(len(pos_to), len(pos_from))``."""
+        key = self.key(pos_from, pos_to, alpha)
+        if key in self.matrices:
+            self.hits += 1
+            return self.matrices[key]
+
+        fname = None if self.root is None \
+            else os.path.join(self.root, key + '.npy')
+        try:
+            matrix = np.load(fname)
+            self.hits += 1
+        except (TypeError, FileNotFoundError, ValueError):
+            matrix = _make_interpolation_matrix(pos_from, pos_to, alpha=alpha)
+            self.misses += 1
+            if fname is not None:
+                # write atomically, other subjects may read it concurrently
+                tmp = fname + f'.tmp-{uuid4().hex}.npy'
+                np.save(tmp, matrix)
+                os.replace(tmp, fname)
+
+        # shared by all callers, must not be changed
+        matrix.flags.writeable = False
+        self.matrices[key] = matrix
+        return matrix
+
+
+@contextmanager
+def cached_interpolation(cache):
+    """Use ``cache`` for the spherical-spline interpolations of mne."""
+    def make_interpolation_matrix(pos_from, pos_to, alpha=1e-5):
+        return cache.get(pos_from, pos_to, alpha)
+
+    for module in _CALLERS:
+        module._make_interpolation_matrix = make_interpolation_matrix
+    try:
+        yield cache
+    finally:
+        for module in _CALLERS:
+            module._make_interpolation_matrix = _make_interpolation_matrix
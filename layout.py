@@ -0,0 +1,366 @@
+"""Layout of the source data, the BIDS dataset and the derivatives.
+
+All paths of the pipeline are defined here. The roots come from
+``paths.json`` (see ``config.py``), file names are built with ``get_fname``
+and directories with ``get_dir``.
+
+``Layout`` keeps an index of the files that exist. Each directory is listed
+once with ``os.scandir`` and only listed again when its modification time
+changes, so that checking which inputs and outputs exist for the whole cohort
+costs a handful of system calls instead of one per file, which matters on
+network storage.
+"""
+import os
+import time
+
+from pathlib import Path
+
+import pandas as pd
+
+from mne_bids import BIDSPath
+
+from config import (
+    FPATH_DATA_SOURCEDATA,
+    FPATH_DATA_BIDS,
+    FPATH_DATA_DERIVATIVES
+)
+
+# -----------------------------------------------------------------------------
+# directories
+DIRECTORIES = {
+    'sourcedata': FPATH_DATA_SOURCEDATA,
+    'bids': FPATH_DATA_BIDS,
+    'derivatives': FPATH_DATA_DERIVATIVES,
+    'preprocessing': FPATH_DATA_DERIVATIVES / 'preprocessing',
+    'bad_channels': FPATH_DATA_DERIVATIVES / 'preprocessing' / 'bad_channels',
+    'preprocessed': FPATH_DATA_DERIVATIVES / 'preprocessing' / 'preprocessed',
+    'ica': FPATH_DATA_DERIVATIVES / 'preprocessing' / 'ICA',
+    # signal-quality precheck (see `signal_quality.py`)
+    'precheck': FPATH_DATA_DERIVATIVES / 'precheck',
+    'rt': FPATH_DATA_DERIVATIVES / 'rt',
+    'epochs': FPATH_DATA_DERIVATIVES / 'epochs',
+    # condition ERPs and grand averages (see `erp_aggregation.py`)
+    'erps': FPATH_DATA_DERIVATIVES / 'erps',
+    'grand_average': FPATH_DATA_DERIVATIVES / 'erps' / 'grand_average',
+    # time-frequency decomposition (see `tfr.py`)
+    'tfr': FPATH_DATA_DERIVATIVES / 'tfr',
+    # trials of all subjects (see `event_index.py`)
+    'event_index': FPATH_DATA_DERIVATIVES / 'event_index',
+    # record of pipeline runs (see `manifest.py`)
+    'manifest': FPATH_DATA_DERIVATIVES / 'manifest',
+    # quality-control information of each subject (see `qc_index.py`)
+    'qc': FPATH_DATA_DERIVATIVES / 'qc',
+    # cost estimates and run plans (see `preflight.py`)
+    'preflight': FPATH_DATA_DERIVATIVES / 'preflight',
+    # work queue of distributed runs (see `work_queue.py`)
+    'queue': FPATH_DATA_DERIVATIVES / 'queue',
+    # event logs and metrics of pipeline runs (see `metrics.py`)
+    'metrics': FPATH_DATA_DERIVATIVES / 'metrics',
+    # decoded data of .bdf files (see `decoded_cache.py`)
+    'decoded_cache': FPATH_DATA_DERIVATIVES / 'cache' / 'decoded',
+    # spherical-spline interpolation matrices (see `interpolation.py`)
+    'interpolation_cache': FPATH_DATA_DERIVATIVES / 'cache' / 'interpolation',
+    # temporary files
+    'tmp': FPATH_DATA_DERIVATIVES / 'tmp',
+}
+
+# -----------------------------------------------------------------------------
+# files of each subject (and of the cohort, without ``{subj}``)
+TEMPLATES = {
+    # the biosemi files and demographics in the sourcedata directory
+    'sourcedata': os.path.join(
+        str(FPATH_DATA_SOURCEDATA),
+        "sub-{subj:03}",
+        "eeg",
+        "sub-{subj:03}_dpx_eeg.bdf"
+    ),
+    'demographics': os.path.join(
+        str(FPATH_DATA_SOURCEDATA),
+        "sub-{subj:03}",
+        "demographics",
+        "sub-{subj:03}_dpx_demographics.tsv"
+    ),
+    # the raw data in the BIDS directory
+    'bids': os.path.join(
+        str(FPATH_DATA_BIDS),
+        "sub-{subj:03}",
+        "eeg",
+        "sub-{subj:03}_task-dpx_eeg.bdf"
+    ),
+    'bids_events': os.path.join(
+        str(FPATH_DATA_BIDS),
+        "sub-{subj:03}",
+        "eeg",
+        "sub-{subj:03}_task-dpx_events.tsv"
+    ),
+    # derivatives
+    'precheck': os.path.join(
+        str(DIRECTORIES['precheck']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_precheck.json"
+    ),
+    'precheck_channels': os.path.join(
+        str(DIRECTORIES['precheck']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_precheck_channels.tsv"
+    ),
+    'bad_channels': os.path.join(
+        str(DIRECTORIES['bad_channels']),
+        "sub-{subj:03}",
+        "{subj:03}_bad_channels.json"
+    ),
+    'ica': os.path.join(
+        str(DIRECTORIES['ica']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_ica.fif"
+    ),
+    'ica_figure': os.path.join(
+        str(DIRECTORIES['ica']),
+        "sub-{subj:03}",
+        "{subj:03}_ica_components.png"
+    ),
+    'preprocessed': os.path.join(
+        str(DIRECTORIES['preprocessed']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_preprocessed-raw.fif"
+    ),
+    'rt': os.path.join(
+        str(DIRECTORIES['rt']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_rt.tsv"
+    ),
+    'epochs': os.path.join(
+        str(DIRECTORIES['epochs']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-epo.fif"
+    ),
+    'erps': os.path.join(
+        str(DIRECTORIES['erps']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-ave.fif"
+    ),
+    'erp_stats': os.path.join(
+        str(DIRECTORIES['erps']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-stats.npz"
+    ),
+    'tfr': os.path.join(
+        str(DIRECTORIES['tfr']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-tfr.json"
+    ),
+    'tfr_power': os.path.join(
+        str(DIRECTORIES['tfr']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-power.npy"
+    ),
+    'tfr_itc': os.path.join(
+        str(DIRECTORIES['tfr']),
+        "sub-{subj:03}",
+        "sub-{subj:03}_cue-itc.npy"
+    ),
+    # contribution of a subject to the grand average
+    'grand_average_subject': os.path.join(
+        str(DIRECTORIES['grand_average']),
+        "sub-{subj:03}.npz"
+    ),
+    'event_index': os.path.join(
+        str(DIRECTORIES['event_index']),
+        "sub-{subj:03}_events.npz"
+    ),
+    # quality-control information (see `qc_index.py`)
+    'qc': os.path.join(
+        str(DIRECTORIES['qc']),
+        "sub-{subj:03}.json"
+    ),
+    # temporary, memory-mapped data of the chunked filter
+    'filtered_tmp': os.path.join(
+        str(DIRECTORIES['tmp']),
+        "sub-{subj:03}_filtered.dat"
+    ),
+    # temporary copy of the data before ICA (low-memory mode)
+    'clean_tmp': os.path.join(
+        str(DIRECTORIES['tmp']),
+        "sub-{subj:03}_clean-raw.fif"
+    ),
+    # temporary, memory-mapped preprocessed data (epoch views)
+    'preprocessed_tmp': os.path.join(
+        str(DIRECTORIES['tmp']),
+        "sub-{subj:03}_preprocessed.dat"
+    ),
+    # trials of the cohort (see `event_index.py`)
+    'event_index_cohort': os.path.join(
+        str(DIRECTORIES['event_index']),
+        "event_index.npz"
+    ),
+    # QC index of the cohort (see `qc_index.py`)
+    'qc_index': os.path.join(
+        str(DIRECTORIES['qc']),
+        "qc_index.json"
+    ),
+    # cost estimates and run plan of the cohort (see `preflight.py`)
+    'preflight_recordings': os.path.join(
+        str(DIRECTORIES['preflight']),
+        "recordings.tsv"
+    ),
+    'preflight_cost_model': os.path.join(
+        str(DIRECTORIES['preflight']),
+        "cost_model.tsv"
+    ),
+    'preflight_plan': os.path.join(
+        str(DIRECTORIES['preflight']),
+        "plan.tsv"
+    ),
+    # the grand average of the cohort (see `erp_aggregation.py`)
+    'grand_average_state': os.path.join(
+        str(DIRECTORIES['grand_average']),
+        "state.npz"
+    ),
+    'grand_average': os.path.join(
+        str(DIRECTORIES['grand_average']),
+        "grand_average-ave.fif"
+    ),
+    'grand_average_sem': os.path.join(
+        str(DIRECTORIES['grand_average']),
+        "grand_average_sem-ave.fif"
+    ),
+    'grand_average_subjects': os.path.join(
+        str(DIRECTORIES['grand_average']),
+        "subjects.json"
+    ),
+}
+
+# kinds of files that exist once per subject
+SUBJECT_KINDS = [kind for kind, template in TEMPLATES.items()
+                 if '{subj' in template]
+
+# directories created in this process
+_CREATED = set()
+
+# the index does not look above these directories
+_ROOTS = {str(FPATH_DATA_SOURCEDATA), str(FPATH_DATA_BIDS),
+          str(FPATH_DATA_DERIVATIVES)}
+
+
+def get_dir(kind, make_dirs=False):
+    """Directory of a kind of data (see ``DIRECTORIES``)."""
+    path = DIRECTORIES[kind]
+    if make_dirs and path not in _CREATED:
+        path.mkdir(parents=True, exist_ok=True)
+        _CREATED.add(path)
+    return path
+
+
+def get_fname(kind, subj=None, make_dirs=False):
+    """File of a subject, or of the cohort without ``subj`` (see
+    ``TEMPLATES``).
+
+    With ``make_dirs``, the directory of the file is created if needed (once
+    per process).
+    """
+    fname = TEMPLATES[kind]
+    if subj is not None:
+        fname = fname.format(subj=int(subj))
+    parent = Path(fname).parent
+    if make_dirs and parent not in _CREATED:
+        parent.mkdir(parents=True, exist_ok=True)
+        _CREATED.add(parent)
+    return fname
+
+
+def get_bids_path(subj, **kwargs):
+    """``BIDSPath`` of the recording of a subject in the BIDS directory."""
+    return BIDSPath(root=FPATH_DATA_BIDS,
+                    subject=f'{int(subj):03}',
+                    task='dpx',
+                    datatype='eeg',
+                    **kwargs)
+
+
+class Layout:
+    """Index of the files that exist.
+
+    Parameters
+    ----------
+    max_age : float
+        Seconds a directory listing is used without checking whether the
+        directory changed.
+    """
+
+    def __init__(self, max_age=10.):
+        self.max_age = max_age
+        # directory -> (mtime, time it was listed, time of the last check,
+        # names of the entries)
+        self._listings = {}
+
+    def _list(self, path):
+        """Names of the entries of a directory (empty if it is missing)."""
+        now = time.time()
+        cached = self._listings.get(path)
+        if cached is not None and now - cached[2] < self.max_age:
+            return cached[3]
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            self._listings.pop(path, None)
+            return frozenset()
+
+        # a directory changed in the same second it was listed could change
+        # again without a new modification time (coarse timestamps on network
+        # storage), so only trust listings of directories older than that
+        if cached is not None and cached[0] == mtime and cached[1] - mtime > 1:
+            self._listings[path] = (mtime, cached[1], now, cached[3])
+            return cached[3]
+
+        try:
+            with os.scandir(path) as entries:
+                names = frozenset(entry.name for entry in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            self._listings.pop(path, None)
+            return frozenset()
+        self._listings[path] = (mtime, now, now, names)
+        return names
+
+    def _exists(self, path):
+        parent, name = os.path.split(path)
+        if parent == path:
+            return True
+        # missing parent directories are found without looking further down
+        if parent not in _ROOTS and not self._exists(parent):
+            return False
+        return name in self._list(parent)
+
+    def exists(self, kind, subj):
+        """Whether the file of a subject exists."""
+        return self._exists(get_fname(kind, subj))
+
+    def table(self, kinds=None, subjects=()):
+        """Which files exist, one row per subject and one column per kind."""
+        kinds = SUBJECT_KINDS if kinds is None else list(kinds)
+        return pd.DataFrame(
+            [[self.exists(kind, subj) for kind in kinds] for subj in subjects],
+            index=pd.Index([int(subj) for subj in subjects], name='subject'),
+            columns=kinds)
+
+    def missing(self, kinds=None, subjects=()):
+        """Subjects whose files are missing, for each kind."""
+        table = self.table(kinds, subjects)
+        return {kind: table.index[~table[kind]].tolist() for kind in table}
+
+    def invalidate(self):
+        """Check all directories for changes on the next query."""
+        self._listings = {path: (mtime, listed, 0., names)
+                          for path, (mtime, listed, _, names)
+                          in self._listings.items()}
+
+
+_LAYOUT = None
+
+
+def get_layout():
+    """The index of this process."""
+    global _LAYOUT
+    if _LAYOUT is None:
+        _LAYOUT = Layout()
+    return _LAYOUT
@@ -0,0 +1,260 @@
+"""Removal of line noise.
+
+Originally, PREP removes line noise channel by channel with a multitaper
+regression at every harmonic, and ``01_run_preprocessing.py`` applies a notch
+filter at 50 and 100 Hz after the interpolation of bad channels
+(``method='prep'``). The methods of ``LINE_NOISE_METHODS`` (see
+``config.py``) replace both steps and process all channels at once:
+
+- ``'zapline'``: a spatial filter removes the components of the data that
+  are dominated by line noise (ZapLine, de Cheveigné, 2020). The data are
+  split into a smooth part (moving average over one period of the line
+  frequency, which cancels the line frequency and its harmonics) and the
+  rest. Denoising source separation (DSS) of the rest finds the components
+  with the most power at the harmonics relative to their total power, and
+  these are regressed out. The covariance matrices are accumulated chunk by
+  chunk and the filter is applied in place, so intermediate results never
+  hold the whole recording.
+- ``'spectrum_interpolation'``: the amplitude spectrum of each channel is
+  interpolated over narrow bands around the harmonics from the neighbouring
+  frequencies, the phases are kept (Leske & Dalal, 2019). One FFT of the
+  whole recording for all channels.
+
+Unlike a notch filter, both remove all harmonics without wide stop bands.
+"""
+import time
+
+import numpy as np
+
+from scipy.fft import rfft, irfft, rfftfreq, next_fast_len
+from scipy.signal import oaconvolve
+
+from mne import pick_types
+from mne.utils import logger
+
+from config import LINE_NOISE_METHODS
+
+
+def _harmonics(sfreq, line_freq):
+    return np.arange(line_freq, sfreq / 2., line_freq)
+
+
+def _smooth(data, period):
+    """Moving average over ``period`` (possibly fractional) samples."""
+    n_full = int(period)
+    kernel = np.ones(n_full + 1)
+    kernel[-1] = period - n_full
+    kernel = np.trim_zeros(kernel, 'b') / period
+    return oaconvolve(data, kernel[np.newaxis], mode='same', axes=-1)
+
+
+def _bins(freqs, centers, offsets):
+    """Indices of the frequencies at the given offsets (in bins)."""
+    bins = np.unique([np.argmin(np.abs(freqs - center)) + offset
+                      for center in centers for offset in offsets])
+    return bins[(bins > 0) & (bins < len(freqs))]
+
+
+def zapline(data, sfreq, line_freq=50., n_remove='auto', min_ratio=2.,
+            max_remove=None, nfft=None, chunk_duration=60.):
+    """Remove line noise with a spatial filter (in place).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        The data, modified in place (can be memory-mapped).
+    sfreq : float
+        Sampling frequency.
+    line_freq : float
+        Frequency of the power line.
+    n_remove : int | 'auto'
+        Number of components to remove. With ``'auto'``, components are
+        removed as long as their power at the harmonics is more than
+        ``min_ratio`` times their power at the neighbouring frequencies
+        (3-5 Hz away), e.g., none if a low-pass filter already removed the
+        line noise.
+    min_ratio : float
+        See ``n_remove``.
+    max_remove : int | None
+        Maximum number of components removed with ``'auto'`` (default: a
+        fifth of the channels).
+    nfft : int | None
+        Length of the FFT of the line-noise bias (default: about 1 s).
+    chunk_duration : float
+        Seconds of data processed at once.
+
+    Returns
+    -------
+    n_removed : int
+        Number of components that were removed.
+    ratios : ndarray
+        Power at the harmonics relative to the neighbouring frequencies of
+        each DSS component.
+    """
+    n_channels, n_times = data.shape
+    period = sfreq / line_freq
+    # samples of the neighbouring chunks the moving average needs
+    pad = int(np.ceil(period)) + 1
+    step = max(int(chunk_duration * sfreq), 2 * pad)
+    if nfft is None:
+        nfft = int(2 ** np.ceil(np.log2(sfreq)))
+    window = np.hanning(nfft)
+    freqs = rfftfreq(nfft, 1. / sfreq)
+    harmonics = _harmonics(sfreq, line_freq)
+    bins = _bins(freqs, harmonics, (-1, 0, 1))
+    # neighbouring frequencies (3-5 Hz away)
+    offsets = np.arange(3, 6) * nfft / sfreq
+    neighbours = _bins(freqs, harmonics, np.round(
+        np.concatenate([-offsets, offsets])).astype(int))
+
+    def residual(start, stop):
+        """Data minus the moving average, from unmodified samples."""
+        first, last = max(start - pad, 0), min(stop + pad, n_times)
+        chunk = np.asarray(data[:, first:last], dtype=float)
+        chunk = chunk - _smooth(chunk, period)
+        return chunk[:, start - first:stop - first]
+
+    chunks = [(start, min(start + step, n_times))
+              for start in range(0, n_times, step)]
+
+    # covariance of the data, of its line-noise part and of the neighbouring
+    # frequencies
+    cov = np.zeros((n_channels, n_channels))
+    bias = np.zeros((n_channels, n_channels))
+    reference = np.zeros((n_channels, n_channels))
+    for start, stop in chunks:
+        res = residual(start, stop)
+        cov += res @ res.T
+        n_windows = res.shape[1] // nfft
+        if n_windows:
+            spectrum = rfft(res[:, :n_windows * nfft]
+                            .reshape(n_channels, n_windows, nfft) * window,
+                            axis=-1)
+            for cross, selection in ((bias, bins), (reference, neighbours)):
+                selected = spectrum[..., selection].reshape(n_channels, -1)
+                cross += (selected @ selected.conj().T).real
+
+    # DSS: whiten the data, then rotate to maximize the line-noise power
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    keep = eigvals > eigvals.max() * 1e-10
+    whitener = eigvecs[:, keep] / np.sqrt(eigvals[keep])
+    scores, rotation = np.linalg.eigh(whitener.T @ bias @ whitener)
+    unmixing = whitener @ rotation[:, np.argsort(scores)[::-1]]
+    # power per frequency bin at the harmonics relative to the neighbours
+    line_power = np.einsum('ij,ik,kj->j', unmixing, bias, unmixing)
+    neighbour_power = np.einsum('ij,ik,kj->j', unmixing, reference, unmixing)
+    ratios = (line_power / len(bins)) / (neighbour_power / len(neighbours))
+
+    if n_remove == 'auto':
+        max_remove = n_channels // 5 if max_remove is None else max_remove
+        above = ratios[:max_remove] > min_ratio
+        n_remove = int(np.argmin(above)) if not above.all() else len(above)
+    if n_remove == 0:
+        return 0, ratios
+
+    # least-squares projection of the residual onto the removed components
+    filters = unmixing[:, :n_remove]
+    projection = cov @ filters @ np.linalg.solve(
+        filters.T @ cov @ filters, filters.T)
+
+    # the moving average of a chunk reads samples of its neighbours, so
+    # each chunk is written after the next one was read
+    pending = None
+    for start, stop in chunks:
+        correction = projection @ residual(start, stop)
+        if pending is not None:
+            data[:, pending[0]:pending[1]] -= pending[2]
+        pending = (start, stop, correction)
+    data[:, pending[0]:pending[1]] -= pending[2]
+
+    return n_remove, ratios
+
+
+def spectrum_interpolation(data, sfreq, line_freq=50., width=1.,
+                           neighbours=2., n_jobs=1):
+    """Remove line noise by interpolating the amplitude spectrum (in place).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        The data, modified in place.
+    sfreq : float
+        Sampling frequency.
+    line_freq : float
+        Frequency of the power line.
+    width : float
+        Width (in Hz) of the band around each harmonic that is interpolated.
+    neighbours : float
+        Width (in Hz) of the bands on either side whose mean amplitude is
+        used.
+    n_jobs : int
+        Number of workers of the FFT.
+    """
+    n_times = data.shape[1]
+    n_fft = next_fast_len(n_times, real=True)
+    spectrum = rfft(data, n=n_fft, axis=-1, workers=n_jobs)
+    freqs = rfftfreq(n_fft, 1. / sfreq)
+    for freq in _harmonics(sfreq, line_freq):
+        distance = np.abs(freqs - freq)
+        band = distance <= width / 2.
+        sides = (distance > width / 2.) & (distance <= width / 2. + neighbours)
+        amplitude = np.abs(spectrum[:, sides]).mean(axis=-1, keepdims=True)
+        magnitude = np.abs(spectrum[:, band])
+        spectrum[:, band] *= np.divide(amplitude, magnitude,
+                                       out=np.zeros_like(magnitude),
+                                       where=magnitude > 0)
+    data[:] = irfft(spectrum, n=n_fft, axis=-1, workers=n_jobs)[:, :n_times]
+
+
+def remove_line_noise(raw, method='zapline', line_freq=50.,
+                      picks=('eeg', 'eog'), n_jobs=1):
+    """Remove line noise from the channels of a raw object (in place).
+
+    Bad channels are left as they are.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The data, must be loaded.
+    method : str
+        Key of ``LINE_NOISE_METHODS`` (except ``'prep'``).
+    line_freq : float
+        Frequency of the power line.
+    picks : tuple of str
+        Channel types to clean.
+    n_jobs : int
+        Number of workers of the FFT (spectrum interpolation).
+
+    Returns
+    -------
+    fit : dict
+        Runtime in seconds and, for ``'zapline'``, the number of removed
+        components.
+    """
+    methods = [name for name in LINE_NOISE_METHODS if name != 'prep']
+    if method not in methods:
+        raise ValueError(f"Unknown line-noise method '{method}', use one of "
+                         f"{methods}.")
+    params = LINE_NOISE_METHODS[method]
+    picks = pick_types(raw.info, eeg='eeg' in picks, eog='eog' in picks)
+    sfreq = raw.info['sfreq']
+
+    start = time.time()
+    fit = dict(method=method)
+    if method == 'zapline':
+        def clean(data):
+            fit['n_removed'], _ = zapline(data, sfreq, line_freq, **params)
+            return data
+    else:
+        def clean(data):
+            spectrum_interpolation(data, sfreq, line_freq, n_jobs=n_jobs,
+                                   **params)
+            return data
+    raw.apply_function(clean, picks=picks, channel_wise=False)
+    fit['seconds'] = time.time() - start
+
+    logger.info(f"    > Line noise removed ({method}) in "
+                f"{fit['seconds']:.1f} s"
+                + (f", {fit['n_removed']} components"
+                   if 'n_removed' in fit else ''))
+    return fit
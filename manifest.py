@@ -0,0 +1,118 @@
+"""Record of pipeline runs.
+
+For every stage and subject, a small .json file in ``derivatives/manifest``
+records the status of the last run (``'running'``, ``'done'`` or
+``'failed'``), when it started and finished, how long it took, the files it
+wrote and, if it failed, the error. One file per record keeps concurrent
+workers (also on different machines, see ``work_queue.py``) from
+overwriting each other's records.
+"""
+import os
+import json
+import time
+import socket
+
+from pathlib import Path
+
+from config import STAGES
+
+from layout import get_dir, get_fname, get_layout
+
+from utils import write_json
+
+
+def _fname(stage, subj, root=None):
+    root = get_dir('manifest') if root is None else Path(root)
+    return root / stage / ('sub-%03d.json' % subj)
+
+
+def _write_record(record, root=None):
+    fname = _fname(record['stage'], record['subject'], root)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    write_json(fname, record)
+
+
+def expected_outputs(stage, subj):
+    """Files written by a stage for a given subject."""
+    return [get_fname(kind, subj) for kind in STAGES[stage]['outputs']]
+
+
+def input_files(stage, subj):
+    """Files read by a stage for a given subject."""
+    return [get_fname(kind, subj) for kind in STAGES[stage]['inputs']]
+
+
+def read_record(stage, subj, root=None):
+    """Record of the last run of a stage for a subject (None if missing)."""
+    try:
+        with open(_fname(stage, subj, root)) as record:
+            return json.load(record)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_records(stages=None, root=None):
+    """All records of the given stages (default: all stages)."""
+    root = get_dir('manifest') if root is None else Path(root)
+    records = []
+    for stage in (STAGES if stages is None else stages):
+        for fname in sorted((root / stage).glob('sub-*.json')):
+            with open(fname) as record:
+                records.append(json.load(record))
+    return records
+
+
+def record_start(stage, subj, command=None, root=None):
+    """Record that a stage started for a subject."""
+    previous = read_record(stage, subj, root)
+    record = dict(stage=stage,
+                  subject=int(subj),
+                  status='running',
+                  host=socket.gethostname(),
+                  pid=os.getpid(),
+                  command=command,
+                  started=time.time(),
+                  finished=None,
+                  duration=None,
+                  outputs=[],
+                  error=None,
+                  attempts=1 if previous is None
+                  else previous.get('attempts', 0) + 1)
+    _write_record(record, root)
+    return record
+
+
+def record_end(record, returncode, error=None, root=None, **info):
+    """Record the outcome of a run started with ``record_start``.
+
+    Additional keyword arguments are stored in the record as well.
+    """
+    record = dict(record)
+    record['finished'] = time.time()
+    record['duration'] = record['finished'] - record['started']
+    record['returncode'] = returncode
+    record['status'] = 'done' if returncode == 0 else 'failed'
+    # the run just wrote its outputs, look at the directories again
+    layout = get_layout()
+    layout.invalidate()
+    record['outputs'] = [get_fname(kind, record['subject'])
+                         for kind in STAGES[record['stage']]['outputs']
+                         if layout.exists(kind, record['subject'])]
+    record['error'] = error
+    record.update(info)
+    _write_record(record, root)
+    return record
+
+
+def needs_run(stage, subj, root=None):
+    """Whether a stage has to be (re-)run for a subject.
+
+    This is the case if the stage was never run, did not finish successfully
+    or if any of its outputs is missing.
+    """
+    record = read_record(stage, subj, root)
+    if record is None or record['status'] != 'done':
+        return True
+    layout = get_layout()
+    return not all(layout.exists(kind, subj)
+                   for kind in STAGES[stage]['outputs'])
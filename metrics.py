@@ -0,0 +1,249 @@
+"""Metrics of pipeline runs for monitoring.
+
+Each run of a stage script (see ``scheduler.run_stage``) appends events to a
+log in ``derivatives/metrics``, one JSON object per line:
+
+* ``queued``: stage and subjects of a batch of ``pipeline.py run``
+* ``start``: stage, subject, id of the run and size of the input files
+* ``end``: status, exit code, duration, bytes read and written by the
+  process (block I/O, i.e., without page-cache hits), size of the outputs
+  and peak memory
+
+Each host writes to its own file (``events-<host>.jsonl``), so that workers
+on several machines (see ``work_queue.py``) can share the derivatives
+directory.
+
+``write_textfile`` summarizes the events in the text format of Prometheus,
+e.g., for the textfile collector of the node exporter: runs and failures,
+throughput, queue depth, running and longest running jobs (to spot stuck
+workers), bytes read and written, peak memory and a histogram of the
+duration of each stage. It is updated after each run and by
+``python pipeline.py metrics``.
+"""
+import os
+import json
+import time
+import socket
+
+from collections import defaultdict
+from pathlib import Path
+
+from layout import get_dir
+
+from overlapped_io import write_atomic
+
+TEXTFILE_NAME = 'uva_pipeline.prom'
+
+# upper bounds (in seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+# time window of the throughput (in seconds)
+THROUGHPUT_WINDOW = 3600.
+
+
+def _root(root=None):
+    return get_dir('metrics') if root is None else Path(root)
+
+
+def log_event(event, root=None, **fields):
+    """Append an event to the log of this host.
+
+    Lines are written with a single ``write`` in append mode, so events of
+    concurrent processes don't interleave.
+    """
+    host = socket.gethostname()
+    record = dict(event=event, time=time.time(), host=host, pid=os.getpid(),
+                  **fields)
+    root = _root(root)
+    root.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(root / f'events-{host}.jsonl',
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_events(root=None):
+    """Events of all hosts, sorted by time."""
+    events = []
+    for fname in sorted(_root(root).glob('events-*.jsonl')):
+        with open(fname) as log:
+            for line in log:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # line of a process that is still writing
+                    continue
+    return sorted(events, key=lambda event: event['time'])
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"'
+                          for key, value in labels.items()) + '}'
+
+
+class _Metrics:
+    """Lines of a file in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        """Add a metric, ``samples`` are ``(labels, value)`` tuples."""
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            suffix, labels = labels.pop('_suffix', ''), _labels(**labels)
+            self.lines.append(f'{name}{suffix}{labels} {value:.15g}')
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def summarize(events, queue_counts=None, now=None):
+    """Prometheus metrics of the events (see ``read_events``).
+
+    Parameters
+    ----------
+    events : list of dict
+        The events.
+    queue_counts : dict | None
+        Number of tasks in each state of a work queue
+        (``WorkQueue.summary()``).
+    now : float | None
+        Current time (default: ``time.time()``).
+
+    Returns
+    -------
+    text : str
+        The metrics in the Prometheus text format.
+    """
+    now = time.time() if now is None else now
+    runs = defaultdict(int)
+    durations = defaultdict(list)
+    read, written = defaultdict(float), defaultdict(float)
+    peak_memory = defaultdict(float)
+    recent = defaultdict(int)
+    running, queued, started = {}, {}, {}
+
+    for event in events:
+        stage = event.get('stage')
+        if event['event'] == 'queued':
+            for subj in event['subjects']:
+                queued[stage, subj] = event['time']
+        elif event['event'] == 'start':
+            running[event['run']] = event
+            started[stage, event['subject']] = event['time']
+        elif event['event'] == 'end':
+            running.pop(event['run'], None)
+            runs[stage, event['status']] += 1
+            durations[stage].append(event['duration'])
+            read[stage] += event.get('bytes_read', 0)
+            written[stage] += event.get('bytes_written', 0)
+            peak_memory[stage] = max(peak_memory[stage],
+                                     event.get('peak_memory_gb', 0)
+                                     * 1024 ** 3)
+            if event['status'] == 'done' \
+                    and now - event['time'] < THROUGHPUT_WINDOW:
+                recent[stage] += 1
+
+    stages = sorted({stage for stage, _ in runs} | set(durations)
+                    | {stage for stage, _ in queued}
+                    | {event['stage'] for event in running.values()})
+
+    # subjects of a batch that did not start yet
+    depth = defaultdict(int)
+    for (stage, subj), queued_at in queued.items():
+        if started.get((stage, subj), -1) < queued_at:
+            depth[stage] += 1
+    oldest = defaultdict(float)
+    n_running = defaultdict(int)
+    for event in running.values():
+        n_running[event['stage']] += 1
+        oldest[event['stage']] = max(oldest[event['stage']],
+                                     now - event['time'])
+
+    metrics = _Metrics()
+    metrics.add('uva_stage_runs_total', 'counter',
+                'Finished runs of a stage by status.',
+                [(dict(stage=stage, status=status), count)
+                 for (stage, status), count in sorted(runs.items())])
+    metrics.add('uva_stage_failures_total', 'counter',
+                'Failed runs of a stage.',
+                [(dict(stage=stage), runs[stage, 'failed'])
+                 for stage in stages])
+    metrics.add('uva_stage_throughput_per_hour', 'gauge',
+                'Successful runs of a stage in the last hour.',
+                [(dict(stage=stage), recent[stage]) for stage in stages])
+    metrics.add('uva_stage_queued', 'gauge',
+                'Subjects of a batch waiting for a stage.',
+                [(dict(stage=stage), depth[stage]) for stage in stages])
+    metrics.add('uva_stage_running', 'gauge',
+                'Runs of a stage that did not finish yet.',
+                [(dict(stage=stage), n_running[stage]) for stage in stages])
+    metrics.add('uva_stage_oldest_running_seconds', 'gauge',
+                'Time since the oldest unfinished run of a stage started.',
+                [(dict(stage=stage), oldest[stage]) for stage in stages])
+    metrics.add('uva_stage_read_bytes_total', 'counter',
+                'Bytes read from disk by the runs of a stage.',
+                [(dict(stage=stage), read[stage]) for stage in stages])
+    metrics.add('uva_stage_written_bytes_total', 'counter',
+                'Bytes written to disk by the runs of a stage.',
+                [(dict(stage=stage), written[stage]) for stage in stages])
+    metrics.add('uva_stage_peak_memory_bytes', 'gauge',
+                'Highest peak memory of a run of a stage.',
+                [(dict(stage=stage), peak_memory[stage])
+                 for stage in stages])
+
+    samples = []
+    for stage in stages:
+        values = durations[stage]
+        for bound in DURATION_BUCKETS:
+            samples.append((dict(_suffix='_bucket', stage=stage,
+                                 le=bound),
+                            sum(value <= bound for value in values)))
+        samples.append((dict(_suffix='_bucket', stage=stage, le='+Inf'),
+                        len(values)))
+        samples.append((dict(_suffix='_sum', stage=stage), sum(values)))
+        samples.append((dict(_suffix='_count', stage=stage), len(values)))
+    metrics.add('uva_stage_duration_seconds', 'histogram',
+                'Duration of the runs of a stage.', samples)
+
+    if queue_counts is not None:
+        metrics.add('uva_queue_tasks', 'gauge',
+                    'Tasks of the work queue by state.',
+                    [(dict(state=state), count)
+                     for state, count in sorted(queue_counts.items())])
+    if events:
+        metrics.add('uva_last_event_timestamp_seconds', 'gauge',
+                    'Time of the last event.',
+                    [(dict(), events[-1]['time'])])
+    return metrics.text()
+
+
+def _write_text(fname, text):
+    with open(fname, 'w') as file:
+        file.write(text)
+
+
+def write_textfile(fname=None, root=None, queue_counts=None):
+    """Write the metrics of all events to a file (atomically).
+
+    Parameters
+    ----------
+    fname : str | Path | None
+        The file (default: ``derivatives/metrics/uva_pipeline.prom``).
+    root : str | Path | None
+        Directory of the event logs (default: ``derivatives/metrics``).
+    queue_counts : dict | None
+        Number of tasks in each state of a work queue.
+    """
+    if fname is None:
+        fname = _root(root) / TEXTFILE_NAME
+    text = summarize(read_events(root), queue_counts=queue_counts)
+    write_atomic(fname, _write_text, text)
+    return fname
@@ -0,0 +1,326 @@
+"""Near-real-time monitoring of recordings while they are acquired.
+
+The data are processed chunk by chunk as they are written to disk (see
+``bdf_io.iter_bdf_chunks``):
+
+- the EEG is filtered with a causal filter whose state is carried over from
+  one chunk to the next,
+- triggers are decoded from the ``Status`` channel and DPX trials are
+  classified as soon as their events have arrived (using the same rules as
+  the recoding in ``02_extract_epochs.py``),
+- running accuracy and reaction time summaries, as well as the signal quality
+  of each channel, are reported at regular intervals.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+from mne.utils import logger
+
+from bdf_io import read_bdf_header, iter_bdf_chunks
+
+Event = namedtuple('Event', ['sample', 'kind', 'label'])
+
+
+class CausalFilter:
+    """Band-pass filter that keeps its state across chunks of data."""
+
+    def __init__(self, sfreq, l_freq=0.1, h_freq=40., order=2):
+        self.sos = butter(order, [l_freq, h_freq], btype='bandpass',
+                          fs=sfreq, output='sos')
+        self.zi = None
+
+    def __call__(self, data):
+        if self.zi is None:
+            # start from steady state to avoid a large transient
+            self.zi = sosfilt_zi(self.sos)[:, np.newaxis, :] \
+                * data[np.newaxis, :, :1]
+        filtered, self.zi = sosfilt(self.sos, data, axis=-1, zi=self.zi)
+        return filtered
+
+
+class TriggerDecoder:
+    """Find trigger onsets in consecutive chunks of the ``Status`` channel."""
+
+    def __init__(self):
+        self.last = 0
+
+    def __call__(self, status, first_samp):
+        status = status.astype(int)
+        previous = np.concatenate([[self.last], status[:-1]])
+        onsets = np.flatnonzero((status != previous) & (status != 0))
+        self.last = status[-1]
+        return [(first_samp + onset, status[onset]) for onset in onsets]
+
+
+class TrialTracker:
+    """Classify DPX trials incrementally as their events arrive.
+
+    Trials are classified with the same rules as in ``02_extract_epochs.py``:
+    an incorrect reaction right after the cue is a too-soon trial, otherwise
+    the reaction that follows the probe determines whether the trial was
+    correct, incorrect or missed.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the recording.
+    event_id : dict
+        Mapping of event names to trigger values (see ``eeg_markers.json``).
+    break_duration : float
+        A pause of this many seconds between two cues starts a new block.
+    """
+
+    def __init__(self, sfreq, event_id, break_duration=10.):
+        self.sfreq = sfreq
+        self.break_duration = break_duration
+        self.codes = {}
+        for name, value in event_id.items():
+            if name == 'cue_a':
+                self.codes[value] = ('cue', 'A')
+            elif name.startswith('cue_b'):
+                self.codes[value] = ('cue', 'B')
+            elif name == 'probe_x':
+                self.codes[value] = ('probe', 'X')
+            elif name.startswith('probe_y'):
+                self.codes[value] = ('probe', 'Y')
+            elif name.startswith('correct'):
+                self.codes[value] = ('reaction', 'Correct')
+            elif name.startswith('incorrect'):
+                self.codes[value] = ('reaction', 'Incorrect')
+
+        self.pending = []
+        self.trials = []
+        self.block = 0
+        self.last_cue = None
+
+    def push(self, events, final=False):
+        """Add ``(sample, value)`` events, return newly classified trials."""
+        for sample, value in events:
+            if value in self.codes:
+                self.pending.append(Event(sample, *self.codes[value]))
+
+        new = []
+        while self.pending:
+            if self.pending[0].kind != 'cue':
+                # events that don't belong to a trial
+                self.pending.pop(0)
+                continue
+            trial, n_used = self._classify(final)
+            if n_used == 0:
+                # wait for more events
+                break
+            del self.pending[:n_used]
+            if trial is not None:
+                new.append(trial)
+
+        self.trials.extend(new)
+        return new
+
+    def flush(self):
+        """Classify the remaining trials at the end of the recording."""
+        return self.push([], final=True)
+
+    def _classify(self, final):
+        events = self.pending
+        cue = events[0]
+        if len(events) < 2:
+            return None, int(final)
+
+        if events[1].kind == 'reaction' and events[1].label == 'Incorrect':
+            # reaction before the probe, find the probe of the trial
+            probe, n_used = None, None
+            for i, event in enumerate(events[2:], start=2):
+                if event.kind == 'probe':
+                    probe, n_used = event, i + 1
+                    break
+                if event.kind == 'cue':
+                    # broken trial, no probe was shown
+                    n_used = i
+                    break
+            if n_used is None:
+                if not final:
+                    return None, 0
+                n_used = len(events)
+            trial = self._trial(cue, probe, 'Too_soon', np.nan)
+
+        elif events[1].kind == 'probe':
+            probe = events[1]
+            if len(events) < 3 and not final:
+                return None, 0
+            if len(events) > 2 and events[2].kind == 'reaction':
+                rt = (events[2].sample - probe.sample) / self.sfreq
+                trial = self._trial(cue, probe, events[2].label, rt)
+                n_used = 3
+            else:
+                trial = self._trial(cue, probe, 'Missed', np.nan)
+                n_used = 2
+
+        else:
+            # unexpected order of events, skip the cue
+            return None, 1
+
+        return trial, n_used
+
+    def _trial(self, cue, probe, outcome, rt):
+        onset = cue.sample / self.sfreq
+        if self.last_cue is not None \
+                and onset - self.last_cue > self.break_duration:
+            self.block += 1
+        self.last_cue = onset
+
+        return dict(trial=len(self.trials),
+                    block=self.block,
+                    onset=onset,
+                    cue=cue.label,
+                    probe=None if probe is None else probe.label,
+                    condition=cue.label + (probe.label if probe else ''),
+                    outcome=outcome,
+                    rt=rt)
+
+    def summary(self):
+        """Accuracy and reaction times for each trial type."""
+        trials = pd.DataFrame(self.trials)
+        if trials.empty:
+            return trials
+
+        trials = trials[trials.condition.str.len() == 2]
+        summary = trials.groupby('condition').agg(
+            n=('outcome', 'size'),
+            correct=('outcome', lambda x: (x == 'Correct').mean()),
+            incorrect=('outcome', lambda x: (x == 'Incorrect').mean()),
+            missed=('outcome', lambda x: (x == 'Missed').mean()),
+            too_soon=('outcome', lambda x: (x == 'Too_soon').mean()),
+        )
+        rt = trials[trials.outcome == 'Correct'].groupby('condition').rt
+        summary['rt_mean'] = rt.mean()
+        summary['rt_median'] = rt.median()
+
+        return summary
+
+
+class SignalQuality:
+    """Signal quality of each channel since the last report.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        Names of the channels.
+    flat : float
+        Channels with a standard deviation below this value (in V) are flat.
+    noisy : float
+        Channels with a standard deviation above this value (in V), or 5
+        times above the median of all channels, are noisy.
+    clip : ndarray | None
+        Absolute values (in V) that indicate clipping, one per channel.
+    """
+
+    def __init__(self, ch_names, flat=0.5e-6, noisy=100e-6, clip=None):
+        self.ch_names = ch_names
+        self.flat = flat
+        self.noisy = noisy
+        self.clip = clip
+        self.reset()
+
+    def reset(self):
+        n_channels = len(self.ch_names)
+        self.n = 0
+        self.sum = np.zeros(n_channels)
+        self.sum_sq = np.zeros(n_channels)
+        self.n_clipped = np.zeros(n_channels)
+
+    def update(self, filtered, raw=None):
+        self.n += filtered.shape[1]
+        self.sum += filtered.sum(axis=1)
+        self.sum_sq += (filtered ** 2).sum(axis=1)
+        if raw is not None and self.clip is not None:
+            self.n_clipped += (np.abs(raw) >= self.clip[:, np.newaxis]) \
+                .sum(axis=1)
+
+    def summary(self):
+        """Flat, noisy and clipping channels."""
+        if self.n == 0:
+            return dict(flat=[], noisy=[], clipping=[])
+        std = np.sqrt(np.maximum(self.sum_sq / self.n
+                                 - (self.sum / self.n) ** 2, 0))
+        names = np.array(self.ch_names)
+        noisy = (std > self.noisy) | (std > 5 * np.median(std))
+        return dict(
+            median_std_uv=float(np.median(std) * 1e6),
+            flat=names[std < self.flat].tolist(),
+            noisy=names[noisy].tolist(),
+            clipping=names[self.n_clipped / self.n > 0.001].tolist(),
+        )
+
+
+def monitor(fname, event_id, ch_names=None, follow=True, speed=None,
+            report_every=30., l_freq=0.1, h_freq=40.):
+    """Monitor a recording while it is acquired.
+
+    Parameters
+    ----------
+    fname : str
+        The .bdf file that is being recorded.
+    event_id : dict
+        Mapping of event names to trigger values.
+    ch_names : list of str | None
+        Channels to monitor the signal quality of (default: all channels
+        except ``Status``).
+    follow : bool
+        Keep reading while the file grows.
+    speed : float | None
+        Replay a finished recording at this speed instead (e.g., ``1`` for
+        real time).
+    report_every : float
+        Seconds of data between two reports.
+    l_freq, h_freq : float
+        Edges of the causal band-pass filter.
+
+    Returns
+    -------
+    trials : pd.DataFrame
+        The classified trials.
+    """
+    header = read_bdf_header(fname)
+    sfreq = header['sfreq']
+    status = header['ch_names'].index('Status')
+    if ch_names is None:
+        ch_names = [name for name in header['ch_names'] if name != 'Status']
+    picks = [header['ch_names'].index(name) for name in ch_names]
+
+    causal_filter = CausalFilter(sfreq, l_freq, h_freq)
+    decoder = TriggerDecoder()
+    tracker = TrialTracker(sfreq, event_id)
+    quality = SignalQuality(ch_names, clip=header['phys_max'][picks])
+
+    next_report = report_every * sfreq
+    for first_samp, data in iter_bdf_chunks(fname, follow=follow,
+                                            speed=speed):
+        quality.update(causal_filter(data[picks]), data[picks])
+        for trial in tracker.push(decoder(data[status], first_samp)):
+            logger.info(f"    > Trial {trial['trial']}: {trial['condition']} "
+                        f"{trial['outcome']} (RT {trial['rt']:.3f} s)")
+
+        if first_samp + data.shape[1] >= next_report:
+            _report(tracker, quality, (first_samp + data.shape[1]) / sfreq)
+            quality.reset()
+            next_report += report_every * sfreq
+
+    tracker.flush()
+    _report(tracker, quality, None)
+
+    return pd.DataFrame(tracker.trials)
+
+
+def _report(tracker, quality, time):
+    when = 'end of recording' if time is None else '%.0f s' % time
+    logger.info(f"\n--- Summary at {when} ---")
+    summary = tracker.summary()
+    if not summary.empty:
+        logger.info(summary.to_string(float_format='%.3f'))
+    for key, val in quality.summary().items():
+        logger.info(f"    {key}: {val}")
+    logger.info("")
@@ -0,0 +1,249 @@
+"""Overlap of disk I/O with computation.
+
+``BackgroundWriter`` writes the derivatives of a stage script on a background
+thread while the script goes on computing. Each file is written to a hidden
+temporary directory next to its destination, synced to disk and then renamed,
+so readers never see half-written files. The first error of a write is raised
+in the script with the next call of the writer.
+
+``Prefetcher`` reads the input files of the subjects that are processed next
+while the current ones are computed (see ``pipeline.py``). Each subject is
+processed in its own process (see ``scheduler.py``), so the decoded data can
+not be handed over, but the files are in the page cache of the operating
+system when the stage script of the next subject reads them.
+"""
+import io
+import os
+import time
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from uuid import uuid4
+
+from mne.utils import logger
+
+
+def _fsync(fname):
+    """Sync a file (or a directory) to disk."""
+    flags = os.O_RDONLY
+    if os.path.isdir(fname):
+        flags |= getattr(os, 'O_DIRECTORY', 0)
+    try:
+        fd = os.open(fname, flags)
+    except OSError:
+        # directories can't be opened on all platforms
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(fname, write, *args):
+    """Write a file with ``write(tmp_fname, *args)`` and rename it.
+
+    ``write`` may produce several files (e.g., split .fif files), all of them
+    are moved next to ``fname``. The names of the files are kept, so that
+    references between split files stay valid.
+    """
+    fname = str(fname)
+    directory = os.path.dirname(fname)
+    tmp_dir = os.path.join(directory, f'.tmp-{uuid4().hex}')
+    os.makedirs(tmp_dir)
+    try:
+        write(os.path.join(tmp_dir, os.path.basename(fname)), *args)
+        names = os.listdir(tmp_dir)
+        for name in names:
+            _fsync(os.path.join(tmp_dir, name))
+        for name in names:
+            os.replace(os.path.join(tmp_dir, name),
+                       os.path.join(directory, name))
+        _fsync(directory)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_bytes(fname, data):
+    """Write bytes to a file (e.g., a figure rendered with ``figure_bytes``)."""
+    with open(fname, 'wb') as file:
+        file.write(data)
+
+
+def figure_bytes(fig, **kwargs):
+    """Render a matplotlib figure to bytes (for ``BackgroundWriter``).
+
+    Figures have to be rendered in the main thread, only writing the result
+    can be done in the background.
+    """
+    buffer = io.BytesIO()
+    fig.savefig(buffer, **kwargs)
+    return buffer.getvalue()
+
+
+class BackgroundWriter:
+    """Write files on a background thread.
+
+    Parameters
+    ----------
+    max_pending : int
+        Number of files that can wait to be written. ``submit`` blocks when
+        more are pending, which bounds the memory held by the queue.
+    enabled : bool
+        If False, files are written immediately by ``submit`` (still
+        atomically).
+
+    Attributes
+    ----------
+    seconds_waited : float
+        Time the caller spent waiting for writes (in ``submit`` and
+        ``close``).
+    """
+
+    def __init__(self, max_pending=2, enabled=True):
+        self.enabled = enabled
+        self.seconds_waited = 0.
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = None
+        self._error = None
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.5)
+            except Empty:
+                # the script ended (e.g., with an error) without ``close``
+                if not threading.main_thread().is_alive():
+                    return
+                continue
+            try:
+                if item is None:
+                    return
+                fname, write, args = item
+                # don't write anything after a failure
+                if self._error is None:
+                    try:
+                        write_atomic(fname, write, *args)
+                    except BaseException as err:
+                        logger.info(f"    > Writing {fname} failed: {err}")
+                        self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, fname, write, *args, overwrite=True):
+        """Write a file with ``write(tmp_fname, *args)``.
+
+        The arguments must not be modified until the file is written (see
+        ``wait``). Raises the error of a previous write, if any.
+        """
+        self._raise()
+        if not overwrite and os.path.exists(fname):
+            raise FileExistsError(f"Destination file exists: {fname}. "
+                                  f"Set overwrite=True to replace it.")
+        if not self.enabled:
+            write_atomic(fname, write, *args)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='BackgroundWriter')
+            self._thread.start()
+        start = time.time()
+        self._queue.put((fname, write, args))
+        self.seconds_waited += time.time() - start
+
+    def wait(self):
+        """Wait until all submitted files are written."""
+        start = time.time()
+        if self._thread is not None:
+            self._queue.join()
+        self.seconds_waited += time.time() - start
+        self._raise()
+
+    def close(self):
+        """Write the pending files and stop the thread."""
+        start = time.time()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.seconds_waited += time.time() - start
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # don't hide the original error with one of the writes
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class Prefetcher:
+    """Read files on a background thread, so they are in the page cache.
+
+    Parameters
+    ----------
+    max_bytes : int | None
+        Stop reading after about this many bytes per call of ``prefetch``
+        (e.g., a fraction of the available memory, so prefetched files are
+        not evicted before they are used). No limit if None.
+    chunk_size : int
+        Size of the reads in bytes.
+    """
+
+    def __init__(self, max_bytes=None, chunk_size=8 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._requested = set()
+
+    def _read(self, fnames):
+        budget = self.max_bytes
+        buffer = bytearray(self.chunk_size)
+        start, n_bytes = time.time(), 0
+        for fname in fnames:
+            try:
+                with open(fname, 'rb', buffering=0) as file:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(file.fileno(), 0, 0,
+                                         os.POSIX_FADV_SEQUENTIAL)
+                    while budget is None or n_bytes < budget:
+                        size = file.readinto(buffer)
+                        if not size:
+                            break
+                        n_bytes += size
+            except OSError:
+                # missing files are reported by the stage script
+                continue
+        logger.debug(f"Prefetched {n_bytes / 1024 ** 2:.0f} MB in "
+                     f"{time.time() - start:.1f} s")
+        return n_bytes
+
+    def prefetch(self, fnames):
+        """Read files in the background (files are read only once)."""
+        fnames = [str(fname) for fname in fnames
+                  if str(fname) not in self._requested]
+        self._requested.update(fnames)
+        if fnames:
+            return self._executor.submit(self._read, fnames)
+
+    def close(self):
+        """Stop reading (pending reads are cancelled)."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
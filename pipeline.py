@@ -0,0 +1,548 @@
+"""
+==============================
+Run pipeline stages on cohorts
+==============================
+
+Command line interface for running the pipeline scripts on several subjects.
+The number of subjects processed concurrently, as well as ``n_jobs`` and
+BLAS/OpenMP thread limits for each of them, are derived from the cores and
+memory of the machine and the cost profiles of each stage (see ``STAGES`` in
+``config.py``).
+
+Example::
+
+    python pipeline.py run --stage preprocessing --subjects 1-10
+
+Any additional arguments are passed on to the stage scripts. Each run is
+recorded in a manifest in the derivatives directory (see ``manifest.py``).
+Use ``python pipeline.py status`` to see progress and failures, and
+``python pipeline.py resume`` to re-run only what failed or is missing.
+While subjects are processed, the input files of the next ones are read in
+the background (``--prefetch``), so the stage scripts find them in the page
+cache instead of waiting for the disk.
+
+To distribute the work over several machines that share the derivatives
+directory, start one or more workers on each machine::
+
+    python pipeline.py worker --stage preprocessing --stage epochs
+
+Workers claim ``(stage, subject)`` tasks from a work queue in the derivatives
+directory (see ``work_queue.py``) until no task is left.
+
+To estimate the costs of a cohort from the file headers before running it,
+and to process the most expensive subjects first::
+
+    python pipeline.py preflight
+    python pipeline.py run --plan derivatives/preflight/plan.tsv
+
+To export metrics of the runs (throughput, queue depth, failures, duration
+of each stage) for Prometheus, e.g., to the directory of the textfile
+collector of the node exporter, every 30 seconds::
+
+    python pipeline.py metrics --textfile /var/lib/node_exporter/uva.prom \
+        --every 30
+
+To update the grand average of the condition ERPs after new subjects were
+processed::
+
+    python pipeline.py grand-average
+
+License: BSD (3-clause)
+"""
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Process
+
+import click
+
+import numpy as np
+import pandas as pd
+
+from mne.utils import logger
+
+from config import (
+    SUBJECT_IDS,
+    STAGES,
+    event_id
+)
+
+from erp_aggregation import reset_grand_average, update_grand_average
+
+from layout import SUBJECT_KINDS, get_dir, get_fname, get_layout
+
+from manifest import input_files, needs_run, read_record
+
+from metrics import log_event, write_textfile
+
+from online import monitor as monitor_recording
+
+from overlapped_io import Prefetcher
+
+from preflight import preflight as estimate_cohort, read_plan
+
+from qc_figures import render_cohort
+
+from qc_index import load_qc_index
+
+from scheduler import (
+    get_available_memory,
+    get_n_cores,
+    plan_resources,
+    run_stage
+)
+
+from utils import parse_subjects
+
+from work_queue import WorkQueue, work
+
+
+@click.group()
+def cli():
+    """Run pipeline stages on several subjects."""
+
+
+def _run_options(command):
+    """Options shared by ``run`` and ``resume``."""
+    options = [
+        click.option("--stage", "stages", multiple=True,
+                      default=list(STAGES), show_default=True,
+                      type=click.Choice(list(STAGES)),
+                      help="Stage(s) to run, in the given order"),
+        click.option("--subjects", default=None, type=str,
+                     help="Subjects to process, e.g., '1-10,12' "
+                          "(default: all)"),
+        click.option("--n_cores", default=None, type=int,
+                     help="Number of cores to use (default: all available)"),
+        click.option("--memory", default=None, type=float,
+                     help="Memory to use in GB (default: all available)"),
+        click.option("--n_workers", default=None, type=int,
+                     help="Number of subjects to process concurrently"),
+        click.option("--n_jobs", default=None, type=int,
+                     help="Number of cores to use for each subject"),
+        click.option("--plan", "plan_fname", default=None, type=str,
+                     help="Plan written by 'preflight': process subjects "
+                          "longest first and use their memory estimates"),
+        click.option("--prefetch", default=1, type=int, show_default=True,
+                     help="Number of subjects whose input files are read "
+                          "ahead (0: off)"),
+        click.argument("stage_args", nargs=-1, type=click.UNPROCESSED),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _run_stages(stages, subjects, n_cores, memory, n_workers, n_jobs,
+                overwrite, stage_args, only_missing=False, plan_fname=None,
+                prefetch=1):
+    """Run stages for subjects, one stage after the other."""
+    estimates = None if plan_fname is None else read_plan(plan_fname)
+    # read at most a quarter of the available memory ahead for each subject,
+    # so the files are still in the page cache when they are needed
+    available = memory if memory is not None else get_available_memory()
+    max_bytes = None if available is None \
+        else int(available * 1024 ** 3 / 4)
+    failed, rerun = [], set()
+    for stage in stages:
+        # don't continue with subjects that failed in a previous stage
+        todo = [subj for subj in subjects if subj not in failed]
+        if only_missing:
+            # outputs of later stages are outdated when an earlier stage was
+            # re-run for the subject
+            todo = [subj for subj in todo
+                    if subj in rerun or needs_run(stage, subj)]
+            rerun.update(todo)
+        if not todo:
+            logger.info(f"\nNothing to do for '{stage}'\n")
+            continue
+
+        memory_gb = None
+        if estimates is not None:
+            # longest first, subjects that are not in the plan at the end
+            stage_estimates = estimates[estimates.stage == stage] \
+                .set_index('subject')
+            planned = [subj for subj in stage_estimates.index if subj in todo]
+            todo = planned + [subj for subj in todo if subj not in planned]
+            if planned and len(planned) == len(todo):
+                memory_gb = stage_estimates.loc[planned, 'memory_gb'].max()
+
+        plan = plan_resources(stage, len(todo), n_cores, memory, memory_gb)
+        if n_workers is not None:
+            # distribute the cores among the given number of workers
+            jobs = max(min((n_cores or get_n_cores()) // n_workers,
+                           STAGES[stage]['max_jobs']), 1)
+            plan = plan._replace(n_workers=n_workers, n_jobs=jobs,
+                                 n_threads=jobs)
+        if n_jobs is not None:
+            plan = plan._replace(n_jobs=n_jobs, n_threads=n_jobs)
+        logger.info(f"\nRunning '{stage}' for {len(todo)} subjects: "
+                    f"{plan.n_workers} at a time, "
+                    f"n_jobs={plan.n_jobs}, threads={plan.n_threads}\n")
+
+        def run_subject(index, subj):
+            # subjects that start when one of the running ones finishes
+            ahead = index + plan.n_workers
+            for next_subj in todo[ahead:ahead + prefetch]:
+                prefetcher.prefetch(input_files(stage, next_subj))
+            return run_stage(stage, subj,
+                             n_jobs=plan.n_jobs,
+                             n_threads=plan.n_threads,
+                             overwrite=overwrite,
+                             stage_args=stage_args)
+
+        log_event('queued', stage=stage,
+                  subjects=[int(subj) for subj in todo])
+        with ThreadPoolExecutor(max_workers=plan.n_workers) as executor, \
+                Prefetcher(max_bytes=max_bytes) as prefetcher:
+            codes = executor.map(run_subject, range(len(todo)), todo)
+            failed.extend(
+                [subj for subj, code in zip(todo, codes) if code != 0])
+
+    if failed:
+        logger.info(f"\nFailed subjects: {failed}\n")
+        sys.exit(1)
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@_run_options
+@click.option("--overwrite", default=False, type=bool, help="Overwrite?")
+def run(stages, subjects, n_cores, memory, n_workers, n_jobs, plan_fname,
+        prefetch, stage_args, overwrite):
+    """Run stage scripts for several subjects."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    _run_stages(stages, subjects, n_cores, memory, n_workers, n_jobs,
+                overwrite, stage_args, plan_fname=plan_fname,
+                prefetch=prefetch)
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@_run_options
+def resume(stages, subjects, n_cores, memory, n_workers, n_jobs, plan_fname,
+           prefetch, stage_args):
+    """Re-run only failed or missing work.
+
+    A stage is re-run for a subject if the manifest has no successful run of
+    it or any of its outputs is missing. Outputs of unfinished runs are
+    overwritten.
+    """
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    _run_stages(stages, subjects, n_cores, memory, n_workers, n_jobs,
+                True, stage_args, only_missing=True, plan_fname=plan_fname,
+                prefetch=prefetch)
+
+
+@cli.command()
+@click.option("--stage", "stages", multiple=True,
+              default=list(STAGES), show_default=True,
+              type=click.Choice(list(STAGES)),
+              help="Stage(s) to summarize")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to summarize, e.g., '1-10,12' (default: all)")
+def status(stages, subjects):
+    """Summarize progress, throughput and failures of cohort runs."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+
+    summary, failures = [], []
+    for stage in stages:
+        records = [read_record(stage, subj) for subj in subjects]
+        records = [record for record in records if record is not None]
+        done = [record for record in records if record['status'] == 'done']
+        failed = [record for record in records
+                  if record['status'] == 'failed']
+        running = [record for record in records
+                   if record['status'] == 'running']
+        n_missing = sum(needs_run(stage, subj) for subj in subjects)
+
+        durations = np.array([record['duration'] for record in done])
+        if len(done):
+            # subjects finished per hour, from the first start to the last end
+            span = max(record['finished'] for record in done) \
+                - min(record['started'] for record in done)
+            throughput = len(done) / span * 3600 if span > 0 else np.nan
+        else:
+            throughput = np.nan
+
+        summary.append(dict(
+            stage=stage,
+            done=len(done),
+            failed=len(failed),
+            running=len(running),
+            to_do=n_missing,
+            median_minutes=np.median(durations) / 60 if len(done) else np.nan,
+            max_minutes=durations.max() / 60 if len(done) else np.nan,
+            subjects_per_hour=throughput,
+        ))
+        for record in failed:
+            error = (record['error'] or '').strip().splitlines()
+            failures.append(dict(
+                stage=stage,
+                subject=record['subject'],
+                attempts=record.get('attempts'),
+                host=record['host'],
+                finished=time.strftime('%Y-%m-%d %H:%M',
+                                       time.localtime(record['finished'])),
+                error=error[-1] if error else '',
+            ))
+
+    logger.info('\n' + pd.DataFrame(summary).to_string(
+        index=False, float_format='%.1f') + '\n')
+    if failures:
+        logger.info('Failures:\n' + pd.DataFrame(failures).to_string(
+            index=False) + '\n')
+
+
+@cli.command()
+@click.option("--kind", "kinds", multiple=True,
+              type=click.Choice(SUBJECT_KINDS),
+              help="Kind(s) of files to check (default: all)")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to check, e.g., '1-10,12' (default: all)")
+def files(kinds, subjects):
+    """Show which input and output files exist for the cohort."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    table = get_layout().table(kinds or None, subjects)
+
+    summary = pd.DataFrame(dict(
+        exist=table.sum(),
+        missing=(~table).sum(),
+        missing_subjects=[', '.join(str(subj) for subj in
+                                    table.index[~table[kind]])
+                          for kind in table],
+    ))
+    logger.info('\n' + summary.to_string() + '\n')
+
+
+@cli.command("preflight")
+@click.option("--stage", "stages", multiple=True,
+              default=list(STAGES), show_default=True,
+              type=click.Choice(list(STAGES)),
+              help="Stage(s) to estimate")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to estimate, e.g., '1-10,12' (default: all)")
+@click.option("--output", default=None, type=str,
+              help="Directory of the plan (default: derivatives/preflight)")
+def preflight_command(stages, subjects, output):
+    """Estimate runtime and memory of each subject from file headers."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    recordings, model, plan = estimate_cohort(subjects, list(stages), output)
+
+    logger.info('\nRecordings:\n' + recordings.drop(columns='error')
+                .describe().loc[['mean', 'min', 'max']]
+                .to_string(float_format='%.1f'))
+    logger.info('\nCost model (per million samples):\n'
+                + model.to_string(float_format='%.4f'))
+    summary = plan.groupby('stage', sort=False).agg(
+        total_minutes=('minutes', 'sum'),
+        max_minutes=('minutes', 'max'),
+        max_memory_gb=('memory_gb', 'max'),
+    )
+    logger.info('\nEstimates:\n' + summary.to_string(float_format='%.1f')
+                + '\n')
+
+
+def _worker(queue_kwargs, poll, heartbeat, run_kwargs):
+    """Process tasks of the work queue (runs in its own process)."""
+    queue = WorkQueue(**queue_kwargs)
+    run_task = partial(run_stage, **run_kwargs)
+    work(queue, run_task, poll=poll, heartbeat=heartbeat)
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@click.option("--stage", "stages", multiple=True, required=True,
+              type=click.Choice(list(STAGES)),
+              help="Stage(s) to run, in the given order")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to process, e.g., '1-10,12' (default: all)")
+@click.option("--queue", "queue_root", default=None, type=str,
+              help="Path to the shared queue directory "
+                   "(default: `derivatives/queue`)")
+@click.option("--n_cores", default=None, type=int,
+              help="Number of cores to use on this machine")
+@click.option("--memory", default=None, type=float,
+              help="Memory to use on this machine in GB")
+@click.option("--n_workers", default=None, type=int,
+              help="Number of workers to start on this machine")
+@click.option("--stale_after", default=600., type=float,
+              help="Seconds without heartbeat after which a task is "
+                   "considered abandoned")
+@click.option("--heartbeat", default=30., type=float,
+              help="Seconds between two heartbeats of a running task")
+@click.option("--max_retries", default=3, type=int,
+              help="Number of attempts per task")
+@click.option("--poll", default=30., type=float,
+              help="Seconds to wait when no task is available")
+@click.option("--overwrite", default=False, type=bool, help="Overwrite?")
+@click.argument("stage_args", nargs=-1, type=click.UNPROCESSED)
+def worker(stages, subjects, queue_root, n_cores, memory, n_workers,
+           stale_after, heartbeat, max_retries, poll, overwrite, stage_args):
+    """Process tasks from a queue shared by several machines."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    if queue_root is None:
+        queue_root = get_dir('queue')
+
+    # plan for the most demanding stage
+    stage = max(stages, key=lambda name: STAGES[name]['memory_gb'])
+    plan = plan_resources(stage, len(subjects), n_cores, memory)
+    if n_workers is not None:
+        n_jobs = max((n_cores or get_n_cores()) // n_workers, 1)
+        plan = plan._replace(n_workers=n_workers, n_jobs=n_jobs,
+                             n_threads=n_jobs)
+    logger.info(f"\nStarting {plan.n_workers} workers: "
+                f"n_jobs={plan.n_jobs}, threads={plan.n_threads}\n")
+
+    queue_kwargs = dict(root=queue_root,
+                        stages=stages,
+                        subjects=subjects,
+                        stale_after=stale_after,
+                        max_retries=max_retries)
+    run_kwargs = dict(n_jobs=plan.n_jobs,
+                      n_threads=plan.n_threads,
+                      overwrite=overwrite,
+                      stage_args=stage_args)
+
+    workers = [Process(target=_worker,
+                       args=(queue_kwargs, poll, heartbeat, run_kwargs))
+               for _ in range(plan.n_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    queue = WorkQueue(**queue_kwargs)
+    summary = queue.summary()
+    queue.close()
+    logger.info(f"\nQueue: {summary}\n")
+    if summary.get('failed', 0) or summary.get('blocked', 0):
+        sys.exit(1)
+
+
+@cli.command()
+@click.option("--textfile", default=None, type=str,
+              help="File to write (default: "
+                   "derivatives/metrics/uva_pipeline.prom)")
+@click.option("--every", default=0., type=float,
+              help="Update the file every n seconds (default: once)")
+@click.option("--queue", "with_queue", default=False, type=bool,
+              help="Include the state of the work queue?")
+@click.option("--stage", "stages", multiple=True,
+              default=list(STAGES), show_default=True,
+              type=click.Choice(list(STAGES)),
+              help="Stages of the work queue")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects of the work queue, e.g., '1-10,12' "
+                   "(default: all)")
+def metrics(textfile, every, with_queue, stages, subjects):
+    """Export metrics of pipeline runs for Prometheus."""
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    while True:
+        queue_counts = None
+        if with_queue:
+            queue = WorkQueue(get_dir('queue'), stages, subjects)
+            queue_counts = queue.summary()
+            queue.close()
+        fname = write_textfile(textfile, queue_counts=queue_counts)
+        if not every:
+            break
+        time.sleep(every)
+    logger.info(f"Metrics written to {fname}")
+
+
+@cli.command()
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to render, e.g., '1-10,12' (default: all)")
+@click.option("--n_jobs", default=None, type=int,
+              help="Number of processes to use (default: all cores)")
+@click.option("--dpi", default=100, type=int, help="Resolution of figures")
+@click.option("--overwrite", default=False, type=bool,
+              help="Re-render figures that are up to date?")
+def render_qc(subjects, n_jobs, dpi, overwrite):
+    """Render quality-control figures from saved results.
+
+    Figures whose inputs did not change since they were rendered are skipped.
+    """
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    if n_jobs is None:
+        n_jobs = get_n_cores()
+
+    failed = render_cohort(subjects, n_jobs=n_jobs, dpi=dpi,
+                           overwrite=overwrite)
+    if failed:
+        logger.info(f"\nRendering failed for subjects: {failed}\n")
+        sys.exit(1)
+
+
+@cli.command()
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to show, e.g., '1-10,12' (default: all)")
+@click.option("--fields", default=None, type=str,
+              help="Comma separated QC fields to show (default: all)")
+@click.option("--query", default=None, type=str,
+              help="Only show subjects matching a pandas query, "
+                   "e.g., 'n_epochs_dropped > 20'")
+def qc(subjects, fields, query):
+    """Show the quality-control index."""
+    index = load_qc_index()
+    if subjects is not None:
+        subjects = parse_subjects(subjects, SUBJECT_IDS)
+        index = index[index.index.isin(subjects)]
+    if query is not None:
+        index = index.query(query)
+    if fields is not None:
+        index = index[[field.strip() for field in fields.split(',')]]
+
+    logger.info('\n' + index.to_string() + '\n')
+
+
+@cli.command("grand-average")
+@click.option("--subjects", default=None, type=str,
+              help="Subjects to include, e.g., '1-10,12' (default: all)")
+@click.option("--rebuild", default=False, type=bool,
+              help="Rebuild from all subjects instead of updating?")
+def grand_average(subjects, rebuild):
+    """Update the grand average of the condition ERPs.
+
+    Only subjects whose ERPs changed since the last update are read (see
+    ``erp_aggregation.py``).
+    """
+    subjects = parse_subjects(subjects, SUBJECT_IDS)
+    if rebuild:
+        reset_grand_average()
+    update_grand_average(subjects)
+
+
+@cli.command()
+@click.option("--subj", default=None, type=int,
+              help="Subject whose recording to monitor (file in sourcedata)")
+@click.option("--fname", default=None, type=str,
+              help="Path to the .bdf file (instead of --subj)")
+@click.option("--replay", default=None, type=float,
+              help="Replay a finished recording at this speed "
+                   "(e.g., 1 for real time) instead of following it")
+@click.option("--report_every", default=30., type=float,
+              help="Seconds of data between two summaries")
+@click.option("--output", default=None, type=str,
+              help="Save the classified trials to this .tsv file")
+def monitor(subj, fname, replay, report_every, output):
+    """Monitor a recording while it is acquired.
+
+    Follows the .bdf file as it grows, classifies DPX trials as they arrive
+    and reports accuracy, reaction times and signal quality.
+    """
+    if fname is None:
+        if subj is None:
+            raise click.UsageError("Use --subj or --fname")
+        fname = get_fname('sourcedata', subj)
+
+    trials = monitor_recording(fname, event_id,
+                               follow=replay is None,
+                               speed=replay,
+                               report_every=report_every)
+    if output is not None:
+        trials.to_csv(output, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,252 @@
+"""Cost estimates of a cohort before it is processed.
+
+Only the headers of the .bdf files and the events of the BIDS dataset are
+read (no data), which takes a fraction of a second per subject. From the size
+of the data each stage processes (the whole recording for ``bids``, the two
+task blocks for the other stages), runtime and peak memory are estimated with
+a linear model per stage, which is fitted to the runs recorded in the
+manifest (see ``manifest.py``). Stages that were never run fall back to their
+profile in ``STAGES`` (see ``config.py``), assumed for a subject of median
+size.
+
+The resulting plan lists the subjects of each stage from the longest to the
+shortest, which keeps a long subject from being started last and holding up
+the whole batch (see ``python pipeline.py run --plan``).
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from mne.utils import logger
+
+from config import STAGES, task_events
+
+from bdf_io import read_bdf_header, n_available_records
+
+from layout import get_dir, get_fname, get_layout
+
+from manifest import read_records
+
+from utils import find_task_blocks
+
+# stages that process the whole recording, the others only the task blocks
+WHOLE_RECORDING = ('bids',)
+
+
+def read_recording(subj):
+    """Information about the recording of a subject (headers only).
+
+    The BIDS dataset is used if the subject was already converted, otherwise
+    the source data (without events).
+    """
+    info = dict(subject=int(subj), source=None, sfreq=np.nan,
+                n_channels=np.nan, duration=np.nan, size_mb=np.nan,
+                n_events=np.nan, n_cues=np.nan, n_probes=np.nan,
+                n_reactions=np.nan, n_breaks=np.nan, task_duration=np.nan,
+                error=None)
+
+    layout = get_layout()
+    for source in ('bids', 'sourcedata'):
+        if layout.exists(source, subj):
+            info['source'] = source
+            break
+    else:
+        info['error'] = 'no recording found'
+        return info
+    fname = get_fname(info['source'], subj)
+
+    header = read_bdf_header(fname)
+    n_records = header['n_records']
+    if n_records < 0:
+        # the recording was not stopped properly
+        n_records = n_available_records(fname, header)
+    info.update(sfreq=header['sfreq'],
+                n_channels=header['n_channels'],
+                duration=n_records * header['record_duration'],
+                size_mb=os.path.getsize(fname) / 1024 ** 2)
+    # without events, assume the whole recording is processed
+    info['task_duration'] = info['duration']
+
+    if info['source'] != 'bids' or not layout.exists('bids_events', subj):
+        return info
+
+    events = pd.read_csv(get_fname('bids_events', subj), sep='\t')
+    names = events.trial_type.astype(str)
+    codes = names.map(task_events)
+    info.update(n_events=len(events),
+                n_cues=int(names.str.startswith('cue').sum()),
+                n_probes=int(names.str.startswith('probe').sum()),
+                n_reactions=int(names.str.contains('correct').sum()))
+
+    # same selection of cues as in ``01_run_preprocessing.py``
+    latencies = events.onset[(codes >= 1) & (codes <= 7)].to_numpy()
+    try:
+        breaks, blocks = find_task_blocks(latencies, subj)
+    except ValueError as err:
+        info['error'] = str(err)
+        return info
+    info.update(n_breaks=len(breaks),
+                task_duration=sum(stop - start for start, stop in blocks))
+
+    return info
+
+
+def read_recordings(subjects):
+    """Information about the recordings of several subjects."""
+    return pd.DataFrame([read_recording(subj) for subj in subjects]) \
+        .set_index('subject')
+
+
+def data_size(recordings, stage):
+    """Amount of data a stage processes (in millions of samples)."""
+    duration = recordings.duration if stage in WHOLE_RECORDING \
+        else recordings.task_duration
+    return duration * recordings.sfreq * recordings.n_channels / 1e6
+
+
+def _fit_linear(size, values, default, reference):
+    """Fit ``values = slope * size + offset``.
+
+    With runs of a single data size, the values are assumed to be
+    proportional to the size. Without runs, ``default`` is assumed for data
+    of the ``reference`` size.
+    """
+    valid = np.isfinite(size) & np.isfinite(values) & (size > 0)
+    size, values = size[valid], values[valid]
+    if len(values) == 0:
+        if not np.isfinite(reference) or reference <= 0:
+            return 0., float(default)
+        return float(default / reference), 0.
+    if len(np.unique(size)) < 2:
+        return float(np.mean(values / size)), 0.
+
+    slope, offset = np.polyfit(size, values, 1)
+    if slope <= 0:
+        # no measurable dependence on the data size
+        return 0., float(np.median(values))
+    return float(slope), float(max(offset, 0.))
+
+
+def fit_cost_model(recordings, stages=None, records=None):
+    """Fit runtime and peak memory of each stage to past runs.
+
+    Parameters
+    ----------
+    recordings : pd.DataFrame
+        Recordings of the subjects, see ``read_recordings``. Only runs of
+        these subjects are used.
+    stages : list of str | None
+        The stages (default: all).
+    records : list of dict | None
+        Records of past runs (default: all records in the manifest).
+
+    Returns
+    -------
+    model : pd.DataFrame
+        Slope and offset of minutes and of memory (in GB) per million
+        samples, and the number of runs the fit is based on, one row per
+        stage.
+    """
+    stages = list(STAGES) if stages is None else stages
+    if records is None:
+        records = read_records(stages)
+    runs = pd.DataFrame([record for record in records
+                         if record.get('status') == 'done'],
+                        columns=['stage', 'subject', 'duration',
+                                 'peak_memory_gb'])
+
+    model = []
+    for stage in stages:
+        profile = STAGES[stage]
+        stage_runs = runs[(runs.stage == stage)
+                          & runs.subject.isin(recordings.index)]
+        size = data_size(recordings.loc[stage_runs.subject], stage) \
+            .to_numpy(dtype=float)
+        minutes = stage_runs.duration.to_numpy(dtype=float) / 60
+        memory = stage_runs.peak_memory_gb.to_numpy(dtype=float)
+
+        # the profiles are for a typical subject of the cohort
+        reference = data_size(recordings, stage).median()
+        minutes_slope, minutes_offset = _fit_linear(
+            size, minutes, profile['minutes'], reference)
+        memory_slope, memory_offset = _fit_linear(
+            size, memory, profile['memory_gb'], reference)
+        model.append(dict(stage=stage,
+                          minutes_slope=minutes_slope,
+                          minutes_offset=minutes_offset,
+                          memory_slope=memory_slope,
+                          memory_offset=memory_offset,
+                          n_runs=int(np.isfinite(minutes).sum())))
+
+    return pd.DataFrame(model).set_index('stage')
+
+
+def estimate_costs(recordings, model):
+    """Estimated runtime and peak memory of each stage and subject.
+
+    Subjects without recording get the most expensive estimate of the
+    cohort, so that they are not scheduled last by mistake.
+    """
+    plan = []
+    for stage, params in model.iterrows():
+        size = data_size(recordings, stage)
+        minutes = params.minutes_slope * size + params.minutes_offset
+        memory = params.memory_slope * size + params.memory_offset
+        plan.append(pd.DataFrame(dict(
+            stage=stage,
+            subject=recordings.index,
+            size=size.to_numpy(),
+            minutes=minutes.fillna(minutes.max()).to_numpy(),
+            memory_gb=memory.fillna(memory.max()).to_numpy(),
+        )))
+
+    plan = pd.concat(plan, ignore_index=True)
+    # longest first within each stage, in the order of the stages
+    plan['stage'] = pd.Categorical(plan.stage, categories=list(model.index),
+                                   ordered=True)
+    plan = plan.sort_values(['stage', 'minutes'], ascending=[True, False],
+                            kind='stable')
+    plan['stage'] = plan.stage.astype(str)
+    return plan.reset_index(drop=True)
+
+
+def _fname(kind, root):
+    """File in ``root`` named like the one of the layout."""
+    return os.path.join(root, os.path.basename(get_fname(kind)))
+
+
+def preflight(subjects, stages=None, root=None):
+    """Estimate the costs of a cohort and write the plan.
+
+    Writes ``recordings.tsv``, ``cost_model.tsv`` and ``plan.tsv`` to
+    ``root`` (default: ``derivatives/preflight``).
+
+    Returns
+    -------
+    recordings, model, plan : pd.DataFrame
+        See ``read_recordings``, ``fit_cost_model`` and ``estimate_costs``.
+    """
+    root = get_dir('preflight') if root is None else root
+    os.makedirs(root, exist_ok=True)
+
+    recordings = read_recordings(subjects)
+    for subj, error in recordings.error.dropna().items():
+        logger.info(f"    > Subject {subj}: {error}")
+
+    model = fit_cost_model(recordings, stages)
+    plan = estimate_costs(recordings, model)
+
+    recordings.to_csv(_fname('preflight_recordings', root), sep='\t')
+    model.to_csv(_fname('preflight_cost_model', root), sep='\t')
+    plan.to_csv(_fname('preflight_plan', root), sep='\t', index=False,
+                float_format='%.3f')
+
+    return recordings, model, plan
+
+
+def read_plan(fname=None):
+    """Read a plan written by ``preflight``."""
+    if fname is None:
+        fname = get_fname('preflight_plan')
+    return pd.read_csv(fname, sep='\t')
@@ -0,0 +1,204 @@
+"""Rendering of quality-control figures.
+
+Figures are rendered from the files saved by the pipeline scripts (e.g., the
+ICA solution saved by ``01_run_preprocessing.py``), so that plotting does not
+slow down the preprocessing itself. Subjects are rendered in a pool of
+background processes using matplotlib's non-interactive Agg backend.
+
+Topographies are drawn like ``ICA.plot_components``: channel positions,
+head outlines and the (cubic, extrapolated) interpolation are set up with
+mne's topomap functions. The setup only depends on the channel positions. It
+is done once per process and montage and re-used for all components and
+subjects, which leaves only the interpolation of the values of each
+component.
+"""
+import os
+import json
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from mne.utils import logger
+
+from layout import get_fname, get_layout
+
+from utils import write_json
+
+# version of the rendering code, figures of older versions are re-rendered
+RENDER_VERSION = 2
+
+# topomap setups, one per set of channel positions
+_TOPOMAPS = {}
+
+
+def init_worker():
+    """Set up a worker process for rendering figures."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def get_topomap(info, res=64):
+    """Set up the topographies of EEG channels like ``ICA.plot_components``.
+
+    Parameters
+    ----------
+    info : mne.Info
+        Measurement info with the channel positions.
+    res : int
+        Number of pixels along each side of the image.
+
+    Returns
+    -------
+    topomap : dict
+        ``picks`` (good EEG channels), their 2D positions ``pos``, the head
+        ``outlines``, the ``extrapolate`` mode, the interpolator ``interp``
+        (evaluated on the image grid ``Xi``, ``Yi``) and the ``extent`` of
+        the image.
+    """
+    from mne.viz.topomap import (_check_extrapolate, _make_head_outlines,
+                                 _prepare_topomap_plot, _setup_interp)
+
+    picks, pos, _, _, ch_type, sphere, clip_origin = _prepare_topomap_plot(
+        info, 'eeg')
+    key = (np.round(pos, 6).tobytes(), res)
+    if key in _TOPOMAPS:
+        return _TOPOMAPS[key]
+
+    outlines = _make_head_outlines(sphere, pos, 'head', clip_origin)
+    extrapolate = _check_extrapolate('auto', ch_type)
+    extent, Xi, Yi, interp = _setup_interp(pos, res, 'cubic', extrapolate,
+                                           outlines, 'mean')
+    interp.set_locations(Xi, Yi)
+
+    topomap = dict(picks=picks, pos=pos, outlines=outlines,
+                   extrapolate=extrapolate, interp=interp, Xi=Xi, Yi=Yi,
+                   extent=extent)
+    _TOPOMAPS[key] = topomap
+    return topomap
+
+
+def _file_hash(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _sidecar(fig_fname):
+    return fig_fname + '.json'
+
+
+def is_current(fig_fname, inputs):
+    """Whether a figure was rendered from the same inputs."""
+    try:
+        with open(_sidecar(fig_fname)) as sidecar:
+            return json.load(sidecar) == inputs and os.path.exists(fig_fname)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def plot_ica_components(ica, res=64):
+    """Plot topographies of all ICA components in a single figure.
+
+    Excluded components are marked with red titles.
+    """
+    import matplotlib.pyplot as plt
+    from mne.viz.topomap import _draw_outlines, _make_head_patch
+
+    topomap = get_topomap(ica.info, res)
+    interp, pos = topomap['interp'], topomap['pos']
+
+    # maps of the channels of the topographies: (n_channels, n_components)
+    maps = ica.get_components()[topomap['picks']]
+
+    n_components = maps.shape[1]
+    n_cols = int(np.ceil(np.sqrt(n_components)))
+    n_rows = int(np.ceil(n_components / n_cols))
+    fig, axes = plt.subplots(n_rows, n_cols,
+                             figsize=(1.5 * n_cols, 1.5 * n_rows),
+                             squeeze=False)
+    for comp, ax in enumerate(axes.ravel()):
+        ax.set_axis_off()
+        if comp >= n_components:
+            continue
+        image = interp.set_values(maps[:, comp])()
+        vmax = np.abs(maps[:, comp]).max()
+        im = ax.imshow(image, origin='lower', extent=topomap['extent'],
+                       cmap='RdBu_r', vmin=-vmax, vmax=vmax,
+                       interpolation='bilinear')
+        contours = ax.contour(topomap['Xi'], topomap['Yi'], image, 6,
+                              colors='k', linewidths=0.5)
+        # clip the image at the head (or at the outermost channels)
+        patch = _make_head_patch(topomap['outlines'],
+                                 topomap['extrapolate'], interp, ax)
+        im.set_clip_path(patch)
+        contours.set_clip_path(patch)
+        _draw_outlines(ax, topomap['outlines'])
+        ax.scatter(pos[:, 0], pos[:, 1], s=0.5, c='k')
+        ax.set_aspect('equal')
+        ax.set_title('ICA%03d' % comp, fontsize=8,
+                     color='red' if comp in ica.exclude else 'black')
+    fig.tight_layout()
+
+    return fig
+
+
+def render_ica_figure(subj, dpi=100, overwrite=False):
+    """Render the ICA component figure of a subject.
+
+    The figure is skipped if it was already rendered from the same ICA
+    solution (unless ``overwrite`` is True). Returns True if the figure was
+    rendered.
+    """
+    import matplotlib.pyplot as plt
+    from mne.preprocessing import read_ica
+
+    ica_fname = get_fname('ica', subj)
+    fig_fname = get_fname('ica_figure', subj)
+
+    inputs = dict(ica=_file_hash(ica_fname), dpi=dpi,
+                  version=RENDER_VERSION)
+    if not overwrite and is_current(fig_fname, inputs):
+        return False
+
+    ica = read_ica(ica_fname, verbose=False)
+    fig = plot_ica_components(ica)
+    os.makedirs(os.path.dirname(fig_fname), exist_ok=True)
+    fig.savefig(fig_fname, dpi=dpi, facecolor='white')
+    plt.close(fig)
+
+    write_json(_sidecar(fig_fname), inputs)
+
+    return True
+
+
+def render_cohort(subjects, n_jobs=1, dpi=100, overwrite=False):
+    """Render figures of several subjects in a pool of processes.
+
+    Subjects without ICA solution are skipped. Returns the subjects for which
+    rendering failed.
+    """
+    subjects = get_layout().table(['ica'], subjects).query('ica').index \
+        .tolist()
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             initializer=init_worker) as executor:
+        futures = {executor.submit(render_ica_figure, subj, dpi, overwrite):
+                   subj for subj in subjects}
+        for future in as_completed(futures):
+            subj = futures[future]
+            try:
+                rendered = future.result()
+            except Exception as err:
+                logger.info(f"    > Rendering failed for subject {subj}: "
+                            f"{err!r}")
+                failed.append(subj)
+                continue
+            logger.info(f"    > Subject {subj}: " +
+                        ('rendered' if rendered else 'up to date'))
+
+    return failed
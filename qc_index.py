@@ -0,0 +1,127 @@
+"""Index of quality-control information of all subjects.
+
+Each stage adds its QC information (e.g., interpolated channels, excluded
+ICA components, dropped epochs and runtimes) to a small per-subject file in
+``derivatives/qc``. Files are replaced atomically, so readers never see
+half-written records.
+
+``load_qc_index`` merges these files into a single index
+(``derivatives/qc/qc_index.json``). Only subject files that changed since the
+index was last written are read again, so the index of the whole cohort is
+available in a few milliseconds.
+"""
+import os
+import json
+import time
+
+from pathlib import Path
+
+import pandas as pd
+
+from layout import get_dir, get_fname
+
+from utils import write_json
+
+
+def _fname(kind, subj=None, root=None):
+    """File in ``root`` named like the one of the layout."""
+    fname = Path(get_fname(kind, subj))
+    return fname if root is None else Path(root) / fname.name
+
+
+def read_qc(subj, root=None):
+    """QC record of a subject (empty record if missing)."""
+    try:
+        with open(_fname('qc', subj, root)) as record:
+            return json.load(record)
+    except (FileNotFoundError, ValueError):
+        return dict(subject=int(subj), runtimes={})
+
+
+def update_qc(subj, stage, runtime=None, root=None, **fields):
+    """Add QC information of a stage to the record of a subject.
+
+    Parameters
+    ----------
+    subj : int
+        The subject.
+    stage : str
+        The stage that produced the information.
+    runtime : float | None
+        Runtime of the stage in seconds.
+    root : str | Path | None
+        Directory of the index (default: ``derivatives/qc``).
+    **fields
+        The QC information, must be JSON serializable (numpy types are
+        converted).
+    """
+    fname = _fname('qc', subj, root)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+
+    record = read_qc(subj, root)
+    record.update(fields)
+    if runtime is not None:
+        record['runtimes'][stage] = runtime
+    record['updated'] = time.time()
+    write_json(fname, record)
+
+    return record
+
+
+def load_qc_index(root=None):
+    """QC information of all subjects.
+
+    Returns
+    -------
+    index : pd.DataFrame
+        One row per subject, one column per QC field. Runtimes of the stages
+        are in the columns ``runtime_<stage>``.
+    """
+    root = get_dir('qc') if root is None else Path(root)
+    index_fname = _fname('qc_index', root=root)
+
+    try:
+        with open(index_fname) as index:
+            index = json.load(index)
+    except (FileNotFoundError, ValueError):
+        index = dict(mtimes={}, records={})
+
+    # only read subject files that changed since the index was written
+    changed = False
+    found = set()
+    if root.exists():
+        for entry in os.scandir(root):
+            if not (entry.name.startswith('sub-')
+                    and entry.name.endswith('.json')):
+                continue
+            found.add(entry.name)
+            mtime = entry.stat().st_mtime
+            if index['mtimes'].get(entry.name) == mtime:
+                continue
+            try:
+                with open(entry.path) as record:
+                    index['records'][entry.name] = json.load(record)
+            except (FileNotFoundError, ValueError):
+                continue
+            index['mtimes'][entry.name] = mtime
+            changed = True
+
+    # subjects whose files were removed
+    for name in set(index['records']) - found:
+        del index['records'][name]
+        del index['mtimes'][name]
+        changed = True
+
+    if changed:
+        write_json(index_fname, index)
+
+    records = []
+    for record in index['records'].values():
+        record = dict(record)
+        for stage, runtime in record.pop('runtimes', {}).items():
+            record['runtime_%s' % stage] = runtime
+        records.append(record)
+    if not records:
+        return pd.DataFrame(columns=['subject']).set_index('subject')
+
+    return pd.DataFrame(records).set_index('subject').sort_index()
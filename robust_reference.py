@@ -0,0 +1,499 @@
+"""Robust average reference of PREP with vectorized bad-channel detection.
+
+PyPREP's robust referencing (``pyprep.Reference``) detects noisy channels,
+interpolates them and re-references the data until the bad channels do not
+change, and then twice more after the final reference. Each detection
+(``NoisyChannels``) copies the data, filters it again and loops over 1 s
+windows for the correlation criterion, and each interpolation copies the
+data again.
+
+``RobustReference`` does the same with fewer passes over the data:
+
+- every step (re-referencing, spherical-spline interpolation) multiplies the
+  EEG with a matrix of shape (n_channels, n_channels) from the left, and the
+  trend removal and the low-pass filter of the detection are linear, so the
+  data are filtered once and each detection only needs the product of these
+  matrices with the filtered data,
+- the interpolation matrix of a set of bad channels is computed once (with
+  mne, so it is the same) and reused in later iterations,
+- the statistics of all 1 s windows (MAD, correlations and their quantiles)
+  are computed in batches of windows instead of window by window.
+
+The criteria (NaN, flat, deviation, high-frequency noise, correlation,
+dropout, SNR and PSD) and their thresholds are those of PyPREP without
+RANSAC (``ransac=False``, ``matlab_strict=False``). Bad channels and data
+match those of PyPREP up to floating point errors (see
+``benchmarks/bench_reference.py``).
+"""
+import numpy as np
+
+from scipy.signal import filtfilt
+
+from mne.io import RawArray
+from mne.time_frequency import psd_array_welch
+from mne.utils import logger
+
+from pyprep.removeTrend import removeTrend
+from pyprep.utils import _filter_design
+
+# robust estimates of the standard deviation
+IQR_TO_SD = 0.7413
+MAD_TO_SD = 1.4826
+
+BAD_TYPES = ('bad_by_nan', 'bad_by_flat', 'bad_by_deviation',
+             'bad_by_hf_noise', 'bad_by_correlation', 'bad_by_SNR',
+             'bad_by_dropout', 'bad_by_psd', 'bad_by_ransac')
+
+
+def _quantiles(data, quantiles):
+    """MATLAB-style quantiles along the last axis (as in PyPREP)."""
+    n = data.shape[-1]
+    if n < 2:
+        return [data[..., 0] if n else np.nan for _ in quantiles]
+    # numpy's (vectorized) sort is faster than its partition
+    data = np.sort(data, axis=-1)
+    values = []
+    for q in quantiles:
+        exact = (n - 1) * np.clip((q - 0.5) * n / (n - 1) + 0.5, 0, 1)
+        pre, post = int(np.floor(exact)), int(np.ceil(exact))
+        values.append(data[..., pre]
+                      + (data[..., post] - data[..., pre]) * (exact - pre))
+    return values
+
+
+def _iqr(data):
+    upper, lower = _quantiles(data, (0.75, 0.25))
+    return upper - lower
+
+
+def _middle(data):
+    """Median of data that are sorted along the last axis (like np.median)."""
+    middle = data.shape[-1] // 2
+    if data.shape[-1] % 2:
+        median = data[..., middle]
+    else:
+        median = (data[..., middle - 1] + data[..., middle]) / 2
+    # NaNs are sorted to the end
+    return np.where(np.isnan(data[..., -1]), np.nan, median)
+
+
+def _median(data):
+    """Median along the last axis, same as ``np.median`` but faster."""
+    return _middle(np.sort(data, axis=-1))
+
+
+def _kth_deviation(data, median, kth):
+    """``np.sort(np.abs(data - median))[..., kth]`` of sorted ``data``.
+
+    The deviations of the values below the median and of the others are
+    two sorted sequences, the k-th smallest of both is found by a binary
+    search (vectorized over all rows).
+    """
+    n = data.shape[-1]
+    rows = data.reshape(-1, n)
+    median = median.reshape(-1)
+    # number of values below the median, i.e., in the first sequence
+    n_below = (rows < median[:, np.newaxis]).sum(axis=-1)
+
+    def below(idx):
+        """Deviation of the idx-th smallest deviation below the median."""
+        idx = np.clip(n_below - 1 - idx, 0, n - 1)
+        return median - rows[np.arange(len(rows)), idx]
+
+    def above(idx):
+        idx = np.clip(n_below + idx, 0, n - 1)
+        return rows[np.arange(len(rows)), idx] - median
+
+    # smallest number of values taken from the first sequence
+    low = np.maximum(0, kth + 1 - (n - n_below))
+    high = np.minimum(kth + 1, n_below)
+    while np.any(low < high):
+        idx = (low + high) // 2
+        other = kth + 1 - idx
+        too_few = (idx < n_below) & (other > 0) \
+            & (above(other - 1) > below(idx))
+        low = np.where((low < high) & too_few, idx + 1, low)
+        high = np.where((low < high) & ~too_few, idx, high)
+    other = kth + 1 - low
+    value = np.maximum(np.where(low > 0, below(low - 1), -np.inf),
+                       np.where(other > 0, above(other - 1), -np.inf))
+    return value.reshape(data.shape[:-1])
+
+
+def _mad(data):
+    """Median absolute deviation along the last axis."""
+    data = np.sort(data, axis=-1)
+    median = _middle(data)
+    n = data.shape[-1]
+    if n % 2:
+        mad = _kth_deviation(data, median, n // 2)
+    else:
+        mad = (_kth_deviation(data, median, n // 2 - 1)
+               + _kth_deviation(data, median, n // 2)) / 2
+    return np.where(np.isnan(median), np.nan, mad)
+
+
+def _robust_z(values):
+    sd = _mad(values) * MAD_TO_SD
+    if sd > 0:
+        return (values - np.median(values)) / sd
+    return np.zeros_like(values)
+
+
+def _max_correlations(windows):
+    """98th percentile of the absolute correlations of each channel.
+
+    ``windows`` has shape (n_windows, n_channels, n_samples).
+    """
+    centered = windows - windows.mean(axis=-1, keepdims=True)
+    corr = centered @ centered.swapaxes(-1, -2) / (windows.shape[-1] - 1)
+    std = np.sqrt(np.diagonal(corr, axis1=-2, axis2=-1))
+    corr /= std[..., :, np.newaxis]
+    corr /= std[..., np.newaxis, :]
+    corr = np.abs(np.clip(corr, -1, 1))
+    diagonal = np.arange(corr.shape[-1])
+    corr[..., diagonal, diagonal] = 0
+    # quantiles of the columns, like PyPREP
+    return _quantiles(corr.swapaxes(-1, -2), (0.98,))[0]
+
+
+def _correlation_windows(filtered, sfreq, batch_bytes=64e6):
+    """Maximum correlations and dropouts in windows of 1 s."""
+    n_channels, n_samples = filtered.shape
+    size = int(sfreq)
+    n_windows = len(np.arange(1, n_samples - size, size))
+    max_correlations = np.ones((n_windows, n_channels))
+    dropout = np.zeros((n_windows, n_channels), dtype=bool)
+    batch = max(int(batch_bytes // (8 * n_channels * size)), 1)
+
+    for start in range(0, n_windows, batch):
+        stop = min(start + batch, n_windows)
+        windows = filtered[:, start * size:stop * size].reshape(
+            n_channels, stop - start, size).transpose(1, 0, 2)
+        flat = _mad(windows) == 0
+        dropout[start:stop] = flat
+        complete = ~flat.any(axis=1)
+        if complete.any():
+            max_correlations[start:stop][complete] = _max_correlations(
+                windows[complete])
+        # windows with dropouts, correlations of the other channels
+        for idx in np.flatnonzero(~complete):
+            good = ~flat[idx]
+            max_correlations[start + idx, flat[idx]] = 0
+            if good.sum() > 1:
+                max_correlations[start + idx, good] = _max_correlations(
+                    windows[idx, good][np.newaxis])[0]
+    return max_correlations, dropout
+
+
+def lowpass(data, sfreq):
+    """The low-pass filter of PyPREP's bad-channel detection."""
+    if sfreq <= 100:
+        return data.copy()
+    kernel = _filter_design(N_order=100, amp=np.array([1, 1, 0, 0]),
+                            freq=np.array([0, 90 / sfreq, 100 / sfreq, 1]))
+    return filtfilt(kernel, 1, data, axis=1)
+
+
+def find_noisy_channels(data, filtered, sfreq, ch_names):
+    """Bad channels by the criteria of PyPREP's ``NoisyChannels``.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        Detrended EEG (without the channels that are already known to be bad).
+    filtered : ndarray, shape (n_channels, n_times)
+        The data after ``lowpass``.
+    sfreq : float
+        Sampling frequency.
+    ch_names : list of str
+        Names of the channels.
+
+    Returns
+    -------
+    noisy : dict
+        Names of the bad channels of each type (``bad_by_nan``,
+        ``bad_by_flat``, ``bad_by_deviation``, ...), as returned by
+        ``NoisyChannels.get_bads(as_dict=True)`` without RANSAC.
+    """
+    ch_names = np.asarray(ch_names)
+    bad = {key: np.zeros(len(ch_names), dtype=bool) for key in BAD_TYPES}
+    bad['bad_by_nan'] = np.isnan(data.sum(axis=1))
+    bad['bad_by_flat'] = (_mad(data) < 1e-15) | (data.std(axis=1) < 1e-15)
+    usable = ~(bad['bad_by_nan'] | bad['bad_by_flat'])
+    if not usable.all():
+        data, filtered = data[usable], filtered[usable]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # deviation: robust z-score of the amplitude
+        amplitudes = _iqr(data) * IQR_TO_SD
+        z = (amplitudes - np.nanmedian(amplitudes)) \
+            / (_iqr(amplitudes) * IQR_TO_SD)
+        bad['bad_by_deviation'][usable] = np.isnan(z) | (np.abs(z) > 5.)
+
+        # high-frequency noise: amplitude above 50 Hz relative to below
+        if sfreq > 100:
+            noisiness = _mad(data - filtered) / _mad(filtered)
+            median = np.nanmedian(noisiness)
+            z = (noisiness - median) \
+                / (np.median(np.abs(noisiness - median)) * MAD_TO_SD)
+            bad['bad_by_hf_noise'][usable] = np.isnan(z) | (z > 5.)
+
+    # correlation and dropouts in windows of 1 s
+    max_correlations, dropout = _correlation_windows(filtered, sfreq)
+    bad['bad_by_correlation'][usable] = \
+        (max_correlations < 0.4).mean(axis=0) > 0.01
+    bad['bad_by_dropout'][usable] = dropout.mean(axis=0) > 0.01
+    bad['bad_by_SNR'] = bad['bad_by_correlation'] & bad['bad_by_hf_noise']
+
+    # power spectrum: too much power in a band or more power at high than
+    # at low frequencies
+    psd, freqs = psd_array_welch(filtered, sfreq, fmin=1., fmax=45.,
+                                 n_fft=min(filtered.shape[1], 2048),
+                                 verbose=False)
+    log_psd = 10 * np.log10(psd)
+    bands = [log_psd[:, (freqs >= low) & (freqs < high)].sum(axis=1)
+             for low, high in ((1., 15.), (15., 30.))]
+    bands.append(log_psd[:, (freqs >= 30.) & (freqs <= 45.)].sum(axis=1))
+    bad['bad_by_psd'][usable] = np.any(
+        [_robust_z(band) > 3. for band in bands], axis=0) \
+        | (bands[2] > bands[0])
+
+    return {key: ch_names[mask].tolist() for key, mask in bad.items()}
+
+
+class RobustReference:
+    """Robust average reference of PREP (like ``pyprep.Reference``).
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The EEG channels (loaded, with a montage). Channels in
+        ``info['bads']`` are left out of the reference and interpolated.
+        The data are re-referenced in place by ``fit``.
+    ref_chs : list of str
+        Channels of the reference.
+    reref_chs : list of str
+        Channels that are re-referenced.
+    """
+
+    def __init__(self, raw, ref_chs, reref_chs):
+        self.raw = raw
+        self.ch_names = list(raw.ch_names)
+        self.sfreq = raw.info['sfreq']
+        self.bads_manual = list(raw.info['bads'])
+        self.ref_chs = self._indices(ref_chs)
+        self.reref_chs = self._indices(reref_chs)
+        self._interpolation = {}
+
+        self.noisy_channels_original = None
+        self.noisy_channels = None
+        self.noisy_channels_before_interpolation = None
+        self.noisy_channels_after_interpolation = None
+        self.bad_before_interpolation = None
+        self.unusable_channels = None
+        self.interpolated_channels = None
+        self.still_noisy_channels = None
+        self.reference_signal = None
+        self.reference_signal_new = None
+
+    def _indices(self, names):
+        names = set(names)
+        return np.array([idx for idx, name in enumerate(self.ch_names)
+                         if name in names], dtype=int)
+
+    def _names(self, names):
+        """Channel names in the order of the data."""
+        names = set(names)
+        return [name for name in self.ch_names if name in names]
+
+    def _interpolation_matrix(self, bads):
+        """Matrix that interpolates ``bads`` (mne's spherical splines)."""
+        key = frozenset(bads)
+        if key not in self._interpolation:
+            # interpolate the identity, i.e., each channel by itself
+            probe = RawArray(np.eye(len(self.ch_names)),
+                             self.raw.info.copy(), verbose=False)
+            probe.info['bads'] = self._names(bads)
+            probe.interpolate_bads(verbose=False)
+            self._interpolation[key] = probe.get_data()
+        return self._interpolation[key]
+
+    def _rereference(self, weights, channels):
+        """Matrix that subtracts ``weights @ data`` from ``channels``."""
+        matrix = np.eye(len(self.ch_names))
+        matrix[channels] -= weights
+        return matrix
+
+    def _detect(self, matrix, exclude, offset=None):
+        """Bad channels of ``matrix @ data - offset``.
+
+        ``matrix`` is ``None`` for the data as they are. ``offset`` is a
+        tuple of the coefficients of each channel, the signal that is
+        subtracted and the signal after ``lowpass`` (``None``: nothing).
+        """
+        exclude = set(exclude)
+        keep = [idx for idx, name in enumerate(self.ch_names)
+                if name not in exclude]
+        if matrix is None:
+            data, filtered = self._detrended[keep], self._filtered[keep]
+        else:
+            data = matrix[keep] @ self._detrended
+            filtered = matrix[keep] @ self._filtered
+        if offset is not None:
+            coefs, signal, filtered_signal = offset
+            data -= np.outer(coefs[keep], signal)
+            filtered -= np.outer(coefs[keep], filtered_signal)
+        noisy = find_noisy_channels(data, filtered, self.sfreq,
+                                    [self.ch_names[idx] for idx in keep])
+        noisy['bad_by_manual'] = self._names(exclude)
+        noisy['bad_all'] = self._names(
+            [name for names in noisy.values() for name in names])
+        return noisy
+
+    def fit(self, max_iterations=4):
+        """Estimate the reference, re-reference and interpolate bad channels.
+
+        Parameters
+        ----------
+        max_iterations : int
+            Maximum number of iterations of the robust referencing.
+        """
+        n_channels = len(self.ch_names)
+        data = self.raw._data
+        self._detrended = removeTrend(data, self.sfreq)
+        self._filtered = lowpass(self._detrended, self.sfreq)
+
+        # channels that are unusable for the reference
+        noisy = self._detect(None, self.bads_manual)
+        self.noisy_channels_original = noisy
+        self.unusable_channels = self._names(
+            noisy['bad_by_nan'] + noisy['bad_by_flat']
+            + noisy['bad_by_SNR'] + self.bads_manual)
+        reference = np.setdiff1d(self.ref_chs,
+                                 self._indices(self.unusable_channels))
+        logger.info(f"    > Unusable channels: {self.unusable_channels}")
+
+        # initial estimate of the reference: median of the reference channels
+        median = np.median(self._detrended[reference], axis=0)
+        coefs = np.zeros(n_channels)
+        coefs[reference] = 1.
+        offset = (coefs, median, lowpass(median[np.newaxis], self.sfreq)[0])
+        matrix = None
+
+        noisy = {key: [] for key in BAD_TYPES}
+        noisy.update(bad_by_nan=self.noisy_channels_original['bad_by_nan'],
+                     bad_by_flat=self.noisy_channels_original['bad_by_flat'],
+                     bad_by_manual=self.bads_manual)
+        exclude = self.bads_manual
+        iterations = 0
+        previous_bads = set()
+        while True:
+            noisy_new = self._detect(matrix, exclude, offset)
+            bads = set()
+            for bad_type, names in noisy_new.items():
+                noisy[bad_type] = self._names(noisy.get(bad_type, []) + names)
+                if bad_type not in ('bad_by_SNR', 'bad_all'):
+                    bads.update(noisy[bad_type])
+            noisy['bad_by_manual'] = self.bads_manual
+            noisy['bad_all'] = self._names(list(bads) + self.bads_manual)
+            logger.info(f"    > Iteration {iterations}, bad channels: "
+                        f"{noisy['bad_all']}")
+
+            if iterations > 1 and (not bads or bads == previous_bads) \
+                    or iterations > max_iterations:
+                break
+            previous_bads = bads.copy()
+
+            if n_channels - len(bads) < 2:
+                raise ValueError('Could not perform a robust reference, not '
+                                 'enough good channels.')
+
+            if bads:
+                # mean of the reference channels after interpolation
+                weights = self._interpolation_matrix(bads)[reference].mean(0)
+                shift = 0.
+                # interpolated channels are not excluded anymore
+                exclude = []
+            else:
+                # mean of the reference channels of the current data
+                weights = np.eye(n_channels)[reference].mean(axis=0) \
+                    if matrix is None else matrix[reference].mean(axis=0)
+                shift = 0. if offset is None else \
+                    offset[0][reference].mean()
+            # data minus the reference (``weights @ data - shift * signal``)
+            matrix = self._rereference(weights, reference)
+            if shift and offset is not None:
+                coefs = np.zeros(n_channels)
+                coefs[reference] = -shift
+                offset = (coefs, offset[1], offset[2])
+            else:
+                offset = None
+            iterations += 1
+        self.noisy_channels = noisy
+
+        # reference with the bad channels interpolated
+        interpolate = self._interpolation_matrix(noisy['bad_all'])
+        weights = interpolate[self.ref_chs].mean(axis=0)
+        self.reference_signal = weights @ data
+        matrix = self._rereference(weights, self.reref_chs)
+
+        # bad channels after referencing
+        noisy = self._detect(matrix, self.bads_manual)
+        self.bad_before_interpolation = noisy['bad_all']
+        noisy['bad_by_manual'] = self.bads_manual
+        self.noisy_channels_before_interpolation = noisy
+        bads = self._names(self.bad_before_interpolation
+                           + self.unusable_channels)
+
+        # interpolate them and re-reference
+        matrix = self._interpolation_matrix(bads) @ matrix
+        weights = matrix[self.ref_chs].mean(axis=0)
+        reference_correct = weights @ data
+        self.reference_signal_new = self.reference_signal + reference_correct
+        matrix[self.reref_chs] -= weights
+        self.interpolated_channels = bads
+
+        # remaining bad channels
+        noisy = self._detect(matrix, [])
+        self.noisy_channels_after_interpolation = noisy
+        self.still_noisy_channels = noisy['bad_all']
+        del self._detrended, self._filtered
+
+        self.raw._data = matrix @ data
+        self.raw.info['bads'] = self.still_noisy_channels
+        logger.info(f"    > Interpolated channels: "
+                    f"{self.interpolated_channels}, still noisy: "
+                    f"{self.still_noisy_channels}")
+        return self
+
+
+def robust_reference(prep, max_iterations=None):
+    """Robust referencing of a ``PrepPipeline`` with ``RobustReference``.
+
+    Replaces ``prep.robust_reference()`` and sets the same attributes of
+    ``prep`` (the bad channels of each step, the re-referenced data in
+    ``prep.raw_eeg``).
+    """
+    if prep.ransac_settings['ransac'] or prep.matlab_strict \
+            or prep.ransac_settings['reject_by_annotation'] is not None:
+        raise ValueError('The vectorized robust reference does not support '
+                         'RANSAC, matlab_strict and reject_by_annotation.')
+    if max_iterations is None:
+        max_iterations = prep.prep_params['max_iterations']
+
+    reference = RobustReference(prep.raw_eeg, prep.prep_params['ref_chs'],
+                                prep.prep_params['reref_chs'])
+    reference.fit(max_iterations)
+
+    prep.noisy_channels_original = reference.noisy_channels_original
+    prep.noisy_channels_before_interpolation = \
+        reference.noisy_channels_before_interpolation
+    prep.noisy_channels_after_interpolation = \
+        reference.noisy_channels_after_interpolation
+    prep.bad_before_interpolation = reference.bad_before_interpolation
+    prep.reference_before_interpolation = reference.reference_signal
+    prep.reference_after_interpolation = reference.reference_signal_new
+    prep.interpolated_channels = reference.interpolated_channels
+    prep.still_noisy_channels = reference.still_noisy_channels
+    return prep
@@ -0,0 +1,235 @@
+"""Resource-aware scheduling of the pipeline stages.
+
+Decides how many subjects can be processed concurrently on the current
+machine and how many cores each of them gets, i.e., the ``n_jobs`` passed to
+mne's filter functions and the number of BLAS/OpenMP threads used by PREP and
+ICA.
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+
+from uuid import uuid4
+
+from collections import deque, namedtuple
+from pathlib import Path
+
+from mne.utils import logger
+
+from config import STAGES, MEMORY_HEADROOM
+
+from manifest import expected_outputs, input_files, record_start, record_end
+
+from metrics import log_event, write_textfile
+
+# get path to current file
+parent = Path(__file__).parent.resolve()
+
+# environment variables that control the size of BLAS/OpenMP thread pools
+THREAD_VARS = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+)
+
+Plan = namedtuple('Plan', ['n_workers', 'n_jobs', 'n_threads'])
+
+
+def _cgroup_cpu_limit():
+    """CPU limit imposed by cgroups (e.g., containers or batch jobs)."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+    except (OSError, ValueError):
+        return None
+    if quota == 'max':
+        return None
+    return max(int(quota) // int(period), 1)
+
+
+def get_n_cores():
+    """Number of cores this process is allowed to use."""
+    try:
+        n_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cores = os.cpu_count() or 1
+
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        n_cores = min(n_cores, limit)
+
+    return max(n_cores, 1)
+
+
+def get_available_memory():
+    """Memory available for new processes (in GB)."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+    return pages * page_size / 1024 ** 3
+
+
+def plan_resources(stage, n_subjects, n_cores=None, memory=None,
+                   memory_gb=None):
+    """Decide how to distribute the machine among subjects.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage (see ``STAGES`` in ``config.py``).
+    n_subjects : int
+        Number of subjects to process.
+    n_cores : int | None
+        Number of cores to use. Defaults to all available cores.
+    memory : float | None
+        Memory to use in GB. Defaults to the memory currently available.
+    memory_gb : float | None
+        Peak memory of one subject in GB, e.g., as estimated by
+        ``preflight.py``. Defaults to the profile of the stage.
+
+    Returns
+    -------
+    plan : Plan
+        Number of subjects to process concurrently (``n_workers``), value of
+        ``n_jobs`` and of the BLAS/OpenMP thread limits for each of them.
+    """
+    profile = STAGES[stage]
+    if memory_gb is None:
+        memory_gb = profile['memory_gb']
+
+    if n_cores is None:
+        n_cores = get_n_cores()
+    if memory is None:
+        memory = get_available_memory()
+
+    # cores a single subject can make use of
+    per_subject = max(min(profile['max_jobs'], n_cores), 1)
+
+    # number of subjects that fit on the machine
+    n_workers = max(n_cores // per_subject, 1)
+    if memory is not None:
+        fit_in_memory = int(memory * MEMORY_HEADROOM // memory_gb)
+        n_workers = min(n_workers, max(fit_in_memory, 1))
+    n_workers = max(min(n_workers, n_subjects), 1)
+
+    # distribute the cores that are left among the workers
+    n_jobs = max(min(n_cores // n_workers, profile['max_jobs']), 1)
+
+    return Plan(n_workers=n_workers, n_jobs=n_jobs, n_threads=n_jobs)
+
+
+def thread_env(n_threads):
+    """Copy of the environment with BLAS/OpenMP thread pools limited."""
+    env = os.environ.copy()
+    for var in THREAD_VARS:
+        env[var] = str(n_threads)
+    return env
+
+
+def stage_command(stage, subj, n_jobs=1, overwrite=False, stage_args=()):
+    """Command line call of a stage script for one subject."""
+    script = os.path.join(parent, STAGES[stage]['script'])
+    return [sys.executable, script,
+            '--subj', str(subj),
+            '--overwrite', str(overwrite),
+            '--n_jobs', str(n_jobs),
+            *stage_args]
+
+
+def _size(fnames):
+    """Total size of the files that exist (in bytes)."""
+    return sum(os.path.getsize(fname) for fname in fnames
+               if os.path.exists(fname))
+
+
+def _terminate_when(cancel, process, finished):
+    """Terminate a process once ``cancel`` is set (until ``finished`` is)."""
+    while not finished.wait(1.):
+        if cancel.is_set():
+            logger.info(f"    > Terminating process {process.pid}")
+            process.terminate()
+            return
+
+
+def run_stage(stage, subj, n_jobs=1, n_threads=1, overwrite=False,
+              stage_args=(), manifest=True, metrics=True, cancel=None):
+    """Run a stage script for one subject in a separate process.
+
+    The run is recorded in the manifest (see ``manifest.py``), including the
+    last lines the script wrote to stderr if it fails, and in the event log
+    of ``metrics.py``. The script is terminated when the event ``cancel`` is
+    set (e.g., when the work queue lost the claim of the task). Returns the
+    exit code of the script.
+    """
+    cmd = stage_command(stage, subj, n_jobs, overwrite, stage_args)
+    logger.info(f"    > Running '{stage}' for subject {subj} "
+                f"(n_jobs={n_jobs}, threads={n_threads})")
+    record = record_start(stage, subj, command=cmd) if manifest else None
+    run_id = uuid4().hex
+    if metrics:
+        log_event('start', stage=stage, subject=int(subj), run=run_id,
+                  n_jobs=n_jobs,
+                  input_bytes=_size(input_files(stage, subj)))
+
+    # pass stderr on, but keep its last lines for the manifest
+    stderr = deque(maxlen=20)
+    started = time.time()
+    process = subprocess.Popen(cmd, env=thread_env(n_threads), cwd=parent,
+                               stderr=subprocess.PIPE, text=True)
+    finished = threading.Event()
+    if cancel is not None:
+        watcher = threading.Thread(target=_terminate_when,
+                                   args=(cancel, process, finished),
+                                   daemon=True)
+        watcher.start()
+    for line in process.stderr:
+        sys.stderr.write(line)
+        stderr.append(line)
+    process.stderr.close()
+    # the process must not be signalled once it is reaped
+    finished.set()
+    if cancel is not None:
+        watcher.join()
+    # wait4 also returns the resource usage of the process, ru_maxrss is its
+    # peak memory (in kB)
+    _, status, usage = os.wait4(process.pid, 0)
+    returncode = process.returncode = os.waitstatus_to_exitcode(status)
+
+    if returncode != 0:
+        logger.info(f"    > '{stage}' failed for subject {subj} "
+                    f"(exit code {returncode})")
+    if manifest:
+        record_end(record, returncode,
+                   error=''.join(stderr) if returncode != 0 else None,
+                   peak_memory_gb=usage.ru_maxrss / 1024 ** 2)
+    if metrics:
+        # ru_inblock and ru_oublock are counted in blocks of 512 bytes
+        log_event('end', stage=stage, subject=int(subj), run=run_id,
+                  status='done' if returncode == 0 else 'failed',
+                  returncode=returncode,
+                  duration=time.time() - started,
+                  bytes_read=usage.ru_inblock * 512,
+                  bytes_written=usage.ru_oublock * 512,
+                  output_bytes=_size(expected_outputs(stage, subj)),
+                  peak_memory_gb=usage.ru_maxrss / 1024 ** 2)
+        try:
+            write_textfile()
+        except OSError as err:
+            logger.info(f"    > Could not update the metrics: {err}")
+
+    return returncode
@@ -0,0 +1,137 @@
+"""Read only the data of the epochs from a raw file.
+
+``Epochs`` of a raw object that is not preloaded know their events and time
+window before any data are read. ``read_epoch_spans`` uses them to read only
+the picked channels and the samples the epochs cover (their windows merged
+into spans, so overlapping epochs are read once) and attaches these data to
+the raw object:
+
+- the data of the raw object have their usual shape, samples outside of the
+  spans are zeros that are never written (no memory is used for them, with a
+  memory-mapped file they do not take up disk space either),
+- the epochs then load their data (``Epochs.load_data``, ``EpochViews``) as
+  if the whole file had been read, so they are the same.
+
+Samples of all channels are interleaved in the buffers of a FIF file
+(usually 1 s), which mne reads as a whole. Leaving out channels thus saves
+memory but not reads from disk, and the spans are extended to whole buffers.
+Leaving out the parts of the recording without epochs saves both, e.g., for
+epochs that are shorter than the intervals between events.
+"""
+import numpy as np
+
+from mne.io.base import _allocate_data
+from mne.utils import logger
+
+
+def _merge(starts, stops):
+    """Merge overlapping sample ranges."""
+    order = np.argsort(starts, kind='stable')
+    spans = []
+    for start, stop in zip(starts[order], stops[order]):
+        if start >= stop:
+            continue
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], stop)
+        else:
+            spans.append([start, stop])
+    return np.array(spans, dtype=int).reshape(-1, 2)
+
+
+def _buffer_bounds(raw):
+    """First samples of the buffers of FIF files (and the end of the data).
+
+    ``None`` for other file formats.
+    """
+    bounds, offset = [], 0
+    for extras, first, last in zip(raw._raw_extras, raw._first_samps,
+                                   raw._last_samps):
+        if 'bounds' not in extras:
+            return None
+        n_times = last - first + 1
+        bounds.append(np.clip(extras['bounds'] - first, 0, n_times) + offset)
+        offset += n_times
+    return np.unique(np.concatenate(bounds))
+
+
+def epoch_spans(epochs):
+    """Sample ranges of the raw data that the epochs cover.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs of a raw object.
+
+    Returns
+    -------
+    spans : ndarray, shape (n_spans, 2)
+        First and last (excluded) sample of each span, relative to the first
+        sample of the raw data, in ascending order.
+    """
+    raw = epochs._raw
+    sfreq = raw.info['sfreq']
+    # windows of the epochs, computed like in mne (``_get_epoch_from_raw``)
+    starts = np.array(
+        [int(round(sample + epochs._raw_times[0] * sfreq))
+         for sample in epochs.events[:, 0]], dtype=int) - raw.first_samp
+    stops = np.minimum(starts + len(epochs._raw_times), raw.n_times)
+    return _merge(np.maximum(starts, 0), stops)
+
+
+def read_epoch_spans(epochs, preload=True, chunk_duration=60.):
+    """Read the data of epochs that are not preloaded into their raw object.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs created with ``preload=False`` from a raw object that is not
+        preloaded. Afterwards, the raw object is loaded and the epochs can
+        load their data.
+    preload : True | str
+        Keep the data in memory or in a memory-mapped file with this name.
+    chunk_duration : float
+        Seconds of data read at once.
+
+    Returns
+    -------
+    stats : dict
+        Number of spans and fraction of the samples of the recording that
+        were read.
+    """
+    raw = epochs._raw
+    if raw.preload:
+        raise ValueError('The data of the raw object are already loaded.')
+    picks = epochs.picks
+    spans = epoch_spans(epochs)
+    bounds = _buffer_bounds(raw)
+    if bounds is not None:
+        # mne reads whole buffers of a FIF file, read each of them once
+        spans = _merge(
+            bounds[np.searchsorted(bounds, spans[:, 0], side='right') - 1],
+            bounds[np.searchsorted(bounds, spans[:, 1])])
+    data = _allocate_data(preload, (raw.info['nchan'], raw.n_times),
+                          raw._dtype)
+
+    step = max(int(chunk_duration * raw.info['sfreq']), 1)
+    for start, span_stop in spans:
+        while start < span_stop:
+            stop = min(start + step, span_stop)
+            if bounds is not None:
+                stop = min(bounds[np.searchsorted(bounds, stop)], span_stop)
+            data[picks, start:stop] = raw._read_segment(start, stop,
+                                                        sel=picks)
+            start = stop
+
+    # like ``raw.load_data()``
+    raw._data = data
+    raw.preload = True
+    raw._comp = None
+    raw.close()
+
+    n_read = int(np.sum(spans[:, 1] - spans[:, 0]))
+    stats = dict(n_spans=len(spans),
+                 read_fraction=round(float(n_read / raw.n_times), 3))
+    logger.info(f"    > Read {len(picks)} of {raw.info['nchan']} channels "
+                f"and {stats['read_fraction']:.1%} of the samples "
+                f"({len(spans)} spans)")
+    return stats
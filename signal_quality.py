@@ -0,0 +1,231 @@
+"""Signal-quality precheck of the raw data.
+
+Disconnected electrodes, a saturated amplifier or flat channels only show up
+after minutes of PREP and ICA. The precheck streams the .bdf file of a
+recording in chunks (see ``bdf_io.iter_bdf_chunks``), only the task blocks if
+the events are known, and computes statistics of each channel in windows of
+1 s, vectorized over all windows of a chunk:
+
+- amplitude: standard deviation of the EEG after subtracting the median of
+  all EEG channels at each sample (Biosemi data are reference-free, the
+  common-mode signal would hide single bad channels),
+- flat windows: standard deviation of the data below ``flat``,
+- clipped windows: samples at the limits of the range of the amplifier,
+- line noise: amplitude at the line frequency relative to 1-40 Hz.
+
+EEG channels are bad if they are flat or clipped in too many windows, or if
+their median amplitude or line noise deviates from that of the other EEG
+channels (robust z-score, like the deviation criterion of PREP). External
+(EXG) channels are checked for flat and clipped windows. Subjects with too
+many bad EEG channels are hopeless, the bad channels of the other subjects
+seed the bad channels of PREP (see ``01_run_preprocessing.py``).
+"""
+import numpy as np
+import pandas as pd
+
+from bdf_io import read_bdf_header, iter_bdf_chunks
+
+from config import PRECHECK_PARAMS, montage
+
+
+def _robust_z(values):
+    """Deviation from the median in units of the (scaled) MAD."""
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    if not mad > 0:
+        return np.zeros_like(values)
+    return (values - median) / mad
+
+
+def window_statistics(data, sfreq, eeg, clip, flat=0.1e-6, line_freq=50.,
+                      window=1.):
+    """Statistics of each channel in consecutive windows of the data.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        Calibrated data (in V). Samples after the last full window are
+        ignored.
+    sfreq : float
+        Sampling frequency.
+    eeg : ndarray of bool, shape (n_channels,)
+        Which channels are EEG channels.
+    clip : ndarray, shape (n_channels,)
+        Absolute values (in V) at the limits of the range of each channel.
+    flat : float
+        Windows with a standard deviation below this value (in V) are flat.
+    line_freq : float
+        Frequency of the power line.
+    window : float
+        Length of the windows in seconds.
+
+    Returns
+    -------
+    stats : dict of ndarray, shape (n_channels, n_windows)
+        ``amplitude`` (in V), ``flat``, ``clipped`` and ``line_noise``.
+    """
+    size = int(round(window * sfreq))
+    n_windows = data.shape[1] // size
+    data = data[:, :n_windows * size].reshape(len(data), n_windows, size)
+
+    clipped = (np.abs(data) >= clip[:, np.newaxis, np.newaxis]).any(axis=-1)
+    data = data - data.mean(axis=-1, keepdims=True)
+    is_flat = data.std(axis=-1) < flat
+
+    # remove the common-mode signal of the EEG
+    data[eeg] -= np.median(data[eeg], axis=0)
+    amplitude = data.std(axis=-1)
+
+    power = np.abs(np.fft.rfft(data * np.hanning(size), axis=-1)) ** 2
+    freqs = np.fft.rfftfreq(size, 1. / sfreq)
+    line = np.abs(freqs - line_freq) <= 1.
+    broadband = (freqs >= 1.) & (freqs <= 40.)
+    line_power = power[..., line].sum(axis=-1)
+    broadband_power = power[..., broadband].sum(axis=-1)
+    # no line noise in flat windows
+    line_noise = np.sqrt(np.divide(line_power, broadband_power,
+                                   out=np.zeros_like(line_power),
+                                   where=broadband_power > 0))
+
+    return dict(amplitude=amplitude, flat=is_flat, clipped=clipped,
+                line_noise=line_noise)
+
+
+def _record_spans(header, blocks):
+    """First and last (exclusive) record of each block."""
+    n_records = header['n_records'] if header['n_records'] > 0 else None
+    if blocks is None:
+        return [(0, n_records)]
+    duration = header['record_duration']
+    spans = []
+    for start, stop in blocks:
+        start = max(int(np.floor(start / duration)), 0)
+        stop = int(np.ceil(stop / duration))
+        if n_records is not None:
+            stop = min(stop, n_records)
+        if stop > start:
+            spans.append((start, stop))
+    return spans
+
+
+def check_recording(fname, blocks=None, params=None, chunk_duration=60.):
+    """Statistics of the channels of a recording.
+
+    Parameters
+    ----------
+    fname : str
+        The .bdf file.
+    blocks : list of tuple | None
+        Start and end (in seconds) of the parts of the recording to check
+        (default: the whole recording).
+    params : dict | None
+        Thresholds, override those of ``PRECHECK_PARAMS`` in ``config.py``.
+    chunk_duration : float
+        Seconds of data read at once.
+
+    Returns
+    -------
+    channels : pd.DataFrame
+        One row per channel (except ``Status``): type, median amplitude,
+        fraction of flat and of clipped windows, median line noise, z-scores
+        of amplitude and line noise and the reasons why the channel is bad
+        (empty if it is good).
+    n_windows : int
+        Number of windows that were checked.
+    """
+    params = {**PRECHECK_PARAMS, **(params or {})}
+    header = read_bdf_header(fname)
+    sfreq = header['sfreq']
+    picks = [idx for idx, name in enumerate(header['ch_names'])
+             if name != 'Status']
+    ch_names = [header['ch_names'][idx] for idx in picks]
+    eeg = np.isin(ch_names, montage.ch_names)
+    exg = np.array([name.startswith(('EXG', 'EOG')) for name in ch_names])
+    clip = 0.999 * np.abs(header['phys_max'][picks])
+
+    chunk_records = max(int(chunk_duration / header['record_duration']), 1)
+    size = int(round(params['window'] * sfreq))
+    stats = []
+    for start, stop in _record_spans(header, blocks):
+        rest = np.empty((len(picks), 0))
+        for _, data in iter_bdf_chunks(fname, chunk_records=chunk_records,
+                                       start=start, stop=stop):
+            # windows continue across chunks
+            data = np.concatenate([rest, data[picks]], axis=1)
+            n_used = data.shape[1] // size * size
+            stats.append(window_statistics(
+                data[:, :n_used], sfreq, eeg, clip, flat=params['flat'],
+                line_freq=params['line_freq'], window=params['window']))
+            rest = data[:, n_used:]
+
+    stats = {key: np.concatenate([chunk[key] for chunk in stats], axis=1)
+             if stats else np.empty((len(picks), 0))
+             for key in ('amplitude', 'flat', 'clipped', 'line_noise')}
+    n_windows = stats['amplitude'].shape[1]
+    if n_windows == 0:
+        return pd.DataFrame(dict(name=ch_names)), 0
+
+    amplitude = np.median(stats['amplitude'], axis=1)
+    line_noise = np.median(stats['line_noise'], axis=1)
+    channels = pd.DataFrame(dict(
+        name=ch_names,
+        type=np.where(eeg, 'eeg', np.where(exg, 'exg', 'misc')),
+        amplitude_uv=amplitude * 1e6,
+        flat_fraction=stats['flat'].mean(axis=1),
+        clipped_fraction=stats['clipped'].mean(axis=1),
+        line_noise=line_noise,
+        amplitude_z=np.nan,
+        line_noise_z=np.nan,
+    ))
+    # deviation from the other EEG channels
+    channels.loc[eeg, 'amplitude_z'] = _robust_z(
+        np.log(np.maximum(amplitude[eeg], 1e-12)))
+    channels.loc[eeg, 'line_noise_z'] = _robust_z(line_noise[eeg])
+
+    reasons = pd.DataFrame(dict(
+        flat=channels.flat_fraction > params['max_flat'],
+        clipped=channels.clipped_fraction > params['max_clipped'],
+        amplitude=channels.amplitude_z.abs() > params['max_z'],
+        line_noise=channels.line_noise_z > params['max_z'],
+    ))
+    channels['reasons'] = reasons.apply(
+        lambda row: ','.join(row.index[row]), axis=1)
+
+    return channels, n_windows
+
+
+def assess(channels, n_windows, params=None):
+    """Status of a recording (see ``check_recording``).
+
+    Returns
+    -------
+    summary : dict
+        ``status`` (``'ok'``, ``'flagged'`` or ``'hopeless'``), the
+        ``reasons`` for it, the bad EEG channels (``bad_channels``) and bad
+        external channels (``bad_exg``).
+    """
+    params = {**PRECHECK_PARAMS, **(params or {})}
+    if n_windows == 0:
+        return dict(status='hopeless', reasons=['no data'], bad_channels=[],
+                    bad_exg=[], n_windows=0)
+
+    bad = channels.reasons != ''
+    eeg = channels.type == 'eeg'
+    exg = channels.type == 'exg'
+    bad_channels = channels.name[eeg & bad].tolist()
+    bad_exg = channels.name[exg & bad].tolist()
+
+    status, reasons = 'ok', []
+    if bad_channels or bad_exg:
+        status = 'flagged'
+        reasons.append(f'bad channels: {", ".join(bad_channels + bad_exg)}')
+    if exg.any() and exg.sum() == len(bad_exg):
+        reasons.append('all external channels are flat or clipped')
+    # too many channels to interpolate
+    if len(bad_channels) / max(eeg.sum(), 1) > params['max_bad_fraction']:
+        status = 'hopeless'
+        reasons.insert(0, f'{len(bad_channels)} of {eeg.sum()} EEG channels '
+                          f'are bad')
+
+    return dict(status=status, reasons=reasons, bad_channels=bad_channels,
+                bad_exg=bad_exg, n_windows=int(n_windows))
@@ -0,0 +1,249 @@
+"""Time-frequency decomposition of epochs with a Morlet wavelet bank.
+
+The FFTs of the wavelets are computed once. Epochs are read from disk in
+chunks (``preload=False``) whose size is derived from a memory budget. All
+signals (epochs x channels) of a chunk are transformed with a single FFT,
+multiplied with the FFT of each wavelet and transformed back in one batched
+inverse FFT per frequency, decimated in the frequency domain (see
+``WaveletBank``). The result is the same as that of
+``mne.time_frequency.tfr_array_morlet``.
+
+Power of each epoch is written to a memory-mapped ``.npy`` file with the
+shape ``(n_epochs, n_channels, n_freqs, n_times)`` (like ``EpochsTFR.data``)
+and inter-trial coherence (ITC) of each condition (see ``ERP_CONDITIONS`` in
+``config.py``) to another one with the shape
+``(n_conditions, n_channels, n_freqs, n_times)``. A ``.json`` file describes
+both (see ``read_tfr``) and is written last.
+"""
+import os
+import json
+
+import numpy as np
+
+from scipy.fft import fft, ifft, next_fast_len
+
+from mne import read_epochs
+from mne.time_frequency import morlet
+from mne.utils import logger
+
+from erp_aggregation import condition_labels
+
+from layout import get_fname
+
+from utils import write_json
+
+
+class WaveletBank:
+    """FFTs of Morlet wavelets for signals of a given length.
+
+    Decimation is done before the inverse FFT: keeping every ``decim``-th
+    sample of a signal is the same as summing ``decim`` segments of its
+    spectrum (aliasing) and transforming the shorter spectrum back. The
+    offset of the first sample is folded into the FFTs of the wavelets, so
+    the result is exactly that of ``mne.time_frequency.tfr_array_morlet``
+    (with the same ``zero_mean``), with ``decim`` times shorter inverse
+    FFTs.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the signals.
+    freqs : array of float
+        Frequencies of the wavelets.
+    n_cycles : float | array of float
+        Number of cycles of each wavelet.
+    n_times : int
+        Length of the signals.
+    decim : int
+        Keep every ``decim``-th sample.
+    zero_mean : bool
+        Remove the mean of the wavelets, so that the DC offset of the signals
+        does not leak into the power of low frequencies (the default of
+        ``tfr_array_morlet``).
+    """
+
+    def __init__(self, sfreq, freqs, n_cycles, n_times, decim=1,
+                 zero_mean=True):
+        wavelets = morlet(sfreq, freqs, n_cycles=n_cycles,
+                          zero_mean=zero_mean)
+        max_size = max(wavelet.size for wavelet in wavelets)
+        if max_size > n_times:
+            raise ValueError(f"The longest wavelet ({max_size} samples) is "
+                             f"longer than the signals ({n_times} samples).")
+        self.freqs = np.asarray(freqs)
+        self.n_times = n_times
+        self.decim = decim
+        self.n_times_decim = len(range(0, n_times, decim))
+        # the length of the FFT must be a multiple of ``decim``
+        self.nfft = decim * next_fast_len(
+            -(-(n_times + max_size - 1) // decim))
+
+        # the part of the convolution with the length of the signals starts
+        # at ``(size - 1) // 2``, shift it to the first sample
+        shift = np.exp(2j * np.pi * np.arange(self.nfft) / self.nfft)
+        self.ffts = np.array([fft(wavelet, self.nfft)
+                              * shift ** ((wavelet.size - 1) // 2)
+                              for wavelet in wavelets])
+
+    def bytes_per_signal(self):
+        """Memory needed to transform one signal (FFT, product, result)."""
+        return 3 * self.nfft * np.dtype(np.complex128).itemsize
+
+    def transform(self, signals, workers=1):
+        """Transform signals, one frequency at a time.
+
+        Parameters
+        ----------
+        signals : array, shape (n_signals, n_times)
+            The signals.
+        workers : int
+            Number of threads of the FFT.
+
+        Yields
+        ------
+        index : int
+            Index of the frequency.
+        tfr : array of complex, shape (n_signals, n_times_decim)
+            The transformed signals.
+        """
+        n_signals = len(signals)
+        spectra = fft(signals, self.nfft, axis=-1, workers=workers)
+        for index, wavelet in enumerate(self.ffts):
+            product = spectra * wavelet
+            if self.decim > 1:
+                product = product.reshape(n_signals, self.decim, -1) \
+                    .sum(axis=1)
+                product /= self.decim
+            tfr = ifft(product, axis=-1, workers=workers)
+            yield index, tfr[:, :self.n_times_decim]
+
+
+def compute_tfr(subj, freqs, n_cycles, decim=1, freq_decim=1,
+                zero_mean=True, conditions=None, memory_budget=256.,
+                n_jobs=1):
+    """Write power and ITC of the cue epochs of a subject.
+
+    Parameters
+    ----------
+    subj : int
+        The subject.
+    freqs, n_cycles : array of float
+        Frequencies and cycles of the wavelets.
+    decim, freq_decim : int
+        Keep every ``decim``-th sample and every ``freq_decim``-th
+        frequency.
+    zero_mean : bool
+        Use wavelets with zero mean (see ``WaveletBank``).
+    conditions : list of tuple | None
+        Conditions of the ITC (default: ``ERP_CONDITIONS``).
+    memory_budget : float
+        Approximate memory (in MB) used for the transform of a chunk.
+    n_jobs : int
+        Number of threads of the FFTs.
+
+    Returns
+    -------
+    description : dict
+        See ``read_tfr``.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    n_cycles = np.broadcast_to(np.asarray(n_cycles, dtype=float),
+                               freqs.shape)[::freq_decim]
+    freqs = freqs[::freq_decim]
+
+    epochs = read_epochs(get_fname('epochs', subj), preload=False,
+                         verbose=False)
+    n_epochs, n_channels = len(epochs), len(epochs.ch_names)
+    n_times = len(epochs.times)
+    bank = WaveletBank(epochs.info['sfreq'], freqs, n_cycles, n_times,
+                       decim, zero_mean)
+    times = epochs.times[::decim]
+
+    # only the conditions that occur
+    labels = condition_labels(epochs.metadata, conditions)
+    names = sorted({name for label in labels for name in label.dropna()})
+
+    # the description is written last, the outputs are complete with it
+    fname = get_fname('tfr', subj, make_dirs=True)
+    if os.path.exists(fname):
+        os.remove(fname)
+    power = np.lib.format.open_memmap(
+        get_fname('tfr_power', subj), mode='w+', dtype=np.float32,
+        shape=(n_epochs, n_channels, len(freqs), len(times)))
+    itc = np.zeros((len(names), n_channels, len(freqs), len(times)),
+                   dtype=np.complex64)
+    counts = np.zeros(len(names), dtype=int)
+
+    chunk_size = int(memory_budget * 1024 ** 2
+                     // (n_channels * bank.bytes_per_signal()))
+    chunk_size = min(max(chunk_size, 1), n_epochs)
+    logger.info(f"    > {n_epochs} epochs, {len(freqs)} frequencies, "
+                f"{chunk_size} epochs per chunk")
+
+    for start in range(0, n_epochs, chunk_size):
+        stop = min(start + chunk_size, n_epochs)
+        data = epochs[start:stop].get_data()
+        n_chunk = stop - start
+
+        # rows of the ITC each epoch of the chunk contributes to
+        members = [(names.index(name), label.iloc[start:stop].to_numpy()
+                    == name)
+                   for label in labels
+                   for name in label.iloc[start:stop].dropna().unique()]
+        for row, member in members:
+            counts[row] += member.sum()
+
+        signals = data.reshape(n_chunk * n_channels, n_times)
+        for index, tfr in bank.transform(signals, workers=n_jobs):
+            tfr = tfr.reshape(n_chunk, n_channels, -1)
+            amplitude = np.abs(tfr)
+            power[start:stop, :, index] = amplitude ** 2
+            amplitude[amplitude == 0] = 1.
+            phase = tfr / amplitude
+            for row, member in members:
+                itc[row, :, index] += phase[member].sum(axis=0)
+
+    power.flush()
+    del power
+    itc = np.abs(itc) / np.maximum(counts, 1)[:, None, None, None]
+    itc_map = np.lib.format.open_memmap(
+        get_fname('tfr_itc', subj), mode='w+', dtype=np.float32,
+        shape=itc.shape)
+    itc_map[:] = itc
+    itc_map.flush()
+    del itc_map
+
+    description = dict(subject=int(subj),
+                       freqs=freqs.tolist(),
+                       n_cycles=n_cycles.tolist(),
+                       times=times.tolist(),
+                       sfreq=epochs.info['sfreq'] / decim,
+                       decim=decim,
+                       freq_decim=freq_decim,
+                       zero_mean=bool(zero_mean),
+                       ch_names=epochs.ch_names,
+                       conditions=names,
+                       n_epochs=dict(zip(names, counts.tolist())),
+                       selection=epochs.selection.tolist())
+    write_json(fname, description)
+    return description
+
+
+def read_tfr(subj, mode='r'):
+    """Memory-mapped power and ITC of a subject.
+
+    Returns
+    -------
+    power : np.memmap, shape (n_epochs, n_channels, n_freqs, n_times)
+        Power of each epoch (in the order of the epochs file).
+    itc : np.memmap, shape (n_conditions, n_channels, n_freqs, n_times)
+        ITC of each condition.
+    description : dict
+        ``freqs``, ``times``, ``ch_names``, ``conditions`` (rows of
+        ``itc``), ``n_epochs`` (per condition) and the parameters.
+    """
+    with open(get_fname('tfr', subj)) as description:
+        description = json.load(description)
+    power = np.load(get_fname('tfr_power', subj), mmap_mode=mode)
+    itc = np.load(get_fname('tfr_itc', subj), mmap_mode=mode)
+    return power, itc, description
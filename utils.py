@@ -1,6 +1,12 @@
 """General utility functions that are re-used in different scripts."""
+import os
+import json
+
+from uuid import uuid4
 
 import click
+import numpy as np
+
 from mne.utils import logger
 
 
@@ -8,10 +14,67 @@ from mne.utils import logger
 @click.option("--subj", type=int, help="Subject number")
 @click.option("--overwrite", default=False, type=bool, help="Overwrite?")
 @click.option("--interactive", default=False, type=bool, help="Interactive?")
+@click.option("--n_jobs", default=1, type=int,
+              help="Number of jobs to run in parallel")
+@click.option("--plot_ica", default=False, type=bool,
+              help="Save figure of ICA components?")
+@click.option("--memory_budget", default=None, type=float,
+              help="Process data in chunks using about this much memory (MB)")
+@click.option("--low_memory", default=False, type=bool,
+              help="Avoid copies of the data where possible?")
+@click.option("--interpolation_cache", default=True, type=bool,
+              help="Keep interpolation matrices on disk for other subjects?")
+@click.option("--ica_method", default=None, type=str,
+              help="ICA solver (see `ICA_METHODS` in config.py)")
+@click.option("--ica_max_iter", default=None, type=int,
+              help="Maximum number of iterations of the ICA solver")
+@click.option("--ica_tol", default=None, type=float,
+              help="Stopping tolerance of the ICA solver")
+@click.option("--line_noise_method", default=None, type=str,
+              help="Line-noise removal (`LINE_NOISE_METHODS` in config.py)")
+@click.option("--random_state", default=None, type=int,
+              help="Seed of the ICA solver (for reproducible results)")
+@click.option("--background_writes", default=True, type=bool,
+              help="Write outputs on a background thread?")
+@click.option("--decoded_cache", default=False, type=bool,
+              help="Read decoded .bdf data from the cache?")
+@click.option("--skip_hopeless", default=True, type=bool,
+              help="Fail for subjects that fail the signal-quality precheck?")
+@click.option("--precheck_bads", default=True, type=bool,
+              help="Start PREP with the bad channels of the precheck?")
+@click.option("--reference_method", default=None, type=str,
+              help="Robust referencing of PREP ('pyprep' or 'vectorized')")
+@click.option("--epoch_views", default=False, type=bool,
+              help="Epochs as views of memory-mapped data?")
+@click.option("--selective_read", default=False, type=bool,
+              help="Read only the data of the epochs?")
+@click.option("--decim", default=None, type=int,
+              help="Keep every n-th sample of time-frequency results")
+@click.option("--freq_decim", default=None, type=int,
+              help="Keep every n-th frequency of time-frequency results")
 def get_inputs(
         subj,
         overwrite,
         interactive,
+        n_jobs,
+        plot_ica,
+        memory_budget,
+        low_memory,
+        interpolation_cache,
+        ica_method,
+        ica_max_iter,
+        ica_tol,
+        line_noise_method,
+        random_state,
+        background_writes,
+        decoded_cache,
+        skip_hopeless,
+        precheck_bads,
+        reference_method,
+        epoch_views,
+        selective_read,
+        decim,
+        freq_decim,
 ):
     """Parse inputs in case script is run from command line.
     See Also
@@ -23,6 +86,25 @@ def get_inputs(
         sub=subj,
         overwrite=overwrite,
         interactive=interactive,
+        n_jobs=n_jobs,
+        plot_ica=plot_ica,
+        memory_budget=memory_budget,
+        low_memory=low_memory,
+        interpolation_cache=interpolation_cache,
+        ica_method=ica_method,
+        ica_max_iter=ica_max_iter,
+        ica_tol=ica_tol,
+        line_noise_method=line_noise_method,
+        random_state=random_state,
+        background_writes=background_writes,
+        decoded_cache=decoded_cache,
+        skip_hopeless=skip_hopeless,
+        precheck_bads=precheck_bads,
+        reference_method=reference_method,
+        epoch_views=epoch_views,
+        selective_read=selective_read,
+        decim=decim,
+        freq_decim=freq_decim,
     )
 
     return inputs
@@ -48,3 +130,108 @@ def parse_overwrite(defaults):
         logger.info("Nothing to overwrite, use defaults defined in script.\n")
 
     return defaults
+
+
+def parse_subjects(subjects, valid_ids):
+    """Parse a subject specification such as ``'1-10,12'``.
+
+    If ``subjects`` is None, all ``valid_ids`` are returned.
+    """
+    if subjects is None:
+        return [int(subj) for subj in valid_ids]
+
+    parsed = []
+    for part in str(subjects).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, stop = part.split('-')
+            parsed.extend(range(int(start), int(stop) + 1))
+        else:
+            parsed.append(int(part))
+
+    invalid = [subj for subj in parsed if subj not in valid_ids]
+    if invalid:
+        raise ValueError(f"{invalid} are not valid subject IDs.\n"
+                         f"Use: {valid_ids}")
+
+    # keep order, drop duplicates
+    return list(dict.fromkeys(parsed))
+
+
+def _json_default(obj):
+    """Convert numpy types for .json export."""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def write_json(fname, obj):
+    """Write .json file atomically.
+
+    The file is written to a temporary file first and then renamed, so that
+    readers never see half-written files, also on network storage.
+    """
+    fname = str(fname)
+    tmp = fname + f'.tmp-{uuid4().hex}'
+    with open(tmp, 'w') as tmp_file:
+        json.dump(obj, tmp_file, indent=2, default=_json_default)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp, fname)
+
+
+def ica_template_scores(ica, template):
+    """Absolute correlation of each ICA component map with a template map."""
+    maps = ica.get_components()
+    maps = (maps - maps.mean(axis=0)) / maps.std(axis=0)
+    template = np.asarray(template)
+    template = (template - template.mean()) / template.std()
+    return np.abs(template @ maps) / len(template)
+
+
+def find_task_blocks(latencies, subj=None, break_duration=10.):
+    """Find the two task blocks of a DPX recording.
+
+    Blocks are separated by long breaks, i.e., when the time difference
+    between two consecutive cues is greater than ``break_duration`` seconds.
+    The first block is the practice block, which is skipped.
+
+    Parameters
+    ----------
+    latencies : array of float
+        Onsets of the cues (in seconds).
+    subj : int | None
+        The subject. Subject 41 had two rounds of practice trials.
+    break_duration : float
+        Minimum duration of a break between blocks (in seconds).
+
+    Returns
+    -------
+    breaks : list of int
+        Positions of the last cue before each break.
+    blocks : list of tuple
+        Start and end (in seconds) of the two task blocks.
+    """
+    diffs = np.diff(latencies)
+    breaks = [int(pos) for pos in np.flatnonzero(diffs > break_duration)]
+
+    # subject '041' has more practice trials (two rounds)
+    first = 2 if subj == 41 else 0
+    if len(breaks) < first + 2:
+        raise ValueError(f"Expected at least {first + 2} breaks between "
+                         f"blocks, found {len(breaks)}")
+
+    # start of first block, end of first block
+    b1s = latencies[breaks[first] + 1] - 2
+    b1e = latencies[breaks[first + 1]] + 6
+
+    # start of second block, end of second block
+    b2s = latencies[breaks[first + 1] + 1] - 2
+    if len(breaks) > first + 2:
+        b2e = latencies[breaks[first + 2]] + 6
+    else:
+        b2e = latencies[-1] + 6
+
+    return breaks, [(b1s, b1e), (b2s, b2e)]
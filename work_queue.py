@@ -0,0 +1,379 @@
+"""Shared-filesystem work queue for running the pipeline on several nodes.
+
+Workers on any machine that can see the derivatives directory (e.g., via NFS)
+claim ``(stage, subject)`` tasks by atomically creating lock files. No
+database or scheduler is needed, which keeps the queue usable on network
+storage where SQLite locking is unreliable.
+
+The queue directory contains one sub-directory per stage with the files::
+
+    sub-XXX.lock           task is claimed; owner in the file, heartbeat
+                           via mtime
+    sub-XXX.lock.breaking  a worker is breaking or releasing the lock
+    sub-XXX.done           task finished successfully
+    sub-XXX.failed         failed attempts of the task (JSON)
+
+Lock files that have not been touched for ``stale_after`` seconds belong to
+workers that died; they are broken and the attempt is counted as failed.
+Lock files are only removed by a worker that holds the ``.breaking`` marker
+of the lock, and a lock is only broken if it is still stale once the marker
+is held. A worker that was only stalled has lost its claim: it notices that
+the lock is no longer the one it created, stops the task and neither
+finishes nor releases it.
+Tasks are retried until they failed ``max_retries`` times. A task only
+becomes available once the same subject finished the previous stage(s).
+"""
+import os
+import json
+import time
+import socket
+import threading
+
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+from mne.utils import logger
+
+from utils import write_json
+
+Task = namedtuple('Task', ['stage', 'subj'])
+
+
+class WorkQueue:
+    """Queue of ``(stage, subject)`` tasks in a shared directory.
+
+    Parameters
+    ----------
+    root : str | Path
+        Directory of the queue. Must be visible to all workers.
+    stages : list of str
+        Stages to run, in order.
+    subjects : list of int
+        Subjects to process.
+    stale_after : float
+        Seconds after which a lock without heartbeat is considered stale.
+    max_retries : int
+        Number of times a task is attempted before giving up on it.
+    """
+
+    def __init__(self, root, stages, subjects, stale_after=600.,
+                 max_retries=3):
+        self.root = Path(root)
+        self.stages = list(stages)
+        self.subjects = list(subjects)
+        self.stale_after = stale_after
+        self.max_retries = max_retries
+        self.worker_id = '%s-%d-%s' % (socket.gethostname(), os.getpid(),
+                                       uuid4().hex[:6])
+        # inode of the lock file of each task claimed by this worker
+        self._claims = {}
+        for stage in self.stages:
+            (self.root / stage).mkdir(parents=True, exist_ok=True)
+
+    def _fname(self, task, kind):
+        return self.root / task.stage / ('sub-%03d.%s' % (task.subj, kind))
+
+    def now(self):
+        """Current time of the file server.
+
+        Lock ages are computed from file modification times, which are set by
+        the file server. Using its clock avoids problems with clock skew
+        between nodes.
+        """
+        clock = self.root / ('.clock-%s' % self.worker_id)
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def attempts(self, task):
+        """Number of failed attempts of a task."""
+        try:
+            with open(self._fname(task, 'failed')) as failed:
+                return json.load(failed)['attempts']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    def state(self, task, now=None):
+        """State of a task.
+
+        One of ``'done'``, ``'failed'`` (retries exhausted), ``'running'``,
+        ``'stale'`` (lock without heartbeat), ``'waiting'`` (previous stage
+        not finished yet), ``'blocked'`` (previous stage failed) or
+        ``'ready'``.
+        """
+        if self._fname(task, 'done').exists():
+            return 'done'
+        if self.attempts(task) >= self.max_retries:
+            return 'failed'
+
+        try:
+            heartbeat = self._fname(task, 'lock').stat().st_mtime
+        except FileNotFoundError:
+            pass
+        else:
+            now = self.now() if now is None else now
+            if now - heartbeat < self.stale_after:
+                return 'running'
+            return 'stale'
+
+        # check dependencies (previous stages of the same subject)
+        position = self.stages.index(task.stage)
+        for stage in self.stages[:position]:
+            previous = self.state(Task(stage, task.subj), now)
+            if previous in ('failed', 'blocked'):
+                return 'blocked'
+            if previous != 'done':
+                return 'waiting'
+
+        return 'ready'
+
+    def summary(self):
+        """Number of tasks in each state."""
+        now = self.now()
+        counts = {}
+        for stage in self.stages:
+            for subj in self.subjects:
+                state = self.state(Task(stage, subj), now)
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def pending(self):
+        """Whether there are tasks left that may still be processed."""
+        counts = self.summary()
+        return sum(counts.get(state, 0)
+                   for state in ('running', 'stale', 'waiting', 'ready')) > 0
+
+    def claim(self):
+        """Claim the next available task. Returns None if there is none."""
+        now = self.now()
+        for stage in self.stages:
+            for subj in self.subjects:
+                task = Task(stage, subj)
+                state = self.state(task, now)
+                if state == 'stale':
+                    self._break_lock(task)
+                    state = self.state(task, now)
+                if state == 'ready' and self._acquire(task):
+                    return task
+        return None
+
+    def _acquire(self, task):
+        # O_EXCL creation is atomic, also on NFS (v3 and later)
+        try:
+            fd = os.open(self._fname(task, 'lock'),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+
+        self._claims[task] = os.fstat(fd).st_ino
+        with os.fdopen(fd, 'w') as lock:
+            json.dump(dict(worker=self.worker_id,
+                           host=socket.gethostname(),
+                           pid=os.getpid(),
+                           claimed=time.time()), lock)
+        logger.info(f"    > {self.worker_id} claimed "
+                    f"'{task.stage}' for subject {task.subj}")
+        return True
+
+    def _is_own_lock(self, fname, task):
+        """Whether a lock file is the one this worker created for a task.
+
+        The inode tells apart a lock that was broken and created again by
+        another worker, the worker id one whose inode was reused.
+        """
+        try:
+            inode = os.stat(fname).st_ino
+            with open(fname) as owner:
+                owner = json.load(owner)['worker']
+        except (FileNotFoundError, ValueError, KeyError):
+            return False
+        return inode == self._claims.get(task) and owner == self.worker_id
+
+    def owns(self, task):
+        """Whether this worker still holds the lock of a claimed task."""
+        return self._is_own_lock(self._fname(task, 'lock'), task)
+
+    @contextmanager
+    def _breaking(self, task, timeout=0.):
+        """Hold the marker that allows to remove the lock of a task.
+
+        Yields False if another worker holds it (for longer than ``timeout``
+        seconds). Markers of workers that died while holding them are
+        removed after ``stale_after`` seconds.
+        """
+        marker = self._fname(task, 'lock.breaking')
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                                 0o644))
+                break
+            except FileExistsError:
+                pass
+            try:
+                if self.now() - marker.stat().st_mtime > self.stale_after:
+                    marker.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() >= deadline:
+                yield False
+                return
+            time.sleep(0.05)
+
+        try:
+            yield True
+        finally:
+            marker.unlink()
+
+    def _break_lock(self, task):
+        lock = self._fname(task, 'lock')
+        with self._breaking(task) as breaking:
+            if not breaking:
+                return
+            # the lock may have been touched (or released) since its state
+            # was checked
+            try:
+                heartbeat = lock.stat().st_mtime
+                with open(lock) as owner:
+                    owner = json.load(owner).get('worker', 'unknown')
+            except FileNotFoundError:
+                return
+            except ValueError:
+                owner = 'unknown'
+            if self.now() - heartbeat < self.stale_after:
+                return
+            lock.unlink()
+
+        logger.info(f"    > Broke stale lock of '{task.stage}' for subject "
+                    f"{task.subj} (worker {owner})")
+        self._record_failure(task, f"worker {owner} stopped responding")
+
+    def _record_failure(self, task, error):
+        fname = self._fname(task, 'failed')
+        try:
+            with open(fname) as failed:
+                failed = json.load(failed)
+        except (FileNotFoundError, ValueError):
+            failed = dict(attempts=0, errors=[])
+        failed['attempts'] += 1
+        failed['errors'].append(dict(worker=self.worker_id,
+                                     time=time.time(),
+                                     error=error))
+        write_json(fname, failed)
+
+    @contextmanager
+    def heartbeat(self, task, interval=30.):
+        """Keep touching the lock of a task while it is being processed.
+
+        Yields an event that is set when the lock was lost (broken by
+        another worker), the task should be stopped then.
+        """
+        lock = self._fname(task, 'lock')
+        stop, lost = threading.Event(), threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                # do not keep the lock of another worker alive
+                if not self.owns(task):
+                    logger.warning(f"    > {self.worker_id} lost its claim "
+                                   f"on '{task.stage}' for subject "
+                                   f"{task.subj}, stopping it")
+                    lost.set()
+                    break
+                try:
+                    os.utime(lock)
+                except FileNotFoundError:
+                    lost.set()
+                    break
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, task, success, error=None):
+        """Mark a claimed task as done (or failed) and release its lock.
+
+        Returns
+        -------
+        completed : bool
+            False if the claim was lost: the lock was broken (and the attempt
+            counted as failed) while this worker stalled, and the task may
+            have been claimed again. Nothing is marked in that case.
+        """
+        # hold the marker, so that the lock is not broken between checking
+        # that it is ours and removing it
+        with self._breaking(task, timeout=self.stale_after) as breaking:
+            owns = breaking and self.owns(task)
+            self._claims.pop(task, None)
+            if owns:
+                if success:
+                    write_json(self._fname(task, 'done'),
+                               dict(worker=self.worker_id,
+                                    finished=time.time()))
+                else:
+                    self._record_failure(task, error)
+                self._fname(task, 'lock').unlink()
+
+        if not owns:
+            logger.warning(f"    > {self.worker_id} lost its claim on "
+                           f"'{task.stage}' for subject {task.subj}, the "
+                           f"result is discarded")
+        return owns
+
+    def close(self):
+        """Remove files of this worker."""
+        clock = self.root / ('.clock-%s' % self.worker_id)
+        if clock.exists():
+            clock.unlink()
+
+
+def work(queue, run, poll=30., heartbeat=30.):
+    """Process tasks of a queue until no task is left.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The queue to take tasks from.
+    run : callable
+        Called as ``run(stage, subj, cancel=event)``, must return 0 on
+        success. The event is set when the lock of the task was lost, ``run``
+        should stop the task then.
+    poll : float
+        Seconds to wait before looking for new tasks when all remaining tasks
+        are claimed by other workers or wait for a previous stage.
+    heartbeat : float
+        Seconds between two heartbeats. Must be well below the queue's
+        ``stale_after``.
+    """
+    n_done = 0
+    try:
+        while True:
+            task = queue.claim()
+            if task is None:
+                if not queue.pending():
+                    break
+                time.sleep(poll)
+                continue
+
+            with queue.heartbeat(task, heartbeat) as lost:
+                try:
+                    code = run(task.stage, task.subj, cancel=lost)
+                    error = None if code == 0 else f"exit code {code}"
+                except Exception as err:
+                    error = repr(err)
+            completed = queue.complete(task, success=error is None,
+                                       error=error)
+            n_done += completed and error is None
+
+        logger.info(f"\nWorker {queue.worker_id} finished {n_done} tasks.\n"
+                    f"Queue: {queue.summary()}\n")
+    finally:
+        queue.close()
+
+    return n_done